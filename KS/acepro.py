@@ -8,6 +8,10 @@ from ks_includes.screen_panel import ScreenPanel
 from ks_includes.widgets.keypad import Keypad
 
 
+# 驱动状态尚不可用时显示的料盘数（单个 ACE）
+DEFAULT_SLOT_COUNT = 4
+
+
 class Panel(ScreenPanel):
     def __init__(self, screen, title):
         super().__init__(screen, title)
@@ -25,13 +29,12 @@ class Panel(ScreenPanel):
         self.slot_color_boxes = []
         self.slot_buttons = []
         
+        # 工具表：每个全局工具号对应的 (单元, 料盘)，来自驱动 get_status 的 slots
+        self.tool_table = self.get_tool_table()
+        self.main_screen_active = False
+        
         # 存储配置界面的实际料盘数据
-        self.slot_data = [
-            {"material": "PLA", "color": [255, 255, 255], "temp": 200, "status": "empty"},
-            {"material": "PLA", "color": [255, 255, 255], "temp": 200, "status": "empty"},
-            {"material": "PLA", "color": [255, 255, 255], "temp": 200, "status": "empty"},
-            {"material": "PLA", "color": [255, 255, 255], "temp": 200, "status": "empty"}
-        ]
+        self.slot_data = [self.default_slot_data() for _ in self.tool_table]
         
         # 创建主屏幕布局
         self.create_main_screen()
@@ -46,6 +49,11 @@ class Panel(ScreenPanel):
                 logging.info("ACE: 已订阅 saved_variables 更新")
             except Exception as e:
                 logging.error(f"ACE: 订阅 saved_variables 失败: {e}")
+            try:
+                self._screen.printer.klippy.subscribe_object("ace", ["slots", "units"])
+                logging.info("ACE: 已订阅 ace 工具表更新")
+            except Exception as e:
+                logging.error(f"ACE: 订阅 ace 失败: {e}")
         
         # 从 saved_variables 初始化已加载料盘（将在 get_current_loaded_slot 中更新）
         
@@ -176,6 +184,44 @@ class Panel(ScreenPanel):
             logging.error(f"ACE: 读取 ace_current_index 错误: {e}")
             return getattr(self, 'current_loaded_slot', -1)
     
+    @staticmethod
+    def default_slot_data():
+        """未配置料盘的默认数据"""
+        return {"material": "PLA", "color": [255, 255, 255], "temp": 200, "status": "empty"}
+    
+    def get_tool_table(self, count=None):
+        """从驱动状态读取工具表；状态尚不可用时按 count（默认 4）个单单元料盘处理"""
+        slots = None
+        try:
+            ace_status = self._screen.printer.data.get('ace', {})
+            slots = ace_status.get('slots')
+        except Exception as e:
+            logging.error(f"ACE: 读取 ace 工具表错误: {e}")
+        if isinstance(slots, list) and slots:
+            return [{"unit": slot.get("unit", "ace"), "slot": slot.get("slot", i)}
+                    for i, slot in enumerate(slots)]
+        return [{"unit": "ace", "slot": i} for i in range(count or DEFAULT_SLOT_COUNT)]
+    
+    def tool_title(self, tool):
+        """工具标题；多单元时附上单元和料盘，与驱动的工具描述一致"""
+        units = {entry["unit"] for entry in self.tool_table}
+        if len(units) > 1:
+            entry = self.tool_table[tool]
+            return f"料盘 {tool} ({entry['unit']}:{entry['slot']})"
+        return f"料盘 {tool}"
+    
+    def set_tool_table(self, tool_table):
+        """工具表变化时调整料盘数据，并在主屏幕可见时重建布局"""
+        if tool_table == self.tool_table:
+            return
+        logging.info(f"ACE: 工具表更新为 {len(tool_table)} 个料盘")
+        self.tool_table = tool_table
+        self.slot_data = (self.slot_data[:len(tool_table)]
+                          + [self.default_slot_data()
+                             for _ in range(len(tool_table) - len(self.slot_data))])
+        if self.main_screen_active:
+            self.return_to_main_screen()
+    
     def initialize_loaded_slot(self):
         """从 saved_variables 或查询 ACE 状态初始化已加载料盘"""
         # 尝试获取当前已加载料盘
@@ -448,8 +494,7 @@ class Panel(ScreenPanel):
         
         logging.info(f"ACE: 当前已加载料盘: {current_loaded}")
         
-        for slot in range(4):
-            slot_btn = self.slot_buttons[slot]
+        for slot, slot_btn in enumerate(self.slot_buttons):
             if slot == current_loaded:
                 slot_btn.get_style_context().remove_class("ace_slot_empty")
                 slot_btn.get_style_context().add_class("ace_slot_loaded")
@@ -605,6 +650,8 @@ class Panel(ScreenPanel):
     
     def show_slot_config_screen(self, slot):
         """创建紧凑的双列配置屏幕以适应 480px"""
+        self.main_screen_active = False
+        
         # 从料盘数据加载当前值
         slot_info = self.slot_data[slot]
         self.config_material = slot_info["material"]
@@ -1001,7 +1048,7 @@ class Panel(ScreenPanel):
         self.slot_color_boxes = []
         self.slot_buttons = []
         
-        for slot in range(4):
+        for slot in range(len(self.tool_table)):
             # 创建可点击的料盘按钮（高25%）
             slot_btn = Gtk.Button()
             slot_btn.get_style_context().add_class("ace_slot_button")  # 更具体的类
@@ -1039,7 +1086,7 @@ class Panel(ScreenPanel):
             slot_content.pack_start(top_row, True, True, 0)
             
             # 料盘编号标签
-            slot_num_label = Gtk.Label(label=f"料盘 {slot}")
+            slot_num_label = Gtk.Label(label=self.tool_title(slot))
             slot_num_label.get_style_context().add_class("ace_slot_number")  # 更具体的类
             slot_content.pack_start(slot_num_label, False, False, 0)
             
@@ -1054,7 +1101,7 @@ class Panel(ScreenPanel):
         settings_box.set_homogeneous(True)
         settings_box.set_margin_top(5)  # 更靠近料盘框
         
-        for slot in range(4):
+        for slot in range(len(self.tool_table)):
             # 创建容器以居中较小的按钮
             settings_container = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
             settings_container.set_halign(Gtk.Align.CENTER)
@@ -1089,6 +1136,7 @@ class Panel(ScreenPanel):
         
         self.content.add(main_box)
         self.content.show_all()
+        self.main_screen_active = True
         
         # 更新状态
         self.update_status()
@@ -1279,6 +1327,10 @@ class Panel(ScreenPanel):
     def process_update(self, action, data):
         """处理来自 Klipper 的更新"""
         if action == "notify_status_update":
+            # 检查驱动工具表（单元数或料盘数）变化
+            if isinstance(data.get("ace"), dict) and "slots" in data["ace"]:
+                self.set_tool_table(self.get_tool_table())
+            
             # 检查 saved_variables 更新
             if "saved_variables" in data:
                 save_vars = data["saved_variables"]
@@ -1305,6 +1357,8 @@ class Panel(ScreenPanel):
                     slot_data = json.loads(json_str)
                     if isinstance(slot_data, list) and len(slot_data) > 0:
                         logging.info(f"ACE: 从 ACE_QUERY_SLOTS 解析料盘数据: {slot_data}")
+                        if len(slot_data) != len(self.tool_table):
+                            self.set_tool_table(self.get_tool_table(len(slot_data)))
                         self.update_slots_from_data(slot_data)
                 except json.JSONDecodeError as e:
                     logging.error(f"ACE: JSON 解码错误: {e}")
@@ -1344,7 +1398,7 @@ class Panel(ScreenPanel):
                         match = re.search(r'(\d+)', response_str)
                         if match:
                             new_slot = int(match.group(1))
-                            if 0 <= new_slot <= 3:
+                            if 0 <= new_slot < len(self.slot_buttons):
                                 logging.info(f"ACE: 检测到工具更改，更新到料盘 {new_slot}")
                                 self.current_loaded_slot = new_slot
                                 self.update_slot_loaded_states()
@@ -1356,7 +1410,7 @@ class Panel(ScreenPanel):
         logging.info(f"ACE: 从 ACE_QUERY_SLOTS 数据更新料盘: {slot_data}")
         
         for i, slot in enumerate(slot_data):
-            if i < 4:  # 确保不超过我们的4个料盘
+            if i < len(self.slot_buttons):  # 确保不超过工具表中的料盘数
                 if slot.get('status') == 'ready':
                     material = slot.get('material', 'PLA')
                     temp = slot.get('temp', 200)
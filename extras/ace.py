@@ -1,36 +1,688 @@
-import serial, threading, time, logging, json, struct, queue, traceback, re
+import serial, threading, time, logging, json, struct, traceback, re, collections, os
+import ctypes, ctypes.util
 from serial import SerialException
-import serial.tools.list_ports
 
-class BunnyAce:
-    def __init__(self, config):
+# 分帧、CRC、请求簿记、延迟统计和状态模型在 ace_protocol 中，与 tools/ 下的
+# 工具和 AceClient 共用；这里只保留 Klipper 的 reactor 传输和 G-code 命令
+from .ace_protocol import (
+    SERIAL_BY_ID, METHOD_PRIORITY, GCODE_INDEX_CHUNK, PRIORITY_CONTROL, RETRY_LIMITS,
+    TRACE_TX, TRACE_RX, TRACE_FAULT, CAPTURE_TX, CAPTURE_RX,
+    AceTraceBuffer, AceCaptureWriter, AceLink, GcodeToolchangeIndex,
+    default_status, status_deltas, firmware_capabilities, find_by_id, find_com_port,
+    is_ace_port)
+
+
+# inotify 常量（linux/inotify.h）
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class AcePortWatcher:
+    """用 inotify 监视 /dev 和 /dev/serial/by-id 中设备节点的出现与移除
+
+    read_events() 在 fd 可读时调用，返回变化的文件名。inotify 不可用时
+    fd 为 None，调用方退回到定时重试。
+    """
+
+    WATCH_DIRS = ('/dev', '/dev/serial', SERIAL_BY_ID)
+    WATCH_MASK = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_TO
+
+    def __init__(self):
+        self.fd = None
+        self._libc = None
+        self._watches = {}
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        self._libc = libc
+        self.fd = fd
+        self._update_watches()
+
+    def _update_watches(self):
+        # /dev/serial/by-id 在第一个 USB 串口出现之前并不存在，每次事件后补上监视
+        for path in self.WATCH_DIRS:
+            if path in self._watches or not os.path.isdir(path):
+                continue
+            wd = self._libc.inotify_add_watch(self.fd, path.encode(), self.WATCH_MASK)
+            if wd >= 0:
+                self._watches[path] = wd
+
+    def read_events(self):
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not data:
+                break
+            pos = 0
+            while pos + INOTIFY_EVENT.size <= len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                if mask & IN_IGNORED:
+                    # 目录被删除后监视自动失效，下次出现时重新添加
+                    self._watches = {path: w for path, w in self._watches.items() if w != wd}
+                else:
+                    names.append(data[pos:pos + length].rstrip(b'\0').decode(errors='replace'))
+                pos += length
+        if names:
+            self._update_watches()
+        return names
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self._watches = {}
+
+
+class AceUnit(AceLink):
+    """一台 ACE 的串口链路：独立的读写、请求调度、状态轮询、跟踪与捕获
+
+    [ace] 段本身是第一台，每个 [ace unitN] 段再创建一台。料盘编号在单元内
+    从 0 开始，全局工具号 T0..Tn 由 BunnyAce 的工具表映射到 (单元, 料盘)。
+    请求簿记、冻结恢复和重连退避与 AceClient 共用 AceLink，这里只有 reactor 上的传输。
+    """
+
+    def __init__(self, config, ace, name):
+        self.ace = ace
+        self.name = name
+        self.printer = ace.printer
+        self.reactor = ace.reactor
+        self.gcode = ace.gcode
+        self.log_prefix = 'ACE' if name == 'ace' else 'ACE ' + name
+        self.file_prefix = 'ace' if name == 'ace' else 'ace_' + name
+        # 上次连接时记录的固件能力：启动时即可按它设置，不必等待 ACE 响应
+        saved = self.ace.variables.get('ace_capabilities', None)
+        # 断线重连：首次立即重试，之后按指数退避直到 reconnect_max_delay；
+        # 断开超过 reconnect_timeout 时排队的请求以失败结束
+        reconnect_delay = config.getfloat('reconnect_delay', 0.1, above=0.)
+        super().__init__(
+            request_timeout=config.getfloat('request_timeout', 2., above=0.),
+            # 配置了 tx_window_bytes 时始终使用它，否则按固件能力选择
+            window_bytes=config.getint('tx_window_bytes', None, minval=64),
+            window_time=config.getfloat('tx_window_time', 0.1, above=0.),
+            capabilities=saved.get(name) if isinstance(saved, dict) else None,
+            # 看门狗：ACE 在 3 秒内没有收到完整帧就会断开。正常轮询已经足够频繁，只有链路
+            # keepalive_interval 秒没有写出任何帧时才补发状态查询，因此它应接近但小于 3 秒
+            keepalive_interval=config.getfloat('keepalive_interval', 2.5, above=0., maxval=2.8),
+            freeze_timeout=config.getfloat('freeze_timeout', 1., above=0.),
+            reconnect_delay=reconnect_delay,
+            reconnect_max_delay=config.getfloat('reconnect_max_delay', 5., minval=reconnect_delay),
+            reconnect_timeout=config.getfloat('reconnect_timeout', 10., above=0.))
         self._connected = False
         self._serial = None
+        self.port = None
+        self._port_cache = None
+        self.connect_timer = None
+        self.writer_timer = None
+        self.watchdog_timer = None
+        self.read_handle = None
+        self._poll_mode = 'idle'
+        # 跟踪级别：0 关闭，1 仅记录到内存环形缓冲区，2 同时逐帧写入 klippy.log
+        self.trace_level = config.getint('trace_level', 1, minval=0, maxval=2)
+        self._trace = AceTraceBuffer(config.getint('trace_size', 256, minval=16))
+        self.trace_dump_interval = config.getfloat('trace_dump_interval', 60., minval=0.)
+        self._last_trace_dump = -self.trace_dump_interval
+        log_file = self.printer.get_start_args().get('log_file')
+        self.trace_dir = config.get('trace_dir', os.path.dirname(log_file) if log_file else '/tmp')
+        # 串口会话捕获，可用 tools/ace_replay.py 离线重放
+        self.capture_file = config.get('capture_file', None)
+        self.capture_max_bytes = config.getint('capture_max_bytes', 16 * 1024 * 1024, minval=4096)
+        self.capture_backups = config.getint('capture_backups', 3, minval=0)
+        self._capture = None
+        if self.capture_file:
+            try:
+                self._start_capture(os.path.expanduser(self.capture_file))
+            except OSError as e:
+                raise config.error(f'无法打开捕获文件 {self.capture_file}: {str(e)}')
+
+        # 未配置时按 USB 描述自动查找 ACE
+        self.serial_name = config.get('serial', None)
+        self._serial_warned = None
+        self.baud = config.getint('baud', 115200)
+        self.slot_count = config.getint('slots', self._capability('slots') or 4, minval=1)
+
+        # get_status 轮询间隔：送料/换料期间、打印期间、空闲（含仅干燥）
+        self.status_poll_intervals = {
+            'fast': config.getfloat('status_poll_fast', 0.2, above=0.),
+            'printing': config.getfloat('status_poll_printing', 0.5, above=0.),
+            'idle': config.getfloat('status_poll_idle', 2.0, above=0.),
+        }
+
+        self._status_version = 0
+        self._status_key = None
+        self._status_cache = None
+        self._feed_assist_index = -1
+        self.last_resync_time = 0.
+        # get_filament_info 返回的 RFID 信息，按料盘索引
+        self._filament_info = [None] * self.slot_count
+
+        # 默认数据以防止异常
+        self._info = default_status(self.slot_count, self._has_feed_assist_count())
+
+    def _now(self):
+        return self.reactor.monotonic()
+
+    def _new_completion(self):
+        return self.reactor.completion()
+
+    def _report(self, msg):
+        self.gcode.respond_info(msg)
+
+    def _trace_tx(self, eventtime, task, data):
+        if self.trace_level:
+            self._trace.record(eventtime, TRACE_TX, task.id, task.method, data)
+            if self.trace_level >= 2:
+                logging.info(f'{self.log_prefix}: >> ' + str(bytes(data)))
+
+    def _trace_rx(self, eventtime, id, task, payload):
+        if self.trace_level:
+            self._trace.record(eventtime, TRACE_RX, id, task.method if task is not None else None, payload)
+            if self.trace_level >= 2:
+                logging.info(f'{self.log_prefix}: << ' + str(payload))
+
+    def _frame_error(self, reason, data):
+        names = {'crc': 'CRC', 'length': '长度', 'json': 'JSON'}
+        self.gcode.respond_info(f'来自 {self.log_prefix} 的无效数据（{names[reason]}）')
+        self._trace_fault(reason, data)
+
+    def _callback_error(self, e):
+        logging.exception(f'{self.log_prefix}: 响应回调错误')
+        self.gcode.respond_info('ACE 错误: ' + str(e))
+
+    def _request_timed_out(self, task, retry):
+        if retry:
+            logging.info(f'{self.log_prefix}: 请求 {task.method} (id {task.id}) 超时，重发')
+        else:
+            self.gcode.respond_info(f'{self.log_prefix}: 请求 {task.method} (id {task.id}) 超时')
+
+    def _status_changed(self, old, new):
+        self._status_version += 1
+        self._publish_status_deltas(old, new)
+
+    def _link_changed(self):
+        self._status_version += 1
+
+    def _write(self, data):
+        n = self._serial.write(data)
+        if self._capture is not None:
+            self._capture.record(self.reactor.monotonic(), CAPTURE_TX, data if n is None else data[:n])
+        return n
+
+    def _reader(self, eventtime):
+        # 串口 fd 可读时由 reactor 直接调用，数据到达即解析
+        try:
+            raw_bytes = self._serial.read(size=4096)
+            if self._capture is not None:
+                self._capture.record(eventtime, CAPTURE_RX, raw_bytes)
+        except SerialException:
+            self.gcode.respond_info(f"无法与 {self.log_prefix} 通信" + traceback.format_exc())
+            self.lock = False
+            self._reconnect()
+            return
+
+        if raw_bytes:
+            self._handle_frames(self._decoder.feed(raw_bytes), raw_bytes)
+
+    def _trace_fault(self, reason, data=b''):
+        """记录故障，并在限速范围内自动导出跟踪缓冲区"""
+        if self._capture is not None:
+            self._capture.flush()
+        if not self.trace_level:
+            return
+        eventtime = self.reactor.monotonic()
+        self._trace.record(eventtime, TRACE_FAULT, None, reason, data)
+        if eventtime - self._last_trace_dump >= self.trace_dump_interval:
+            self._last_trace_dump = eventtime
+            self._dump_trace(reason)
+
+    def _dump_trace(self, reason):
+        path = os.path.join(self.trace_dir, time.strftime(self.file_prefix + '_trace_%Y%m%d_%H%M%S.log'))
+        try:
+            self._trace.dump(path, reason)
+        except OSError as e:
+            logging.info(f'{self.log_prefix}: 写入跟踪文件失败: {str(e)}')
+            return None
+        logging.info(f'{self.log_prefix}: 协议跟踪已写入 {path} ({reason})')
+        return path
+
+    def _start_capture(self, path):
+        self._stop_capture()
+        self._capture = AceCaptureWriter(path, self.capture_max_bytes, self.capture_backups)
+        logging.info(f'{self.log_prefix}: 开始捕获串口会话到 {path}')
+
+    def _stop_capture(self):
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+
+    def _kick_writer(self):
+        if self.writer_timer is not None:
+            self.reactor.update_timer(self.writer_timer, self.reactor.NOW)
+
+    def _writer(self, eventtime):
+        try:
+            return self._run_writer(eventtime)
+        except serial.serialutil.SerialException:
+            logging.info('ACE 错误: ' + traceback.format_exc())
+            self._reconnect()
+            return self.reactor.NEVER
+
+    def _watchdog(self, eventtime):
+        """链路将要静默到接近 ACE 的 3 秒时限时补发状态查询，并检测 ACE 冻结"""
+        try:
+            waketime = self._check_link(eventtime)
+        except serial.serialutil.SerialException:
+            logging.info('ACE 错误: ' + traceback.format_exc())
+            self._reconnect()
+            return self.reactor.NEVER
+        if self.watchdog_timer is None:
+            return self.reactor.NEVER
+        return waketime
+
+    def _poll_interval(self, eventtime):
+        if (self.ace._park_in_progress or self.ace.endless_spool_in_progress
+                or self._info.get('status') != 'ready'
+                or self._scheduler.depths()['motion']):
+            mode = 'fast'
+        elif self.ace._is_printing(eventtime):
+            mode = 'printing'
+        else:
+            mode = 'idle'
+        self._poll_mode = mode
+        return self.status_poll_intervals[mode]
+
+    def start(self):
+        logging.info(f'{self.log_prefix}: 连接到 ' + str(self.serial_name or '自动检测的端口'))
+        # 我们可以捕获主机没有数据可用时 ACE 重新启动的时间。我们通过这个技巧避免它
+        self._connected = False
+        self._disconnect_time = self.reactor.monotonic()
+        self._connect_attempts = 0
+        self.connect_timer = self.reactor.register_timer(self._connect, self.reactor.NOW)
+
+    def shutdown(self):
+        logging.info(f'{self.log_prefix}: 关闭与 ' + str(self.port or self.serial_name or '自动检测的端口') + ' 的连接')
+        if self._serial is not None:
+            self._serial.close()
+        self._stop_capture()
+        self._connected = False
+        if self.connect_timer is not None:
+            self.reactor.unregister_timer(self.connect_timer)
+            self.connect_timer = None
+        if self.writer_timer is not None:
+            self.reactor.unregister_timer(self.writer_timer)
+            self.writer_timer = None
+        if self.watchdog_timer is not None:
+            self.reactor.unregister_timer(self.watchdog_timer)
+            self.watchdog_timer = None
+        if self.read_handle is not None:
+            self.reactor.unregister_fd(self.read_handle)
+            self.read_handle = None
+
+        self._fail_all_requests()
+
+    def send_request(self, request, callback=None, priority=None, pipelined=False):
+        self._set_info_field('status', 'busy')
+        return self._queue_request(request, callback, priority, pipelined)
+
+    def wait_request(self, task, timeout=None):
+        """挂起 G-code 线程直到请求完成，超时或失败返回 None"""
+        if task.done():
+            return task.response
+        waketime = self.reactor.NEVER
+        if timeout is not None:
+            waketime = self.reactor.monotonic() + timeout
+        return task.completion.wait(waketime)
+
+    def _check_response(self, task, timeout=None):
+        response = self.wait_request(task, timeout)
+        if response is None:
+            raise self.gcode.error(f'{self.log_prefix} 响应超时: ' + str(task.method))
+        if response.get('code', 0) != 0:
+            raise self.gcode.error(f'{self.log_prefix} 错误: ' + str(response.get('msg')))
+        return response
+
+    def _wait_status(self, predicate, waketime=None):
+        """每收到一次状态就检查 predicate，直到成立或超过 waketime"""
+        if waketime is None:
+            waketime = self.reactor.NEVER
+        while not predicate():
+            completion = self.reactor.completion()
+            self._status_waiters.append(completion)
+            if completion.wait(waketime) is None:
+                return predicate()
+        return True
+
+    def _wait_motion_done(self, task, expected_time):
+        """等待送料/退料被确认，并且状态流显示 ACE 重新空闲"""
+        self._check_response(task)
+        finished = self._motion_finished(expected_time)
+        if not self._wait_status(finished, self.reactor.monotonic() + self._motion_timeout(expected_time)):
+            self.gcode.respond_info(f'{self.log_prefix}: 等待 {task.method} 完成超时')
+
+    def _set_info_field(self, field, value):
+        # _info 不在原地修改，保证差异比较和 get_status 缓存有效
+        if self._info.get(field) != value:
+            info = dict(self._info)
+            info[field] = value
+            self._info = info
+            self._status_version += 1
+
+    def _publish_status_deltas(self, old, new):
+        """只为真正变化的字段发出 ace:slot_status、ace:dryer、ace:feed_assist_count 事件，第一个参数是单元名"""
+        for event, args in status_deltas(old, new, self._has_feed_assist_count()):
+            self.printer.send_event('ace:' + event, self.name, *args)
+
+    def wait_ace_ready(self):
+        self._wait_status(lambda: self._info['status'] == 'ready')
+
+    def _serial_disconnect(self):
+
+        if self._serial is not None and self._serial.isOpen():
+            self._serial.close()
+
+        if self.read_handle is not None:
+            self.reactor.unregister_fd(self.read_handle)
+            self.read_handle = None
+        if self.writer_timer is not None:
+            self.reactor.unregister_timer(self.writer_timer)
+            self.writer_timer = None
+        if self.watchdog_timer is not None:
+            self.reactor.unregister_timer(self.watchdog_timer)
+            self.watchdog_timer = None
+        if self._connected:
+            self._connected = False
+            self._link_closed(self.reactor.monotonic())
+
+    def _reconnect(self):
+        self.gcode.respond_info(f'{self.log_prefix}: 尝试重新连接')
+        self._trace_fault('disconnect')
+        self._serial_disconnect()
+        self._connect_attempts = 0
+        if self.connect_timer is None:
+            self.connect_timer = self.reactor.register_timer(self._connect, self.reactor.NOW)
+        else:
+            self.reactor.update_timer(self.connect_timer, self.reactor.NOW)
+
+    def _connect_retry(self, eventtime):
+        """连接失败后按指数退避安排下一次尝试；断开太久时放弃排队的请求"""
+        return eventtime + self._connect_retry_delay(eventtime)
+
+    def _connect(self, eventtime):
+
+        try:
+            port = self._find_port()
+            if port is None:
+                return self._connect_retry(eventtime)
+            self.gcode.respond_info(f'{self.log_prefix}: 尝试连接')
+            self._serial = serial.Serial(
+                port=port,
+                baudrate=self.baud,
+                timeout=0,
+                write_timeout=0)
+
+            if self._serial.isOpen():
+                self._connected = True
+                self.port = port
+                self._port_cache = port
+                self._link_opened(eventtime)
+                logging.info(f'{self.log_prefix}: 已连接到 ' + port)
+                self.gcode.respond_info(f'{self.log_prefix}: 已连接到 {port} {eventtime}')
+                if self.connect_count > 1:
+                    logging.info(f'{self.log_prefix}: 断开 {self.last_reconnect_time:.3f}s 后重新连接')
+                self.writer_timer = self.reactor.register_timer(self._writer, self.reactor.NOW)
+                self.read_handle = self.reactor.register_fd(self._serial.fileno(), self._reader)
+                self.watchdog_timer = self.reactor.register_timer(
+                    self._watchdog, eventtime + self.freeze_timeout / 2.)
+                self._resync(self._disconnect_time)
+                self.reactor.unregister_timer(self.connect_timer)
+                self.connect_timer = None
+                return self.reactor.NEVER
+        except serial.serialutil.SerialException:
+            self._serial = None
+        return self._connect_retry(eventtime)
+
+    def _resync(self, disconnect_time):
+        """连接建立后用一次流水线突发恢复状态：固件信息、状态、各料盘 RFID 信息和进料辅助"""
+        remaining = [0]
+
+        def resynced(self, response):
+            remaining[0] -= 1
+            if not remaining[0]:
+                self.last_resync_time = self.reactor.monotonic() - disconnect_time
+                self._status_version += 1
+
+        requests = [({"method": "get_info"}, AceUnit._set_capabilities),
+                    ({"method": "get_status"}, None)]
+        for slot in range(self.slot_count):
+            requests.append(({"method": "get_filament_info", "params": {"index": slot}},
+                             lambda self, response, slot=slot: self._set_filament_info(slot, response)))
+        # --- 添加：当前工具在本单元上时重新启用进料辅助 ---
+        ace_current_index = self.ace.variables.get('ace_current_index', -1)
+        if 0 <= ace_current_index < len(self.ace.tools):
+            unit, slot = self.ace.tools[ace_current_index]
+            if unit is self:
+                self.gcode.respond_info(f'{self.log_prefix}: 重新连接时重新启用索引 {ace_current_index} 的进料辅助')
+                requests.append(({"method": "start_feed_assist", "params": {"index": slot}},
+                                 self._feed_assist_callback(slot)))
+        # ---------------------------------------------------------------
+        remaining[0] = len(requests)
+        for request, callback in requests:
+            task = self.send_request(request, callback, pipelined=True)
+            task.callbacks.append(resynced)
+
+    def _set_capabilities(self, response):
+        if response.get('code', 0) != 0 or not isinstance(response.get('result'), dict):
+            return
+        caps = firmware_capabilities(response['result'])
+        if self.capabilities is not None:
+            # 进料辅助计数只能从状态中得知，固件未变时保留
+            if self.capabilities.get('firmware') == caps['firmware']:
+                caps['feed_assist_count'] = self.capabilities.get('feed_assist_count', -1)
+        self.gcode.respond_info(f"{self.log_prefix}: {caps['model']} 固件 {caps['firmware']}，"
+                                f"引导程序 {caps['boot_firmware']}，{caps['slots']} 个料盘")
+        if caps['slots'] and caps['slots'] != self.slot_count:
+            self.gcode.respond_info(f"{self.log_prefix}: ACE 报告 {caps['slots']} 个料盘，当前使用 {self.slot_count} 个；"
+                                    f"未配置 slots 时重启后按 ACE 报告的数量")
+        self._apply_capabilities(caps)
+
+    def _apply_capabilities(self, caps):
+        if super()._apply_capabilities(caps):
+            self._status_version += 1
+            self.ace._save_capabilities()
+
+    def _set_filament_info(self, slot, response):
+        if response.get('code', 0) != 0 or not isinstance(response.get('result'), dict):
+            return
+        if self._filament_info[slot] != response['result']:
+            info = list(self._filament_info)
+            info[slot] = response['result']
+            self._filament_info = info
+            self._status_version += 1
+
+    def handle_port_change(self):
+        """/dev 中有设备节点出现或移除"""
+        if self._connected:
+            if self.port is not None and not os.path.exists(self.port):
+                # 设备已移除：不必等读写出错，立即进入重连
+                self._reconnect()
+        elif self.connect_timer is not None:
+            self.reactor.update_timer(self.connect_timer, self.reactor.NOW)
+
+    def _find_port(self):
+        if self.serial_name:
+            # 配置的路径（例如 /dev/serial/by-id/... 或模拟器的 PTY 链接）
+            if not os.path.exists(self.serial_name):
+                return None
+            if is_ace_port(self.serial_name):
+                return self.serial_name
+            # 旧配置里的 serial: /dev/ttyACM0 可能指向打印机主板：能自动找到 ACE 时改用它，
+            # 找不到时（模拟器、故障注入代理）仍使用配置的路径
+            port = self._discover_port()
+            if port is not None and os.path.realpath(port) != os.path.realpath(self.serial_name):
+                if self._serial_warned != port:
+                    self._serial_warned = port
+                    logging.warning(f'{self.log_prefix}: 配置的 serial {self.serial_name} 不是 ACE，'
+                                    f'改用自动检测到的 {port}')
+                return port
+            return self.serial_name
+        return self._discover_port()
+
+    def _discover_port(self):
+        # 自动检测：先用上次连接成功的端口，再查 /dev/serial/by-id，都没有时才枚举所有串口。
+        # 跳过已被其他单元占用的端口
+        claimed = set(os.path.realpath(unit.port) for unit in self.ace.units
+                      if unit is not self and unit._connected and unit.port)
+        cached = self._port_cache
+        if cached is not None and os.path.exists(cached) and os.path.realpath(cached) not in claimed:
+            return cached
+        port = find_by_id('ACE', claimed)
+        if port is None:
+            port = find_com_port('ACE', claimed)
+        if port is not None:
+            self._port_cache = port
+        return port
+
+    def _feed_assist_callback(self, index):
+        def callback(self, response):
+            if response.get('code', 0) == 0:
+                self._feed_assist_index = index
+                self.gcode.respond_info(str(response))
+        return callback
+
+    def _enable_feed_assist(self, index, wait=True):
+        task = self.send_request(request={"method": "start_feed_assist", "params": {"index": index}},
+                                 callback=self._feed_assist_callback(index))
+        if wait:
+            self._check_response(task)
+
+    def _disable_feed_assist(self, index):
+        def callback(self, response):
+            if response.get('code', 0) == 0:
+                self._feed_assist_index = -1
+                self.gcode.respond_info(f'已禁用 {self.log_prefix} 进料辅助')
+
+        task = self.send_request(request={"method": "stop_feed_assist", "params": {"index": index}}, callback=callback)
+        self._check_response(task)
+
+    def _feed(self, index, length, speed):
+        task = self.send_request(
+            request={"method": "feed_filament", "params": {"index": index, "length": length, "speed": speed}})
+        self._wait_motion_done(task, length / speed)
+
+    def _retract(self, index, length, speed):
+        task = self.send_request(
+            request={"method": "unwind_filament", "params": {"index": index, "length": length, "speed": speed}})
+        self._wait_motion_done(task, length / speed)
+
+    def report_inflight(self, gcmd):
+        now = self.reactor.monotonic()
+        gcmd.respond_info(f"{self.log_prefix}: 进行中 {len(self._callback_map)}，排队 {self._scheduler.depths()}")
+        for id, task in sorted(self._callback_map.items()):
+            gcmd.respond_info(f"  - id {id} {task.method} 已等待 {now - task.send_time:.3f}s "
+                              f"第 {task.attempts} 次发送，截止 {task.deadline - now:.3f}s")
+        gcmd.respond_info(f"  - 超时 {self.request_timeouts}，重发 {self.request_retries}，"
+                          f"失败 {self.request_failures}")
+        gcmd.respond_info(f"  - 发送 {self._pacer.get_status()}，窗口 {self._pacer.window_bytes} 字节")
+        if self.capabilities is not None:
+            gcmd.respond_info(f"  - 固件 {self.capabilities['firmware']}，"
+                              f"进料辅助计数 {['无', '有', '未知'][self.capabilities['feed_assist_count']]}")
+        gcmd.respond_info(f"  - 状态版本 {self._status_version}，已接收 {self._status_seq}")
+        link = self._link_status()
+        gcmd.respond_info(f"  - 连接 {link['port'] if link['connected'] else '已断开'}，重连 {link['reconnects']} 次，"
+                          f"上次重连 {link['last_reconnect_time']:.3f}s，状态恢复 {link['last_resync_time']:.3f}s")
+        gcmd.respond_info(f"  - keepalive {link['keepalives']}，冻结 {link['freezes']}，已恢复 {link['freeze_recoveries']}，"
+                          f"上次恢复 {link['last_recovery_time']:.3f}s")
+
+    def _link_status(self):
+        return {
+            'connected': self._connected,
+            'port': self.port,
+            'reconnects': self.reconnect_count,
+            'last_reconnect_time': self.last_reconnect_time,
+            'last_resync_time': self.last_resync_time,
+            'keepalives': self.keepalives,
+            'freezes': self.freezes,
+            'freeze_recoveries': self.freeze_recoveries,
+            'last_recovery_time': self.last_recovery_time,
+            'recovering': self._recovery_start is not None,
+        }
+
+    def get_status(self, eventtime=None):
+        # 只有状态真正变化时才生成新的字典；未变化时返回同一对象，
+        # Moonraker 订阅的比较因此几乎没有开销
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        latency = self.latency.snapshot(eventtime)
+        key = (self._status_version, self._poll_mode, self.latency.version)
+        if key != self._status_key:
+            status = self._info.copy()
+            status['poll'] = {
+                'mode': self._poll_mode,
+                'interval': self.status_poll_intervals[self._poll_mode]
+            }
+            status['filament_info'] = self._filament_info
+            status['link'] = self._link_status()
+            status['latency'] = latency
+            status['capabilities'] = self.capabilities
+            self._status_key = key
+            self._status_cache = status
+        return self._status_cache
+
+
+# ACE_BATCH 一次最多接受的请求数；发送速度另由流水线深度和接收窗口限速约束
+MAX_BATCH_CALLS = 64
+# 换料预测保留索引的文件数；扫描未完成时每隔 LOOKAHEAD_SCAN_DELAY 秒扫描一块，避免长时间阻塞反应器
+LOOKAHEAD_INDEX_FILES = 4
+LOOKAHEAD_SCAN_DELAY = 0.05
+
+
+class BunnyAce:
+    def __init__(self, config):
         self.printer = config.get_printer()
         self.reactor = self.printer.get_reactor()
         self.gcode = self.printer.lookup_object('gcode')
         self._name = config.get_name()
-        self.lock = False
-        self.send_time = None
-        self.read_buffer = bytearray()
-        if self._name.startswith('ace '):
-            self._name = self._name[4:]
         self.variables = self.printer.lookup_object('save_variables').allVariables
 
-        self.serial_name = config.get('serial', '/dev/ttyACM0')
-        self.baud = config.getint('baud', 115200)
         extruder_sensor_pin = config.get('extruder_sensor_pin', None)
         toolhead_sensor_pin = config.get('toolhead_sensor_pin', None)
         self.feed_speed = config.getint('feed_speed', 50)
         self.retract_speed = config.getint('retract_speed', 50)
         self.toolchange_retract_length = config.getint('toolchange_retract_length', 150)
         self.toolchange_load_length = config.getint('toolchange_load_length', 630)
+        # 预送料停靠点：打印期间提前从 ACE 送出的长度，停在分流器之前，换料时只需再送剩余部分
+        self.prestage_park_length = config.getint(
+            'prestage_park_length', max(0, self.toolchange_load_length - 50),
+            minval=0, maxval=self.toolchange_load_length)
+        # 换料预测：读取 virtual_sdcard 当前文件后面的换料命令，剩余挤出量低于
+        # lookahead_extrusion 时刷新下一个料盘的 RFID、预送料并调用 _ACE_NEXT_TOOL 宏
+        self.lookahead = config.getboolean('lookahead', False)
+        self.lookahead_interval = config.getfloat('lookahead_interval', 1., above=0.)
+        self.lookahead_extrusion = config.getfloat('lookahead_extrusion', 300., minval=0.)
         self.toolhead_sensor_to_nozzle_length = config.getint('toolhead_sensor_to_nozzle', 0)
         # self.extruder_to_blade_length = config.getint('extruder_to_blade', None)
         self.bowden_tube_length = config.getint('bowden_tube_length', 1000)
 
         self.max_dryer_temperature = config.getint('max_dryer_temperature', 55)
 
+        # 设备热插拔监视：/dev 有变化时立即尝试连接，而不是每秒重新枚举串口
+        self.port_watch = config.getboolean('port_watch', True)
+        self._port_watcher = None
+        self._port_watch_handle = None
+
         # 自动续料配置 - 如果可用则从持久变量加载
         saved_endless_spool_enabled = self.variables.get('ace_endless_spool_enabled', False)
         
@@ -38,10 +690,7 @@ class BunnyAce:
         self.endless_spool_in_progress = False
         self.endless_spool_runout_detected = False
 
-        self._callback_map = {}
         self.park_hit_count = 5
-        self._feed_assist_index = -1
-        self._request_id = 0
         self._last_assist_count = 0
         self._assist_hit_count = 0
         self._park_in_progress = False
@@ -50,60 +699,33 @@ class BunnyAce:
         self._park_index = -1
         self.endstops = {}
 
-        # 默认数据以防止异常
-        self._info = {
-            'status': 'ready',
-            'dryer': {
-                'status': 'stop',
-                'target_temp': 0,
-                'duration': 0,
-                'remain_time': 0
-            },
-            'temp': 0,
-            'enable_rfid': 1,
-            'fan_speed': 7000,
-            'feed_assist_count': 0,
-            'cont_assist_time': 0.0,
-            'slots': [
-                {
-                    'index': 0,
-                    'status': 'empty',
-                    'sku': '',
-                    'type': '',
-                    'color': [0, 0, 0]
-                },
-                {
-                    'index': 1,
-                    'status': 'empty',
-                    'sku': '',
-                    'type': '',
-                    'color': [0, 0, 0]
-                },
-                {
-                    'index': 2,
-                    'status': 'empty',
-                    'sku': '',
-                    'type': '',
-                    'color': [0, 0, 0]
-                },
-                {
-                    'index': 3,
-                    'status': 'empty',
-                    'sku': '',
-                    'type': '',
-                    'color': [0, 0, 0]
-                }
-            ]
-        }
-
-        # 为4个料盘添加库存 - 如果可用则从持久变量加载
-        saved_inventory = self.variables.get('ace_inventory', None)
-        if saved_inventory:
-            self.inventory = saved_inventory
-        else:
-            self.inventory = [
-                {"status": "empty", "color": [0, 0, 0], "material": "", "temp": 0} for _ in range(4)
-            ]
+        # 全局工具表：工具号 -> (单元, 单元内料盘号)，按配置顺序依次排列各单元的料盘
+        self.units = []
+        self.tools = []
+        # 由 ace:slot_status 事件维护的料盘可用状态，按工具号索引
+        self._slot_ready = []
+        self.printer.register_event_handler('ace:slot_status', self._handle_slot_status)
+        self._status_key = None
+        self._status_cache = None
+        # 最近一次 ACE_BATCH 的结果，宏可以通过 printer.ace.batch 读取
+        self.last_batch = []
+        self._batch_version = 0
+        self._capabilities_save_pending = False
+        # 各工具已预送到停靠点的长度（mm），按工具号索引；保存在持久变量中，重启后换料仍会扣除
+        self._staged = list(self.variables.get('ace_staged', None) or [])
+        self._prestage_tool = -1
+        self._prestage_completion = None
+        self._prestage_version = 0
+        # 按文件路径缓存的换料索引，跳转和续打时不必重新扫描
+        self._gcode_indexes = collections.OrderedDict()
+        self._lookahead_timer = None
+        self._lookahead_prediction = None
+        self._lookahead_version = 0
+        self._lookahead_acted = None
+
+        # 库存按工具号索引 - 如果可用则从持久变量加载，不足的部分在添加单元时补齐
+        self.inventory = list(self.variables.get('ace_inventory', None) or [])
+        self.add_unit(config)
         # 注册库存命令
         self.gcode.register_command(
             'ACE_SET_SLOT', self.cmd_ACE_SET_SLOT,
@@ -116,6 +738,7 @@ class BunnyAce:
 
         self._create_mmu_sensor(config, extruder_sensor_pin, "extruder_sensor")
         self._create_mmu_sensor(config, toolhead_sensor_pin, "toolhead_sensor")
+        self.printer.register_event_handler('klippy:connect', self._handle_connect)
         self.printer.register_event_handler('klippy:ready', self._handle_ready)
         self.printer.register_event_handler('klippy:disconnect', self._handle_disconnect)
         self.gcode.register_command(
@@ -163,175 +786,157 @@ class BunnyAce:
         self.gcode.register_command(
             'ACE_GET_CURRENT_INDEX', self.cmd_ACE_GET_CURRENT_INDEX,
             desc=self.cmd_ACE_GET_CURRENT_INDEX_help)
-
-
-    def _calc_crc(self, buffer):
-        _crc = 0xffff
-        for byte in buffer:
-            data = byte
-            data ^= _crc & 0xff
-            data ^= (data & 0x0f) << 4
-            _crc = ((data << 8) | (_crc >> 8)) ^ (data >> 4) ^ (data << 3)
-        return _crc
-
-    def _send_request(self, request):
-        if not 'id' in request:
-            request['id'] = self._request_id
-            self._request_id += 1
-
-        payload = json.dumps(request)
-        payload = bytes(payload, 'utf-8')
-
-        data = bytes([0xFF, 0xAA])
-        data += struct.pack('@H', len(payload))
-        data += payload
-        data += struct.pack('@H', self._calc_crc(payload))
-        data += bytes([0xFE])
-        self._serial.write(data)
-
-
-    def _reader(self, eventtime):
-
-        if self.lock and (self.reactor.monotonic() - self.send_time) > 2:
-            self.lock = False
-            self.read_buffer = bytearray()
-            self.gcode.respond_info(f"超时 {self.reactor.monotonic()}")
-
-        buffer = bytearray()
-        try:
-            raw_bytes = self._serial.read(size=4096)
-        except SerialException:
-            self.gcode.respond_info("无法与 ACE PRO 通信" + traceback.format_exc())
-            self.lock = False
-            self.gcode.respond_info('尝试重新连接')
-            self._serial_disconnect()
-            self.connect_timer = self.reactor.register_timer(self._connect, self.reactor.NOW)
-            return self.reactor.NEVER
-
-        if len(raw_bytes):
-            text_buffer = self.read_buffer + raw_bytes
-            i = text_buffer.find(b'\xfe')
-            if i >= 0:
-                buffer = text_buffer
-                self.read_buffer = bytearray()
-            else:
-                self.read_buffer += raw_bytes
-                return eventtime + 0.1
-
-        else:
-            return eventtime + 0.1
-
-        if len(buffer) < 7:
-            return eventtime + 0.1
-
-        if buffer[0:2] != bytes([0xFF, 0xAA]):
-            self.lock = False
-            self.gcode.respond_info("来自 ACE PRO 的无效数据（头部字节）")
-            self.gcode.respond_info(str(buffer))
-            return eventtime + 0.1
-
-        payload_len = struct.unpack('<H', buffer[2:4])[0]
-        logging.info(str(buffer))
-        payload = buffer[4:4 + payload_len]
-
-        crc_data = buffer[4 + payload_len:4 + payload_len + 2]
-        crc = struct.pack('@H', self._calc_crc(payload))
-
-        if len(buffer) < (4 + payload_len + 2 + 1):
-            self.lock = False
-            self.gcode.respond_info(f"来自 ACE PRO 的无效数据（长度） {payload_len} {len(buffer)} {crc}")
-            self.gcode.respond_info(str(buffer))
-            return eventtime + 0.1
-
-        if crc_data != crc:
-            self.lock = False
-            self.gcode.respond_info('来自 ACE PRO 的无效数据（CRC）')
-
-        ret = json.loads(payload.decode('utf-8'))
-        id = ret['id']
-        if id in self._callback_map:
-            callback = self._callback_map.pop(id)
-            callback(self=self, response=ret)
-            self.lock = False
-        return eventtime + 0.1
-
-    def _writer(self, eventtime):
-
-        try:
-            def callback(self, response):
-                if response is not None:
-                    self._info = response['result']
-            if not self.lock:
-                if not self._queue.empty():
-                    task = self._queue.get()
-                    if task is not None:
-                        id = self._request_id
-                        self._request_id += 1
-                        self._callback_map[id] = task[1]
-                        task[0]['id'] = id
-
-                        self._send_request(task[0])
-                        self.send_time = eventtime
-                        self.lock = True
-                else:
-                    id = self._request_id
-                    self._request_id += 1
-                    self._callback_map[id] = callback
-                    self._send_request({"id": id, "method": "get_status"})
-                    self.send_time = eventtime
-                    self.lock = True
-        except serial.serialutil.SerialException as e:
-            logging.info('ACE 错误: ' + traceback.format_exc())
-            self.lock = False
-            self.gcode.respond_info('尝试重新连接')
-            self._serial_disconnect()
-            self.connect_timer = self.reactor.register_timer(self._connect, self.reactor.NOW)
-            return self.reactor.NEVER
-        except Exception as e:
-            self.gcode.respond_info(str(e))
-            logging.info('ACE: 写入错误 ' + str(e))
-        return eventtime + 0.5
+        self.gcode.register_command(
+            'ACE_INFLIGHT', self.cmd_ACE_INFLIGHT,
+            desc=self.cmd_ACE_INFLIGHT_help)
+        self.gcode.register_command(
+            'ACE_DUMP_TRACE', self.cmd_ACE_DUMP_TRACE,
+            desc=self.cmd_ACE_DUMP_TRACE_help)
+        self.gcode.register_command(
+            'ACE_CAPTURE', self.cmd_ACE_CAPTURE,
+            desc=self.cmd_ACE_CAPTURE_help)
+        self.gcode.register_command(
+            'ACE_STATS', self.cmd_ACE_STATS,
+            desc=self.cmd_ACE_STATS_help)
+        self.gcode.register_command(
+            'ACE_BATCH', self.cmd_ACE_BATCH,
+            desc=self.cmd_ACE_BATCH_help)
+        self.gcode.register_command(
+            'ACE_PRESTAGE', self.cmd_ACE_PRESTAGE,
+            desc=self.cmd_ACE_PRESTAGE_help)
+        self.gcode.register_command(
+            'ACE_UNSTAGE', self.cmd_ACE_UNSTAGE,
+            desc=self.cmd_ACE_UNSTAGE_help)
+        self.gcode.register_command(
+            'ACE_LOOKAHEAD', self.cmd_ACE_LOOKAHEAD,
+            desc=self.cmd_ACE_LOOKAHEAD_help)
+
+    def _is_printing(self, eventtime):
+        print_stats = self.printer.lookup_object('print_stats', None)
+        if print_stats is None:
+            return False
+        return print_stats.get_status(eventtime).get('state') == 'printing'
+
+    def add_unit(self, config):
+        """为 [ace] 或 [ace unitN] 段创建一台 ACE，并把它的料盘追加到全局工具表"""
+        name = config.get_name().split()[-1]
+        if name in [unit.name for unit in self.units]:
+            raise config.error(f'ACE 单元名重复: {name}')
+        unit = AceUnit(config, self, name)
+        self.units.append(unit)
+        self.tools.extend((unit, slot) for slot in range(unit.slot_count))
+        self._slot_ready.extend(False for _ in range(unit.slot_count))
+        while len(self.inventory) < len(self.tools):
+            self.inventory.append({"status": "empty", "color": [0, 0, 0], "material": "", "temp": 0})
+        while len(self._staged) < len(self.tools):
+            self._staged.append(0)
+        self._status_key = None
+        return unit
+
+    def _get_unit(self, gcmd):
+        name = gcmd.get('UNIT', self.units[0].name)
+        for unit in self.units:
+            if unit.name == name:
+                return unit
+        raise gcmd.error(f'未知的 ACE 单元: {name}')
+
+    def _get_units(self, gcmd):
+        """指定 UNIT= 时只返回该单元，否则返回全部单元"""
+        if gcmd.get('UNIT', None) is None:
+            return list(self.units)
+        return [self._get_unit(gcmd)]
+
+    def _tool_name(self, tool):
+        unit, slot = self.tools[tool]
+        return f'{tool} ({unit.name}:{slot})' if len(self.units) > 1 else str(tool)
+
+    def _handle_connect(self):
+        # 没有同名 gcode_macro 的工具号由驱动直接注册 T<n>
+        for tool in range(len(self.tools)):
+            name = 'T%d' % (tool,)
+            if self.printer.lookup_object('gcode_macro ' + name, None) is not None:
+                continue
+            self.gcode.register_command(
+                name, lambda gcmd, tool=tool: self._change_tool(gcmd, tool),
+                desc=f'切换到工具 {self._tool_name(tool)}')
+
+    def _start_port_watch(self):
+        watcher = AcePortWatcher()
+        if watcher.fd is None:
+            logging.info('ACE: inotify 不可用，只按退避间隔重试查找端口')
+            return
+        self._port_watcher = watcher
+        self._port_watch_handle = self.reactor.register_fd(watcher.fd, self._handle_port_event)
+
+    def _stop_port_watch(self):
+        if self._port_watch_handle is not None:
+            self.reactor.unregister_fd(self._port_watch_handle)
+            self._port_watch_handle = None
+        if self._port_watcher is not None:
+            self._port_watcher.close()
+            self._port_watcher = None
+
+    def _handle_port_event(self, eventtime):
+        if self._port_watcher.read_events():
+            for unit in self.units:
+                unit.handle_port_change()
 
     def _handle_ready(self):
         self.toolhead = self.printer.lookup_object('toolhead')
-        logging.info('ACE: 连接到 ' + self.serial_name)
-        # 我们可以捕获主机没有数据可用时 ACE 重新启动的时间。我们通过这个技巧避免它
-        self._connected = False
-        self._queue = queue.Queue()
-        self._main_queue = queue.Queue()
-        self.connect_timer = self.reactor.register_timer(self._connect, self.reactor.NOW)
+        if self.port_watch:
+            self._start_port_watch()
+        for unit in self.units:
+            unit.start()
         # 启动自动续料监控定时器
         if hasattr(self, 'endless_spool_enabled'):
             self.endless_spool_timer = self.reactor.register_timer(self._endless_spool_monitor, self.reactor.NOW)
             # 挂接到 gcode 移动事件以进行更广泛的挤出机监控
             self.printer.register_event_handler('toolhead:move', self._on_toolhead_move)
-
+        if self.lookahead:
+            self._lookahead_timer = self.reactor.register_timer(self._lookahead_update, self.reactor.NOW)
 
     def _handle_disconnect(self):
-        logging.info('ACE: 关闭与 ' + self.serial_name + ' 的连接')
-        self._serial.close()
-        self._connected = False
-        self.reactor.unregister_timer(self.writer_timer)
-        self.reactor.unregister_timer(self.reader_timer)
+        self._stop_port_watch()
+        for unit in self.units:
+            unit.shutdown()
         # 停止自动续料监控
         if hasattr(self, 'endless_spool_timer'):
             self.reactor.unregister_timer(self.endless_spool_timer)
-
-        self._queue = None
-        self._main_queue = None
+        if self._lookahead_timer is not None:
+            self.reactor.unregister_timer(self._lookahead_timer)
+            self._lookahead_timer = None
 
     def dwell(self, delay = 1.):
         currTs = self.reactor.monotonic()
         self.reactor.pause(currTs + delay)
 
-    def send_request(self, request, callback):
-        self._info['status'] = 'busy'
-        self._queue.put([request, callback])
+    def _save_capabilities(self):
+        """按单元名保存固件能力，下次启动时直接使用；连接时的多次变化合并为一次写入"""
+        if not self._capabilities_save_pending:
+            self._capabilities_save_pending = True
+            self.reactor.register_callback(self._flush_capabilities, self.reactor.monotonic() + 1.)
 
-    def wait_ace_ready(self):
-        while self._info['status'] != 'ready':
-            currTs = self.reactor.monotonic()
-            self.reactor.pause(currTs + .5)
+    def _flush_capabilities(self, eventtime):
+        self._capabilities_save_pending = False
+        saved = {unit.name: unit.capabilities for unit in self.units if unit.capabilities is not None}
+        if saved == self.variables.get('ace_capabilities'):
+            return
+        # 在 reactor 回调中执行，不能使用 run_script_from_command；
+        # 保存失败（例如 G-code 错误）不影响连接，下次能力变化时再保存
+        try:
+            self.gcode.run_script(f"SAVE_VARIABLE VARIABLE=ace_capabilities VALUE='{json.dumps(saved)}'")
+        except Exception as e:
+            logging.exception('ACE: 保存固件能力失败')
+            self.gcode.respond_info('ACE: 保存固件能力失败: ' + str(e))
+            return
+        self.variables['ace_capabilities'] = saved
+
+    def _handle_slot_status(self, unit_name, index, previous, status):
+        for tool, (unit, slot) in enumerate(self.tools):
+            if unit.name == unit_name and slot == index:
+                self._slot_ready[tool] = status == 'ready'
+                logging.info(f'ACE: 工具 {self._tool_name(tool)} 状态 {previous} -> {status}')
+                return
 
     def _extruder_move(self, length, speed):
         pos = self.toolhead.get_position()
@@ -421,52 +1026,10 @@ class BunnyAce:
         print_time = self.toolhead.get_last_move_time()
         return bool(self.endstops[name].query_endstop(print_time))
 
-    def _serial_disconnect(self):
-
-        if self._serial is not None and self._serial.isOpen():
-            self._serial.close()
-            self._connected = False
-
-        self.reactor.unregister_timer(self.reader_timer)
-        self.reactor.unregister_timer(self.writer_timer)
-
-    def _connect(self, eventtime):
-
-        try:
-            port = self.find_com_port('ACE')
-            if port is None:
-                return eventtime + 1
-            self.gcode.respond_info('尝试连接')
-            self._serial = serial.Serial(
-                port=port,
-                baudrate=self.baud,
-                timeout=0,
-                write_timeout=0)
-
-            if self._serial.isOpen():
-                self._connected = True
-                logging.info('ACE: 已连接到 ' + port)
-                self.gcode.respond_info(f'ACE: 已连接到 {port} {eventtime}')
-                self.writer_timer = self.reactor.register_timer(self._writer, self.reactor.NOW)
-                self.reader_timer = self.reactor.register_timer(self._reader, self.reactor.NOW)
-                self.send_request(request={"method": "get_info"},
-                                  callback=lambda self, response: self.gcode.respond_info(str(response)))
-                # --- 添加：检查 ace_current_index 并在需要时启用进料辅助 ---
-                ace_current_index = self.variables.get('ace_current_index', -1)
-                if ace_current_index != -1:
-                    self.gcode.respond_info(f'ACE: 重新连接时重新启用索引 {ace_current_index} 的进料辅助')
-                    self._enable_feed_assist(ace_current_index)
-                # ---------------------------------------------------------------
-                self.reactor.unregister_timer(self.connect_timer)
-                return self.reactor.NEVER
-        except serial.serialutil.SerialException:
-            self._serial = None
-        return eventtime + 1
-
-
-    cmd_ACE_START_DRYING_help = '启动 ACE Pro 干燥器'
+    cmd_ACE_START_DRYING_help = '启动 ACE Pro 干燥器，未指定 UNIT= 时启动所有单元'
 
     def cmd_ACE_START_DRYING(self, gcmd):
+        units = self._get_units(gcmd)
         temperature = gcmd.get_int('TEMP')
         duration = gcmd.get_int('DURATION', 240)
 
@@ -479,77 +1042,57 @@ class BunnyAce:
             if 'code' in response and response['code'] != 0:
                 raise gcmd.error("ACE 错误: " + response['msg'])
 
-            self.gcode.respond_info('已启动 ACE 干燥')
+            self.gcode.respond_info(f'已启动 {self.log_prefix} 干燥')
 
-        self.send_request(
-            request={"method": "drying", "params": {"temp": temperature, "fan_speed": 7000, "duration": duration}},
-            callback=callback)
+        for unit in units:
+            unit.send_request(
+                request={"method": "drying", "params": {"temp": temperature, "fan_speed": 7000, "duration": duration}},
+                callback=callback)
 
-    cmd_ACE_STOP_DRYING_help = '停止 ACE Pro 干燥器'
+    cmd_ACE_STOP_DRYING_help = '停止 ACE Pro 干燥器，未指定 UNIT= 时停止所有单元'
 
     def cmd_ACE_STOP_DRYING(self, gcmd):
         def callback(self, response):
             if 'code' in response and response['code'] != 0:
                 raise gcmd.error("ACE 错误: " + response['msg'])
 
-            self.gcode.respond_info('已停止 ACE 干燥')
+            self.gcode.respond_info(f'已停止 {self.log_prefix} 干燥')
 
-        self.send_request(request={"method": "drying_stop"}, callback=callback)
-
-    def _enable_feed_assist(self, index):
-        def callback(self, response):
-            if 'code' in response and response['code'] != 0:
-                raise ValueError("ACE 错误: " + response['msg'])
-            else:
-                self._feed_assist_index = index
-                self.gcode.respond_info(str(response))
-
-        self.send_request(request={"method": "start_feed_assist", "params": {"index": index}}, callback=callback)
-        self.dwell(delay=0.7)
+        for unit in self._get_units(gcmd):
+            unit.send_request(request={"method": "drying_stop"}, callback=callback)
 
     cmd_ACE_ENABLE_FEED_ASSIST_help = '启用 ACE 进料辅助'
 
     def cmd_ACE_ENABLE_FEED_ASSIST(self, gcmd):
         index = gcmd.get_int('INDEX')
 
-        if index < 0 or index >= 4:
+        if index < 0 or index >= len(self.tools):
             raise gcmd.error('错误的索引')
 
-        self._enable_feed_assist(index)
-
-    def _disable_feed_assist(self, index):
-        def callback(self, response):
-            if 'code' in response and response['code'] != 0:
-                raise ValueError("ACE 错误: " + response['msg'])
-
-            self._feed_assist_index = -1
-            self.gcode.respond_info('已禁用 ACE 进料辅助')
+        unit, slot = self.tools[index]
+        unit._enable_feed_assist(slot)
 
-        self.send_request(request={"method": "stop_feed_assist", "params": {"index": index}}, callback=callback)
-        self.dwell(0.3)
+    def _feed_assist_tool(self):
+        """返回当前开启进料辅助的工具号，没有则返回 -1"""
+        for tool, (unit, slot) in enumerate(self.tools):
+            if unit._feed_assist_index == slot:
+                return tool
+        return -1
 
     cmd_ACE_DISABLE_FEED_ASSIST_help = '禁用 ACE 进料辅助'
 
     def cmd_ACE_DISABLE_FEED_ASSIST(self, gcmd):
-        if self._feed_assist_index != -1:
-            index = gcmd.get_int('INDEX', self._feed_assist_index)
+        assist_tool = self._feed_assist_tool()
+        if assist_tool != -1:
+            index = gcmd.get_int('INDEX', assist_tool)
         else:
             index = gcmd.get_int('INDEX')
 
-        if index < 0 or index >= 4:
+        if index < 0 or index >= len(self.tools):
             raise gcmd.error('错误的索引')
 
-        self._disable_feed_assist(index)
-
-    def _feed(self, index, length, speed):
-        def callback(self, response):
-            if 'code' in response and response['code'] != 0:
-                raise ValueError("ACE 错误: " + response['msg'])
-
-        self.send_request(
-            request={"method": "feed_filament", "params": {"index": index, "length": length, "speed": speed}},
-            callback=callback)
-        self.dwell(delay=(length / speed) + 0.1)
+        unit, slot = self.tools[index]
+        unit._disable_feed_assist(slot)
 
     cmd_ACE_FEED_help = '从 ACE 进料'
 
@@ -558,24 +1101,15 @@ class BunnyAce:
         length = gcmd.get_int('LENGTH')
         speed = gcmd.get_int('SPEED', self.feed_speed)
 
-        if index < 0 or index >= 4:
+        if index < 0 or index >= len(self.tools):
             raise gcmd.error('错误的索引')
         if length <= 0:
             raise gcmd.error('错误的长度')
         if speed <= 0:
             raise gcmd.error('错误的速度')
 
-        self._feed(index, length, speed)
-
-    def _retract(self, index, length, speed):
-        def callback(self, response):
-            if 'code' in response and response['code'] != 0:
-                raise ValueError("ACE 错误: " + response['msg'])
-
-        self.send_request(
-            request={"method": "unwind_filament", "params": {"index": index, "length": length, "speed": speed}},
-            callback=callback)
-        self.dwell(delay=(length / speed) + 0.1)
+        unit, slot = self.tools[index]
+        unit._feed(slot, length, speed)
 
     cmd_ACE_RETRACT_help = '将线材回退到 ACE'
 
@@ -584,27 +1118,32 @@ class BunnyAce:
         length = gcmd.get_int('LENGTH')
         speed = gcmd.get_int('SPEED', self.retract_speed)
 
-        if index < 0 or index >= 4:
+        if index < 0 or index >= len(self.tools):
             raise gcmd.error('错误的索引')
         if length <= 0:
             raise gcmd.error('错误的长度')
         if speed <= 0:
             raise gcmd.error('错误的速度')
 
-        self._retract(index, length, speed)
+        unit, slot = self.tools[index]
+        unit._retract(slot, length, speed)
 
     def _park_to_toolhead(self, tool):
 
         sensor_extruder = self.printer.lookup_object("filament_switch_sensor %s" % "extruder_sensor", None)
+        unit, slot = self.tools[tool]
 
-        self.wait_ace_ready()
+        unit.wait_ace_ready()
 
-        self._feed(tool, self.toolchange_load_length, self.retract_speed)
+        length = self._load_length(tool)
+        if length > 0:
+            unit._feed(slot, length, self.retract_speed)
+        self._staged[tool] = 0
         self.variables['ace_filament_pos'] = "bowden"
 
-        self.wait_ace_ready()
+        unit.wait_ace_ready()
 
-        self._enable_feed_assist(tool)
+        unit._enable_feed_assist(slot)
 
         while not bool(sensor_extruder.runout_helper.filament_present):
             self.dwell(delay=0.1)
@@ -623,24 +1162,224 @@ class BunnyAce:
         self._extruder_move(self.toolhead_sensor_to_nozzle_length, 5)
         self.variables['ace_filament_pos'] = "nozzle"
 
+    def _load_length(self, tool):
+        """换料时还需从 ACE 送出的长度，已预送到停靠点的部分不再重复送出"""
+        return max(0, self.toolchange_load_length - self._staged[tool])
+
+    def _save_staged(self, run_script):
+        self._prestage_version += 1
+        run_script(f"SAVE_VARIABLE VARIABLE=ace_staged VALUE='{json.dumps(self._staged)}'")
+
+    def _prestage_blocked(self, tool):
+        """返回不能预送 tool 的原因，可以预送时返回 None"""
+        if self.prestage_park_length <= 0:
+            return 'prestage_park_length 为 0'
+        if tool == self.variables.get('ace_current_index', -1):
+            return '它是当前工具'
+        if self._prestage_tool != -1:
+            return f'工具 {self._tool_name(self._prestage_tool)} 正在预送料'
+        if self._staged[tool] >= self.prestage_park_length:
+            return '已在停靠点'
+        if self._park_in_progress or self.endless_spool_in_progress:
+            return '正在换料'
+        if not self._slot_ready[tool]:
+            return '料盘没有耗材'
+        return None
+
+    def _start_prestage(self, tool):
+        self._prestage_tool = tool
+        self._prestage_completion = self.reactor.completion()
+        self._prestage_version += 1
+        self.reactor.register_callback(lambda eventtime: self._prestage(tool))
+
+    def _prestage(self, tool):
+        """在反应器回调中把 tool 的耗材送到停靠点，G-code 和打印不等待它"""
+        unit, slot = self.tools[tool]
+        staged = self._staged[tool]
+        length = self.prestage_park_length - staged
+        try:
+            unit.wait_ace_ready()
+            task = unit.send_request(request={
+                "method": "feed_filament", "params": {"index": slot, "length": length, "speed": self.feed_speed}})
+            response = unit.wait_request(task)
+            if response is not None and response.get('code', 0) != 0:
+                self.gcode.respond_info(f'ACE: 工具 {self._tool_name(tool)} 预送料失败: {response.get("msg")}')
+                return
+            if response is None:
+                # 无法确定实际送出的长度时按已到停靠点记录：换料时少送的部分由进料辅助补上，不会送过头
+                self.gcode.respond_info(f'ACE: 工具 {self._tool_name(tool)} 预送料响应超时，按已到停靠点处理')
+            else:
+                unit._wait_motion_done(task, length / self.feed_speed)
+            self._staged[tool] = self.prestage_park_length
+            self._save_staged(self.gcode.run_script)
+            logging.info(f'ACE: 工具 {self._tool_name(tool)} 已预送到停靠点')
+        except Exception as e:
+            # 反应器回调中的异常没有调用方处理：报告后保持原来的已送长度，换料时按完整长度送料
+            logging.exception(f'ACE: 工具 {self._tool_name(tool)} 预送料错误')
+            self.gcode.respond_info(f'ACE: 工具 {self._tool_name(tool)} 预送料失败: {str(e)}')
+            self._staged[tool] = staged
+        finally:
+            self._prestage_tool = -1
+            self._prestage_version += 1
+            self._prestage_completion.complete(True)
+
+    def _wait_prestage(self):
+        """等待进行中的预送料结束，之后读取的已送长度才准确"""
+        if self._prestage_tool == -1:
+            return
+        self.gcode.respond_info(f'ACE: 等待工具 {self._tool_name(self._prestage_tool)} 预送料完成')
+        self._prestage_completion.wait()
+
+    cmd_ACE_PRESTAGE_help = '预送料：打印当前工具时把 TOOL= 的耗材提前送到分流器前的停靠点'
+
+    def cmd_ACE_PRESTAGE(self, gcmd):
+        tool = gcmd.get_int('TOOL', minval=0, maxval=len(self.tools) - 1)
+        reason = self._prestage_blocked(tool)
+        if reason is not None:
+            gcmd.respond_info(f'ACE: 跳过工具 {self._tool_name(tool)} 的预送料，{reason}')
+            return
+        self._start_prestage(tool)
+        gcmd.respond_info(f'ACE: 开始把工具 {self._tool_name(tool)} 预送到停靠点（{self.prestage_park_length}mm）')
+
+    cmd_ACE_UNSTAGE_help = '把预送的耗材退回 ACE：TOOL= 指定工具，省略时退回全部'
+
+    def cmd_ACE_UNSTAGE(self, gcmd):
+        tool = gcmd.get_int('TOOL', None, minval=0, maxval=len(self.tools) - 1)
+        self._wait_prestage()
+        for tool in ([tool] if tool is not None else range(len(self.tools))):
+            length = self._staged[tool]
+            if not length:
+                continue
+            unit, slot = self.tools[tool]
+            unit.wait_ace_ready()
+            unit._retract(slot, length, self.retract_speed)
+            self._staged[tool] = 0
+            self._save_staged(self.gcode.run_script_from_command)
+            gcmd.respond_info(f'ACE: 工具 {self._tool_name(tool)} 已退回 {length}mm')
+
+    def _get_gcode_index(self, path):
+        """返回 path 的换料索引；文件大小或修改时间变化时重新建立"""
+        stat = os.stat(path)
+        index = self._gcode_indexes.get(path)
+        if index is None or index.key != (path, stat.st_size, stat.st_mtime):
+            index = GcodeToolchangeIndex(path)
+        self._gcode_indexes[path] = index
+        self._gcode_indexes.move_to_end(path)
+        while len(self._gcode_indexes) > LOOKAHEAD_INDEX_FILES:
+            self._gcode_indexes.popitem(last=False)
+        return index
+
+    def _set_lookahead(self, prediction):
+        if prediction != self._lookahead_prediction:
+            self._lookahead_prediction = prediction
+            self._lookahead_version += 1
+
+    def _lookahead_update(self, eventtime):
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if sdcard is None:
+            return self.reactor.NEVER
+        sd_status = sdcard.get_status(eventtime)
+        path = sd_status.get('file_path')
+        if not path or not self._is_printing(eventtime):
+            self._set_lookahead(None)
+            return eventtime + self.lookahead_interval
+        try:
+            index = self._get_gcode_index(path)
+            waketime = eventtime + self.lookahead_interval
+            if not index.complete():
+                index.scan(GCODE_INDEX_CHUNK)
+                waketime = eventtime + LOOKAHEAD_SCAN_DELAY
+            position = sd_status.get('file_position', 0)
+            toolchange = index.next_toolchange(position)
+            prediction = {'file': path, 'indexed': index.complete(), 'toolchanges': len(index.toolchanges),
+                          'tool': None, 'extrusion': None}
+            if toolchange is not None:
+                offset, tool, extruded = toolchange
+                prediction.update(tool=tool, offset=offset,
+                                  extrusion=round(extruded - index.extruded_at(position), 1))
+        except OSError as e:
+            logging.info(f'ACE: 无法读取打印文件 {path}: {str(e)}')
+            self._set_lookahead(None)
+            return eventtime + self.lookahead_interval
+        self._set_lookahead(prediction)
+        if toolchange is not None:
+            self._lookahead_act(path, offset, tool, prediction['extrusion'])
+        return waketime
+
+    def _lookahead_act(self, path, offset, tool, extrusion):
+        """下一次换料临近时提前完成能够并行的准备，每次换料只执行一次"""
+        if (self._lookahead_acted == (path, offset) or extrusion > self.lookahead_extrusion
+                or tool < 0 or tool >= len(self.tools) or self._park_in_progress or self.endless_spool_in_progress
+                or tool == self.variables.get('ace_current_index', -1)):
+            return
+        if self._prestage_tool != -1:
+            # 上一次预送料还没结束，下个周期再试
+            return
+        self._lookahead_acted = (path, offset)
+        logging.info(f'ACE: 预测 {extrusion}mm 后换到工具 {self._tool_name(tool)}')
+        unit, slot = self.tools[tool]
+        # 在反应器定时器中执行，异常没有调用方处理：逐项报告，一项失败不影响其他准备
+        try:
+            unit.send_request({"method": "get_filament_info", "params": {"index": slot}},
+                              lambda self, response: self._set_filament_info(slot, response), pipelined=True)
+        except Exception as e:
+            logging.exception('ACE: 换料预测查询耗材信息错误')
+            self.gcode.respond_info(f'ACE: 工具 {self._tool_name(tool)} 耗材信息查询失败: {str(e)}')
+        try:
+            if self._prestage_blocked(tool) is None:
+                self._start_prestage(tool)
+        except Exception as e:
+            logging.exception('ACE: 换料预测启动预送料错误')
+            self.gcode.respond_info(f'ACE: 工具 {self._tool_name(tool)} 预送料启动失败: {str(e)}')
+        if self.printer.lookup_object('gcode_macro _ACE_NEXT_TOOL', None) is not None:
+            try:
+                self.gcode.run_script(f'_ACE_NEXT_TOOL TOOL={tool} EXTRUSION={extrusion}')
+            except Exception as e:
+                logging.exception('ACE: _ACE_NEXT_TOOL 执行错误')
+                self.gcode.respond_info(f'ACE: _ACE_NEXT_TOOL 执行失败: {str(e)}')
+
+    cmd_ACE_LOOKAHEAD_help = '显示换料预测：下一个工具和此前的剩余挤出量'
+
+    def cmd_ACE_LOOKAHEAD(self, gcmd):
+        if not self.lookahead:
+            gcmd.respond_info('ACE: 换料预测未启用，在 [ace] 中设置 lookahead: True')
+            return
+        prediction = self._lookahead_prediction
+        if prediction is None:
+            gcmd.respond_info('ACE: 没有正在打印的文件')
+        elif prediction['tool'] is None:
+            state = '文件中没有后续换料' if prediction['indexed'] else '正在建立索引'
+            gcmd.respond_info(f"ACE: {state}，已找到 {prediction['toolchanges']} 次换料")
+        else:
+            tool = prediction['tool']
+            name = self._tool_name(tool) if 0 <= tool < len(self.tools) else str(tool)
+            gcmd.respond_info(f"ACE: {prediction['extrusion']}mm 后换到工具 {name}"
+                              f"（文件偏移 {prediction['offset']}），已找到 {prediction['toolchanges']} 次换料"
+                              + ('' if prediction['indexed'] else '，索引未完成'))
+
     cmd_ACE_CHANGE_TOOL_help = '更换工具'
 
     def cmd_ACE_CHANGE_TOOL(self, gcmd):
-        tool = gcmd.get_int('TOOL')
+        self._change_tool(gcmd, gcmd.get_int('TOOL'))
+
+    def _change_tool(self, gcmd, tool):
         sensor_extruder = self.printer.lookup_object("filament_switch_sensor %s" % "extruder_sensor", None)
 
-        if tool < -1 or tool >= 4:
+        if tool < -1 or tool >= len(self.tools):
             raise gcmd.error('错误的工具')
 
         was = self.variables.get('ace_current_index', -1)
+        if was >= len(self.tools):
+            raise gcmd.error(f'当前工具 {was} 不在工具表中，请检查 [ace unitN] 配置')
         if was == tool:
             gcmd.respond_info('ACE: 未更换工具，当前索引已是 ' + str(tool))
-            self._enable_feed_assist(tool)
+            if tool != -1:
+                unit, slot = self.tools[tool]
+                unit._enable_feed_assist(slot)
             return
 
         if tool != -1:
-            status = self._info['slots'][tool]['status']
-            if status != 'ready':
+            if not self._slot_ready[tool]:
                 self.gcode.run_script_from_command('_ACE_ON_EMPTY_ERROR INDEX=' + str(tool))
                 return
         
@@ -650,12 +1389,14 @@ class BunnyAce:
             self.endless_spool_enabled = False
             self.endless_spool_runout_detected = False
         self._park_in_progress = True
+        self._wait_prestage()
         self.gcode.run_script_from_command('_ACE_PRE_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool))
 
         logging.info('ACE: 工具更换 ' + str(was) + ' => ' + str(tool))
         if was != -1:
-            self._disable_feed_assist(was)
-            self.wait_ace_ready()
+            was_unit, was_slot = self.tools[was]
+            was_unit._disable_feed_assist(was_slot)
+            was_unit.wait_ace_ready()
             if self.variables.get('ace_filament_pos', "spliter") == "nozzle":
                 self.gcode.run_script_from_command('CUT_TIP')
                 self.variables['ace_filament_pos'] = "toolhead"
@@ -663,14 +1404,14 @@ class BunnyAce:
             if self.variables.get('ace_filament_pos', "spliter") == "toolhead":
                 while bool(sensor_extruder.runout_helper.filament_present):
                     self._extruder_move(-50, 10)
-                    self._retract(was, 100, self.retract_speed)
-                    self.wait_ace_ready()
+                    was_unit._retract(was_slot, 100, self.retract_speed)
+                    was_unit.wait_ace_ready()
                 self.variables['ace_filament_pos'] = "bowden"
 
-            self.wait_ace_ready()
+            was_unit.wait_ace_ready()
 
-            self._retract(was, self.toolchange_retract_length, self.retract_speed)
-            self.wait_ace_ready()
+            was_unit._retract(was_slot, self.toolchange_retract_length, self.retract_speed)
+            was_unit.wait_ace_ready()
             self.variables['ace_filament_pos'] = "spliter"
 
             if tool != -1:
@@ -688,22 +1429,25 @@ class BunnyAce:
         self.gcode.run_script_from_command('SAVE_VARIABLE VARIABLE=ace_current_index VALUE=' + str(tool))
         self.gcode.run_script_from_command(
             f"""SAVE_VARIABLE VARIABLE=ace_filament_pos VALUE='"{self.variables['ace_filament_pos']}"'""")
+        if tool != -1:
+            self._save_staged(self.gcode.run_script_from_command)
         self._park_in_progress = False
         
         # 如果之前启用了自动续料，则重新启用
         if endless_spool_was_enabled:
             self.endless_spool_enabled = True
             
-        gcmd.respond_info(f"工具 {tool} 已加载")
+        gcmd.respond_info(f"工具 {self._tool_name(tool) if tool != -1 else tool} 已加载")
 
     def _find_next_available_slot(self, current_slot):
-        """为自动续料查找下一个有线的可用料盘"""
-        for i in range(4):
-            next_slot = (current_slot + 1 + i) % 4
+        """为自动续料查找下一个有线的可用料盘，可以跨单元"""
+        count = len(self.tools)
+        for i in range(count):
+            next_slot = (current_slot + 1 + i) % count
             if next_slot != current_slot:
                 # 检查库存和 ACE 状态
-                if (self.inventory[next_slot]["status"] == "ready" and 
-                    self._info['slots'][next_slot]['status'] == 'ready'):
+                if (self.inventory[next_slot]["status"] == "ready" and
+                    self._slot_ready[next_slot]):
                     return next_slot
         return -1  # 没有可用料盘
 
@@ -768,15 +1512,23 @@ class BunnyAce:
             
             # 步骤1：在空料盘上禁用进料辅助
             if current_tool != -1:
-                self._disable_feed_assist(current_tool)
-                self.wait_ace_ready()
+                current_unit, current_slot = self.tools[current_tool]
+                current_unit._disable_feed_assist(current_slot)
+                current_unit.wait_ace_ready()
 
             # 步骤2：从下一个料盘进料直到到达挤出机传感器
             sensor_extruder = self.printer.lookup_object("filament_switch_sensor extruder_sensor", None)
             
             # 从新料盘进料直到挤出机传感器触发
-            self._feed(next_tool, self.toolchange_load_length, self.retract_speed)
-            self.wait_ace_ready()
+            self._wait_prestage()
+            next_unit, next_slot = self.tools[next_tool]
+            length = self._load_length(next_tool)
+            if length > 0:
+                next_unit._feed(next_slot, length, self.retract_speed)
+            if self._staged[next_tool]:
+                self._staged[next_tool] = 0
+                self._save_staged(self.gcode.run_script_from_command)
+            next_unit.wait_ace_ready()
 
             # 等待线材到达挤出机传感器
             while not bool(sensor_extruder.runout_helper.filament_present):
@@ -786,7 +1538,7 @@ class BunnyAce:
                 raise ValueError("自动续料更换期间线材卡住")
 
             # 步骤3：为新料盘启用进料辅助
-            self._enable_feed_assist(next_tool)
+            next_unit._enable_feed_assist(next_slot)
 
             # 步骤4：更新当前索引并保存状态
             self.variables['ace_current_index'] = next_tool
@@ -842,14 +1594,8 @@ class BunnyAce:
             gcmd.respond_info(f"  - 检测到断料: {status['runout_detected']}")
             gcmd.respond_info(f"  - 进行中: {status['in_progress']}")
 
-    def find_com_port(self, device_name):
-        com_ports = serial.tools.list_ports.comports()
-        for port, desc, hwid in com_ports:
-            if device_name in desc:
-                return port
-        return None
-
     def cmd_ACE_DEBUG(self, gcmd):
+        unit = self._get_unit(gcmd)
         method = gcmd.get('METHOD')
         params = gcmd.get('PARAMS', '{}')
 
@@ -857,24 +1603,177 @@ class BunnyAce:
             def callback(self, response):
                 self.gcode.respond_info(str(response))
 
-            self.send_request(request = {"method": method, "params": json.loads(params)}, callback = callback)
+            unit.send_request(request = {"method": method, "params": json.loads(params)}, callback = callback)
         except Exception as e:
             self.gcode.respond_info('错误: ' + str(e))
         #self.gcode.respond_info(str(self.find_com_port('ACE')))
 
+    cmd_ACE_INFLIGHT_help = '显示已发送但尚未响应的 ACE 请求: [UNIT=]'
+
+    def cmd_ACE_INFLIGHT(self, gcmd):
+        for unit in self._get_units(gcmd):
+            unit.report_inflight(gcmd)
+
+    cmd_ACE_DUMP_TRACE_help = '将 ACE 协议跟踪缓冲区写入文件: [UNIT=]'
+
+    def cmd_ACE_DUMP_TRACE(self, gcmd):
+        for unit in self._get_units(gcmd):
+            if not unit.trace_level:
+                raise gcmd.error(f'{unit.log_prefix} 协议跟踪已关闭 (trace_level: 0)')
+            path = unit._dump_trace('ACE_DUMP_TRACE')
+            if path is None:
+                raise gcmd.error('写入跟踪文件失败')
+            gcmd.respond_info(f"{unit.log_prefix}: 已写入 {len(unit._trace)} 条记录到 {path}")
+
+    cmd_ACE_STATS_help = '显示各 RPC 方法的往返延迟统计: [UNIT=] [RESET=1]'
+
+    def cmd_ACE_STATS(self, gcmd):
+        reset = gcmd.get_int('RESET', 0)
+        for unit in self._get_units(gcmd):
+            histograms = unit.latency.histograms
+            gcmd.respond_info(f"{unit.log_prefix}: 往返延迟 (ms)")
+            if not histograms:
+                gcmd.respond_info("  - 尚无数据")
+            for method, histogram in sorted(histograms.items()):
+                status = histogram.get_status()
+                gcmd.respond_info(f"  - {method}: {status['count']} 次，平均 {status['mean']:.1f}，"
+                                  f"p50 {status['p50']:.1f}，p90 {status['p90']:.1f}，"
+                                  f"p99 {status['p99']:.1f}，最大 {status['max']:.1f}")
+            if reset:
+                unit.latency.reset()
+                gcmd.respond_info(f"{unit.log_prefix}: 延迟统计已清零")
+
+    cmd_ACE_BATCH_help = '发送一组 ACE 请求（查询以流水线方式）并一起返回结果: CALLS=<JSON 数组> [UNIT=] [STRICT=1]'
+
+    def cmd_ACE_BATCH(self, gcmd):
+        """CALLS 形如 [{"method": ..., "params": {...}, "unit": ...}, ...]，params 和 unit 可省略
+
+        每个请求使用自身方法的优先级。可重发的查询（RETRY_LIMITS）按顺序排队并以流水线
+        方式发送；其他请求（送料、退料等运动命令）先等前面的请求全部完成，再单独发送并
+        等待确认，ACE 因此不会乱序执行运动。送料/退料只等待 ACE 确认，不等待运动完成。
+        结果按顺序以 JSON 输出，并保存在状态的 batch 字段中。
+        """
+        default_unit = self._get_unit(gcmd)
+        try:
+            calls = json.loads(gcmd.get('CALLS'))
+        except ValueError as e:
+            raise gcmd.error(f'CALLS 不是有效的 JSON: {str(e)}')
+        if not isinstance(calls, list) or not calls:
+            raise gcmd.error('CALLS 必须是非空的 JSON 数组')
+        if len(calls) > MAX_BATCH_CALLS:
+            raise gcmd.error(f'ACE_BATCH 一次最多 {MAX_BATCH_CALLS} 个请求')
+
+        units = {unit.name: unit for unit in self.units}
+        results = [None] * len(calls)
+        requests = []
+        for i, call in enumerate(calls):
+            if not isinstance(call, dict) or not isinstance(call.get('method'), str):
+                results[i] = {'method': None, 'error': '缺少 method'}
+                continue
+            method = call['method']
+            params = call.get('params')
+            unit = units.get(call.get('unit', default_unit.name))
+            if params is not None and not isinstance(params, dict):
+                results[i] = {'method': method, 'error': 'params 必须是 JSON 对象'}
+            elif unit is None:
+                results[i] = {'method': method, 'error': f"未知的 ACE 单元: {call.get('unit')}"}
+            else:
+                request = {"method": method}
+                if params is not None:
+                    request['params'] = params
+                requests.append((i, unit, request))
+
+        pending = []
+        for i, unit, request in requests:
+            method = request['method']
+            priority = METHOD_PRIORITY.get(method, PRIORITY_CONTROL)
+            if method in RETRY_LIMITS:
+                pending.append((i, unit, unit.send_request(request, priority=priority, pipelined=True)))
+                continue
+            self._collect_batch_results(pending, results)
+            pending = []
+            task = unit.send_request(request, priority=priority)
+            self._collect_batch_results([(i, unit, task)], results)
+        self._collect_batch_results(pending, results)
+
+        self.last_batch = results
+        self._batch_version += 1
+        errors = sum(1 for result in results if 'error' in result)
+        gcmd.respond_info(json.dumps(results, ensure_ascii=False))
+        if errors:
+            message = f'ACE_BATCH: {len(results)} 个请求中 {errors} 个失败'
+            if gcmd.get_int('STRICT', 0):
+                raise gcmd.error(message)
+            gcmd.respond_info(message)
+
+    def _collect_batch_results(self, tasks, results):
+        """等待 ACE_BATCH 已发送的请求完成，把结果写入 results 的对应位置"""
+        for i, unit, task in tasks:
+            response = unit.wait_request(task)
+            result = {'method': task.method}
+            if len(self.units) > 1:
+                result['unit'] = unit.name
+            if response is None:
+                result['error'] = '响应超时'
+            else:
+                result['code'] = response.get('code', 0)
+                result['msg'] = response.get('msg')
+                result['result'] = response.get('result')
+                if result['code'] != 0:
+                    result['error'] = str(result['msg'])
+            results[i] = result
+
+    cmd_ACE_CAPTURE_help = '开始/停止串口会话捕获: ENABLE=1|0 [FILE=] [UNIT=]'
+
+    def cmd_ACE_CAPTURE(self, gcmd):
+        unit = self._get_unit(gcmd)
+        if not gcmd.get_int('ENABLE', 1):
+            unit._stop_capture()
+            gcmd.respond_info(f"{unit.log_prefix}: 已停止串口会话捕获")
+            return
+        path = gcmd.get('FILE', unit.capture_file
+                        or os.path.join(unit.trace_dir, unit.file_prefix + '_capture.bin'))
+        try:
+            unit._start_capture(os.path.expanduser(path))
+        except OSError as e:
+            raise gcmd.error(f'无法打开捕获文件: {str(e)}')
+        gcmd.respond_info(f"{unit.log_prefix}: 正在捕获串口会话到 {path}")
 
     def get_status(self, eventtime=None):
-        status = self._info.copy()
-        status['endless_spool'] = {
-            'enabled': self.endless_spool_enabled,
-            'runout_detected': self.endless_spool_runout_detected,
-            'in_progress': self.endless_spool_in_progress
-        }
-        return status
+        # 只有状态真正变化时才生成新的字典；未变化时返回同一对象，
+        # Moonraker 订阅的比较因此几乎没有开销
+        primary = self.units[0]
+        primary_status = primary.get_status(eventtime)
+        key = (primary._status_key, tuple(unit._status_version for unit in self.units),
+               self.endless_spool_enabled, self.endless_spool_runout_detected,
+               self.endless_spool_in_progress, self._batch_version, self._prestage_version,
+               self._lookahead_version)
+        if key != self._status_key:
+            # 顶层字段来自 [ace] 单元，slots 按全局工具号列出所有单元的料盘；
+            # 其他单元的完整状态见各自的 "ace unitN" 对象
+            status = primary_status.copy()
+            slots = []
+            for tool, (unit, slot) in enumerate(self.tools):
+                unit_slots = unit._info.get('slots', ())
+                info = unit_slots[slot] if slot < len(unit_slots) else {}
+                slots.append(dict(info, index=tool, unit=unit.name, slot=slot))
+            status['slots'] = slots
+            status['units'] = [unit.name for unit in self.units]
+            status['endless_spool'] = {
+                'enabled': self.endless_spool_enabled,
+                'runout_detected': self.endless_spool_runout_detected,
+                'in_progress': self.endless_spool_in_progress
+            }
+            status['batch'] = self.last_batch
+            status['prestage'] = {'tool': self._prestage_tool, 'staged': list(self._staged)}
+            status['lookahead'] = self._lookahead_prediction
+            self._status_key = key
+            self._status_cache = status
+        return self._status_cache
 
     def cmd_ACE_SET_SLOT(self, gcmd):
         idx = gcmd.get_int('INDEX')
-        if idx < 0 or idx >= 4:
+        if idx < 0 or idx >= len(self.tools):
             raise gcmd.error('无效的料盘索引')
         if gcmd.get_int('EMPTY', 0):
             self.inventory[idx] = {"status": "empty", "color": [0, 0, 0], "material": "", "temp": 0}
@@ -904,7 +1803,7 @@ class BunnyAce:
 
     def cmd_ACE_QUERY_SLOTS(self, gcmd):
         import json
-        gcmd.respond_info(json.dumps(self.inventory))
+        gcmd.respond_info(json.dumps(self.inventory[:len(self.tools)]))
 
     cmd_ACE_SAVE_INVENTORY_help = '手动将当前库存保存到持久存储'
 
@@ -968,8 +1867,8 @@ class BunnyAce:
         if index is None:
             raise gcmd.error('需要 INDEX 参数')
         
-        if index < 0 or index >= 4:
-            raise gcmd.error('错误的索引 - 必须是 0-3')
+        if index < 0 or index >= len(self.tools):
+            raise gcmd.error(f'错误的索引 - 必须是 0-{len(self.tools) - 1}')
         
         gcmd.respond_info(f"ACE: 为索引 {index} 更换耗材")
         
@@ -986,8 +1885,9 @@ class BunnyAce:
         
         # 检查料盘是否非空（系统中已加载线材）
         slot_status = None
-        if hasattr(self, '_info') and self._info and 'slots' in self._info:
-            slot_status = self._info['slots'][index]['status']
+        unit, slot = self.tools[index]
+        if unit._info and slot < len(unit._info.get('slots', ())):
+            slot_status = unit._info['slots'][slot]['status']
         
         inventory_status = self.inventory[index]['status']
         
@@ -997,7 +1897,11 @@ class BunnyAce:
             gcmd.respond_info(f"ACE: 以 {self.retract_speed}mm/min 回退 {self.bowden_tube_length}mm")
             
             try:
-                self._retract(index, self.bowden_tube_length, self.retract_speed)
+                self._wait_prestage()
+                unit._retract(slot, self.bowden_tube_length, self.retract_speed)
+                if self._staged[index]:
+                    self._staged[index] = 0
+                    self._save_staged(self.gcode.run_script_from_command)
                 gcmd.respond_info(f"ACE: 索引 {index} 的线材已回退")
             except Exception as e:
                 gcmd.respond_info(f"ACE: 回退期间错误: {str(e)}")
@@ -1010,3 +1914,11 @@ class BunnyAce:
 
 def load_config(config):
     return BunnyAce(config)
+
+
+def load_config_prefix(config):
+    # [ace unitN]：额外的 ACE 单元，挂到 [ace] 的全局工具表上
+    if not config.has_section('ace'):
+        raise config.error(f'[{config.get_name()}] 需要同时配置 [ace]')
+    ace = config.get_printer().load_object(config, 'ace')
+    return ace.add_unit(config)
@@ -0,0 +1,1650 @@
+# Anycubic ACE Pro 协议层，不依赖 Klipper
+#
+# 分帧与 CRC、按接收窗口限速的发送、请求优先级与流水线、延迟统计、状态
+# 模型，以及基于 asyncio 的 AceClient。extras/ace.py 在 Klipper 的 reactor
+# 上使用同一套实现；tools/ace_cli.py 用 AceClient 在没有 Klipper 的情况下
+# 查询、送料、干燥和监视 ACE。GcodeToolchangeIndex 为换料预测索引打印文件。
+import asyncio, binascii, bisect, collections, json, logging, os, re, struct
+import serial, serial.tools.list_ports
+from serial import SerialException
+
+
+# CRC-16/MCRF4XX（多项式 0x1021 反射，初值 0xFFFF，无输出异或）
+# 逐字节查表：crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ byte) & 0xFF]
+def _build_crc_table():
+    table = []
+    for byte in range(256):
+        data = byte ^ ((byte & 0x0f) << 4)
+        table.append((data << 8) ^ (data >> 4) ^ (data << 3))
+    return tuple(table)
+
+_CRC_TABLE = _build_crc_table()
+
+# 字节位反转表：反射 CRC 等价于对位反转后的数据做非反射 CRC，
+# 因此可以借用 binascii.crc_hqx（C 实现的 CRC-CCITT）完成整帧计算
+_BIT_REVERSE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def calc_crc_table(buffer):
+    """纯 Python 查表实现，作为快速路径的参考"""
+    crc = 0xffff
+    table = _CRC_TABLE
+    for byte in buffer:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+    return crc
+
+
+def calc_crc(buffer):
+    """计算帧负载的 CRC-16/MCRF4XX"""
+    rev = _BIT_REVERSE
+    crc = binascii.crc_hqx(bytes(buffer).translate(rev), 0xffff)
+    return (rev[crc & 0xff] << 8) | rev[crc >> 8]
+
+
+FRAME_HEADER = b'\xff\xaa'
+FRAME_TAIL = 0xFE
+# 超过该长度的帧会让 ACE 死机，接收时视为损坏的头部
+MAX_PAYLOAD_LENGTH = 1024
+# ACE 读到损坏的帧头时会按其中的长度一直等待数据。不含帧头的填充字节加上帧尾
+# 足以补完任何不超过 MAX_PAYLOAD_LENGTH 的帧，ACE 随后因 CRC 错误丢弃它
+FREEZE_FILLER = bytes(MAX_PAYLOAD_LENGTH + 6) + bytes([FRAME_TAIL])
+
+
+class AceFrameEncoder:
+    """把请求编码进一个预分配的帧缓冲区
+
+    encode() 返回指向内部缓冲区的 memoryview，在下一次 encode() 之前有效。
+    没有参数的固定请求（如 get_status）缓存其 JSON 前后缀，只需填入 id。
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD_LENGTH):
+        self.max_payload = max_payload
+        self._buffer = bytearray(4 + max_payload + 3)
+        self._view = memoryview(self._buffer)
+        self._buffer[0:2] = FRAME_HEADER
+        self._templates = {}
+        self._dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+    def _template(self, method):
+        template = self._templates.get(method)
+        if template is None:
+            prefix = self._dumps({"method": method, "id": 0})[:-2]
+            template = self._templates[method] = (prefix.encode('utf-8'), b'}')
+        return template
+
+    def encode_payload(self, request):
+        if len(request) == 2 and next(iter(request)) == 'method' and 'id' in request:
+            prefix, suffix = self._template(request['method'])
+            return b''.join((prefix, str(request['id']).encode('ascii'), suffix))
+        return self._dumps(request).encode('utf-8')
+
+    def encode(self, request):
+        payload = self.encode_payload(request)
+        crc = calc_crc(payload)
+        if crc == 0xAAFF:
+            # CRC 的小端字节恰好是帧头 0xFF 0xAA，头部损坏时会让 ACE 误读；
+            # 插入一个空白改变 CRC
+            payload = b'{ ' + payload[1:]
+            crc = calc_crc(payload)
+        length = len(payload)
+        if length > self.max_payload:
+            raise ValueError(f'ACE 请求过长: {length} 字节')
+        buf = self._buffer
+        struct.pack_into('<H', buf, 2, length)
+        buf[4:4 + length] = payload
+        struct.pack_into('<HB', buf, 4 + length, crc, FRAME_TAIL)
+        return self._view[:4 + length + 3]
+
+
+class AceWritePacer:
+    """按 ACE 接收窗口限速的发送层
+
+    ACE 的输入输出共用一个环形缓冲区，短时间内收到超过约 1024 字节
+    就会丢数据。这里用滑动窗口限制每 window_time 秒写出的字节数，
+    并保存短写剩下的字节，由 flush() 在之后继续写出。
+    """
+
+    def __init__(self, window_bytes=MAX_PAYLOAD_LENGTH, window_time=0.1):
+        self.window_bytes = window_bytes
+        self.window_time = window_time
+        self._pending = bytearray()
+        self._history = collections.deque()
+        self._window_used = 0
+        self.frames = 0
+        self.bytes = 0
+        self.short_writes = 0
+        self.throttled = 0
+
+    def reset(self):
+        del self._pending[:]
+        self._history.clear()
+        self._window_used = 0
+
+    def pending(self):
+        return len(self._pending)
+
+    def send(self, write, data, eventtime):
+        """发送一帧，返回需要继续 flush() 的时间，全部写出则返回 None"""
+        self.frames += 1
+        if not self._pending and len(data) <= self._budget(eventtime):
+            n = self._write(write, data, eventtime)
+            if n == len(data):
+                return None
+            self.short_writes += 1
+            self._pending += data[n:]
+            return eventtime + 0.005
+        self._pending += data
+        return self.flush(write, eventtime)
+
+    def flush(self, write, eventtime):
+        if not self._pending:
+            return None
+        budget = self._budget(eventtime)
+        if budget <= 0:
+            self.throttled += 1
+            return self._history[0][0] + self.window_time
+        pending = self._pending
+        chunk = pending if budget >= len(pending) else pending[:budget]
+        n = self._write(write, chunk, eventtime)
+        del pending[:n]
+        if not pending:
+            return None
+        if n < len(chunk):
+            self.short_writes += 1
+            return eventtime + 0.005
+        self.throttled += 1
+        return self._history[0][0] + self.window_time
+
+    def _budget(self, eventtime):
+        history = self._history
+        expire = eventtime - self.window_time
+        while history and history[0][0] <= expire:
+            self._window_used -= history.popleft()[1]
+        return self.window_bytes - self._window_used
+
+    def _write(self, write, data, eventtime):
+        n = write(data)
+        if n is None:
+            n = len(data)
+        if n:
+            self._history.append((eventtime, n))
+            self._window_used += n
+            self.bytes += n
+        return n
+
+    def get_status(self):
+        return {
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'pending': len(self._pending),
+            'short_writes': self.short_writes,
+            'throttled': self.throttled,
+        }
+
+
+class AceFrameDecoder:
+    """ACE 串口帧的增量解码器
+
+    帧格式：0xFF 0xAA | 长度(LE16) | JSON | CRC(LE16) | 0xFE。
+    每次 feed() 返回本次读取中所有完整且 CRC 正确的负载，
+    未完成的部分保留在内部缓冲区中等待下一次读取。
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD_LENGTH):
+        self.max_payload = max_payload
+        self._buffer = bytearray()
+        # 等待中的帧完整所需的缓冲区长度，不足时 feed() 直接返回
+        self._need = 0
+        self.frames = 0
+        self.crc_errors = 0
+        self.length_errors = 0
+        self.discarded_bytes = 0
+
+    def buffered(self):
+        return len(self._buffer)
+
+    def reset(self):
+        self.discarded_bytes += len(self._buffer)
+        del self._buffer[:]
+        self._need = 0
+
+    def feed(self, data):
+        buf = self._buffer
+        buf += data
+        if len(buf) < self._need:
+            return []
+        return self._decode(0)
+
+    def resync(self):
+        """放弃当前等待中的帧头，从下一个帧头重新同步（用于超时）"""
+        if not self._buffer:
+            return []
+        return self._decode(1)
+
+    def _decode(self, pos):
+        buf = self._buffer
+        size = len(buf)
+        frames = []
+        self._need = 0
+        while True:
+            start = buf.find(FRAME_HEADER, pos)
+            if start < 0:
+                # 末尾的 0xFF 可能是下一个帧头的第一个字节
+                keep = 1 if size and buf[-1] == 0xFF else 0
+                self._discard(pos, size - keep)
+                pos = size - keep
+                break
+            self._discard(pos, start)
+            pos = start
+            if size - start < 4:
+                break
+            length = buf[start + 2] | (buf[start + 3] << 8)
+            if length > self.max_payload:
+                self.length_errors += 1
+                pos = start + 1
+                continue
+            crc_end = start + 4 + length + 2
+            if size < crc_end:
+                self._need = crc_end - start
+                break
+            payload = bytes(buf[start + 4:crc_end - 2])
+            if calc_crc(payload) != (buf[crc_end - 2] | (buf[crc_end - 1] << 8)):
+                self.crc_errors += 1
+                pos = start + 1
+                continue
+            self.frames += 1
+            frames.append(payload)
+            pos = crc_end
+            if pos < size and buf[pos] == FRAME_TAIL:
+                pos += 1
+        del buf[:pos]
+        return frames
+
+    def _discard(self, start, end):
+        if end > start:
+            # 帧尾字节不算作丢弃的数据
+            skipped = end - start
+            if self._buffer[start] == FRAME_TAIL:
+                skipped -= 1
+            self.discarded_bytes += skipped
+
+
+TRACE_TX = 'tx'
+TRACE_RX = 'rx'
+TRACE_FAULT = 'fault'
+
+
+class AceTraceBuffer:
+    """固定大小的协议帧环形缓冲区
+
+    记录每一帧的时间、方向、id、方法和原始字节，只在内存中保存，
+    出现故障或执行 ACE_DUMP_TRACE 时才写入文件。
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._records = [None] * size
+        self._next = 0
+
+    def record(self, eventtime, direction, id, method, data):
+        self._records[self._next % self.size] = (eventtime, direction, id, method, bytes(data))
+        self._next += 1
+
+    def __len__(self):
+        return min(self._next, self.size)
+
+    def records(self):
+        if self._next <= self.size:
+            return self._records[:self._next]
+        start = self._next % self.size
+        return self._records[start:] + self._records[:start]
+
+    def dump(self, path, reason):
+        with open(path, 'w') as f:
+            f.write(f'# ACE 协议跟踪: {reason}，共 {len(self)} 条（总计 {self._next}）\n')
+            for eventtime, direction, id, method, data in self.records():
+                f.write(f'{eventtime:.6f} {direction:<5} id={id} method={method} len={len(data)} {data.hex()}\n')
+                if direction != TRACE_FAULT:
+                    f.write(f'    {data!r}\n')
+
+
+CAPTURE_MAGIC = b'ACECAP1\n'
+CAPTURE_TX = 0
+CAPTURE_RX = 1
+# 每条记录：单调时间(double) | 方向(uint8) | 长度(uint16)，随后是原始字节
+CAPTURE_RECORD = struct.Struct('<dBH')
+
+
+class AceCaptureWriter:
+    """把串口上收发的每个字节连同单调时间戳写入捕获文件
+
+    文件超过 max_bytes 时轮转为 .1、.2 …，最多保留 backups 个旧文件。已有的
+    捕获（例如重启前记录的现场故障）在打开时同样先轮转，不会被覆盖。
+    """
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.bytes_written = 0
+        self._file = None
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._shift_backups()
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self.bytes_written = len(CAPTURE_MAGIC)
+
+    def _shift_backups(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f'{self.path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+
+    def _rotate(self):
+        self._file.close()
+        self._shift_backups()
+        self._open()
+
+    def record(self, eventtime, direction, data):
+        if not data:
+            return
+        if self.bytes_written >= self.max_bytes:
+            self._rotate()
+        header = CAPTURE_RECORD.pack(eventtime, direction, len(data))
+        self._file.write(header)
+        self._file.write(data)
+        self.bytes_written += len(header) + len(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_capture(path):
+    """逐条读取捕获文件，产生 (时间, 方向, 字节)"""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'不是 ACE 捕获文件: {path}')
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            eventtime, direction, length = CAPTURE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield eventtime, direction, data
+
+SERIAL_BY_ID = '/dev/serial/by-id'
+
+
+def find_by_id(device_name='ACE', exclude=()):
+    """在 /dev/serial/by-id 中按名称查找，exclude 是已占用端口的真实路径"""
+    try:
+        names = sorted(os.listdir(SERIAL_BY_ID))
+    except OSError:
+        return None
+    for name in names:
+        path = os.path.join(SERIAL_BY_ID, name)
+        if device_name in name and os.path.realpath(path) not in exclude:
+            return path
+    return None
+
+
+def find_com_port(device_name='ACE', exclude=()):
+    """枚举所有串口，按 USB 描述查找"""
+    com_ports = serial.tools.list_ports.comports()
+    for port, desc, hwid in sorted(com_ports):
+        if device_name in desc and os.path.realpath(port) not in exclude:
+            return port
+    return None
+
+
+def is_ace_port(path, device_name='ACE'):
+    """判断串口是否为 ACE：/dev/serial/by-id 中有指向它的同名链接，或 USB 描述中带设备名"""
+    real = os.path.realpath(path)
+    try:
+        names = os.listdir(SERIAL_BY_ID)
+    except OSError:
+        names = ()
+    for name in names:
+        if device_name in name and os.path.realpath(os.path.join(SERIAL_BY_ID, name)) == real:
+            return True
+    for port, desc, hwid in serial.tools.list_ports.comports():
+        if os.path.realpath(port) == real:
+            return device_name in desc
+    return False
+
+
+# 请求优先级：换料期间的运动命令永远不排在后台流量之后
+PRIORITY_MOTION = 0
+PRIORITY_CONTROL = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ('motion', 'control', 'background')
+
+METHOD_PRIORITY = {
+    'feed_filament': PRIORITY_MOTION,
+    'unwind_filament': PRIORITY_MOTION,
+    'update_feeding_speed': PRIORITY_MOTION,
+    'update_unwinding_speed': PRIORITY_MOTION,
+    'stop_feed_filament': PRIORITY_MOTION,
+    'stop_unwind_filament': PRIORITY_MOTION,
+    'start_feed_assist': PRIORITY_MOTION,
+    'stop_feed_assist': PRIORITY_MOTION,
+    'drying': PRIORITY_CONTROL,
+    'drying_stop': PRIORITY_CONTROL,
+    'enable_rfid': PRIORITY_CONTROL,
+    'disable_rfid': PRIORITY_CONTROL,
+    'get_filament_info': PRIORITY_CONTROL,
+    'get_info': PRIORITY_BACKGROUND,
+    'get_status': PRIORITY_BACKGROUND,
+}
+
+# 排队中的同类请求可以合并为一次发送
+MERGEABLE_METHODS = ('get_status',)
+
+# 标记为流水线的请求可以在前一个流水线请求的响应到达前发送，最多同时在途这么多个
+MAX_PIPELINE_DEPTH = 8
+
+# 超时后允许重发的次数；只有幂等的查询可以重发，运动命令绝不重发
+RETRY_LIMITS = {
+    'get_status': 1,
+    'get_info': 2,
+    'get_filament_info': 2,
+}
+
+
+class AceRequest:
+    """排队或已发送的请求，以及等待其响应的回调
+
+    send_request() 返回该对象作为完成句柄：ACE 确认后 response
+    被设置，completion（reactor completion）被唤醒。
+    """
+
+    def __init__(self, request, callback, priority, pipelined=False):
+        self.request = request
+        self.method = request.get('method')
+        self.priority = priority
+        self.pipelined = pipelined
+        self.callbacks = [callback] if callback is not None else []
+        self.completion = None
+        self.response = None
+        self.finished = False
+        self.id = None
+        self.attempts = 0
+        self.send_time = None
+        self.deadline = None
+
+    def done(self):
+        return self.finished
+
+    def can_retry(self):
+        return self.attempts <= RETRY_LIMITS.get(self.method, 0)
+
+    def idempotent(self):
+        return self.method in RETRY_LIMITS
+
+    def complete(self, response):
+        """以响应完成请求；response 为 None 表示超时或连接断开"""
+        self.finished = True
+        self.response = response
+        if self.completion is not None:
+            self.completion.complete(response)
+
+
+class AceRequestScheduler:
+    """按优先级分类的请求队列"""
+
+    def __init__(self):
+        self._queues = tuple(collections.deque() for _ in PRIORITY_NAMES)
+        self.max_depth = [0] * len(PRIORITY_NAMES)
+        self.merged = 0
+
+    def put(self, request, callback, priority=None, pipelined=False):
+        method = request.get('method')
+        if priority is None:
+            priority = METHOD_PRIORITY.get(method, PRIORITY_CONTROL)
+        if method in MERGEABLE_METHODS and not request.get('params'):
+            queued = self.find(method)
+            if queued is not None:
+                if callback is not None:
+                    queued.callbacks.append(callback)
+                queued.pipelined = queued.pipelined or pipelined
+                self.merged += 1
+                return queued
+        task = AceRequest(request, callback, priority, pipelined)
+        queue = self._queues[priority]
+        queue.append(task)
+        if len(queue) > self.max_depth[priority]:
+            self.max_depth[priority] = len(queue)
+        return task
+
+    def find(self, method):
+        for queue in self._queues:
+            for task in queue:
+                if task.method == method:
+                    return task
+        return None
+
+    def put_task(self, task):
+        self._queues[task.priority].append(task)
+
+    def requeue(self, task):
+        """重发的请求排在同优先级队列的最前面"""
+        self._queues[task.priority].appendleft(task)
+
+    def peek(self):
+        for queue in self._queues:
+            if queue:
+                return queue[0]
+        return None
+
+    def pop(self):
+        for queue in self._queues:
+            if queue:
+                return queue.popleft()
+        return None
+
+    def clear(self):
+        tasks = []
+        for queue in self._queues:
+            tasks.extend(queue)
+            queue.clear()
+        return tasks
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def depths(self):
+        return {name: len(queue) for name, queue in zip(PRIORITY_NAMES, self._queues)}
+
+    def get_status(self):
+        return {
+            'depth': self.depths(),
+            'max_depth': dict(zip(PRIORITY_NAMES, self.max_depth)),
+            'merged': self.merged,
+        }
+
+
+# 往返延迟直方图的桶上界（毫秒），最后一个桶收集更慢的响应
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# get_status 中的延迟摘要最多每隔这么久重新生成一次，避免每个响应都让订阅端看到变化
+LATENCY_SNAPSHOT_INTERVAL = 5.
+
+
+class AceLatencyHistogram:
+    """固定分桶的延迟直方图，百分位数在桶内线性插值估算"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if self.max is None or ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        target = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if not n or seen + n < target:
+                seen += n
+                continue
+            lower = self.bounds[i - 1] if i > 0 else 0.
+            upper = self.bounds[i] if i < len(self.bounds) else self.max
+            value = lower + (upper - lower) * (target - seen) / n
+            return min(max(value, self.min), self.max)
+        return self.max
+
+    def get_status(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(.5),
+            'p90': self.percentile(.9),
+            'p99': self.percentile(.99),
+            'buckets': list(self.counts),
+        }
+
+
+class AceLatencyStats:
+    """按 RPC 方法分别统计从发送到收到响应的时间"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.version = 0
+        self._dirty = False
+        self._snapshot = {}
+        self._snapshot_time = None
+
+    def record(self, method, seconds):
+        histogram = self.histograms.get(method)
+        if histogram is None:
+            histogram = self.histograms[method] = AceLatencyHistogram()
+        histogram.record(round(seconds * 1000., 3))
+        self._dirty = True
+
+    def reset(self):
+        self.histograms = {}
+        self._dirty = True
+        self._snapshot_time = None
+
+    def snapshot(self, eventtime):
+        """限速生成的摘要；内容不变时返回同一对象"""
+        if self._dirty and (self._snapshot_time is None
+                            or eventtime >= self._snapshot_time + LATENCY_SNAPSHOT_INTERVAL):
+            self._snapshot = {
+                'buckets_ms': list(LATENCY_BUCKETS),
+                'methods': {method: histogram.get_status()
+                            for method, histogram in sorted(self.histograms.items())},
+            }
+            self._snapshot_time = eventtime
+            self._dirty = False
+            self.version += 1
+        return self._snapshot
+
+
+def can_pipeline(task, inflight):
+    """task 和所有在途请求都是流水线请求时，不必等待响应即可发送 task"""
+    if task is None or not task.pipelined or len(inflight) >= MAX_PIPELINE_DEPTH:
+        return False
+    return all(other.pipelined for other in inflight.values())
+
+
+def decode_response(payload):
+    """解析一帧响应负载；不是带 id 的 JSON 对象时抛出 ValueError"""
+    try:
+        response = json.loads(payload.decode('utf-8'))
+        response['id']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f'无效的 ACE 响应: {e}')
+    return response
+
+
+def default_status(slot_count=4, feed_assist_count=True):
+    """连接建立、收到第一次 get_status 之前使用的状态
+
+    固件的状态中不带进料辅助计数时（feed_assist_count 为 False）不含这两个字段。
+    """
+    status = {
+        'status': 'ready',
+        'dryer': {
+            'status': 'stop',
+            'target_temp': 0,
+            'duration': 0,
+            'remain_time': 0
+        },
+        'temp': 0,
+        'enable_rfid': 1,
+        'fan_speed': 7000,
+        'feed_assist_count': 0,
+        'cont_assist_time': 0.0,
+        'slots': [
+            {
+                'index': index,
+                'status': 'empty',
+                'sku': '',
+                'type': '',
+                'color': [0, 0, 0]
+            } for index in range(slot_count)
+        ]
+    }
+    if not feed_assist_count:
+        del status['feed_assist_count']
+        del status['cont_assist_time']
+    return status
+
+
+def status_deltas(old, new, feed_assist_count=True):
+    """比较前后两次 get_status 结果，返回真正变化的字段：(事件, 参数元组) 列表
+
+    固件不报告进料辅助计数时（feed_assist_count 为 False）不比较该字段。
+    """
+    deltas = []
+    old_slots = {slot.get('index'): slot.get('status') for slot in old.get('slots', ())}
+    for slot in new.get('slots', ()):
+        index = slot.get('index')
+        status = slot.get('status')
+        previous = old_slots.get(index)
+        if status != previous:
+            deltas.append(('slot_status', (index, previous, status)))
+    if new.get('dryer') != old.get('dryer'):
+        deltas.append(('dryer', (old.get('dryer'), new.get('dryer'))))
+    if feed_assist_count and new.get('feed_assist_count') != old.get('feed_assist_count'):
+        deltas.append(('feed_assist_count', (new.get('feed_assist_count'),)))
+    return deltas
+
+
+# 已知固件的协议差异，按版本从低到高排列，取不高于实际版本的最后一项；
+# 版本无法解析时使用第一项（最保守）。
+#   window_bytes: 每 0.1 秒可以安全写入的字节数
+FIRMWARE_PROFILES = (
+    ((0,), {'window_bytes': 512}),
+    # PROTOCOL.md 记录的 V1.3.82：约 1024 字节的接收窗口
+    ((1, 3), {'window_bytes': MAX_PAYLOAD_LENGTH}),
+)
+
+
+def parse_version(text):
+    """'V1.3.82' -> (1, 3, 82)；无法解析时返回 None"""
+    if not isinstance(text, str):
+        return None
+    try:
+        return tuple(int(part) for part in text.strip().lstrip('vV').split('.'))
+    except ValueError:
+        return None
+
+
+def firmware_capabilities(info, status=None):
+    """由 get_info 结果（以及可选的 get_status 结果）生成能力描述
+
+    返回的字典只含字符串、整数和列表，可以直接保存到 save_variables。
+    feed_assist_count 表示状态中是否带有进料辅助计数，在看到状态之前为 -1（未知）。
+    """
+    version = parse_version(info.get('firmware'))
+    profile = FIRMWARE_PROFILES[0][1]
+    if version is not None:
+        for minimum, candidate in FIRMWARE_PROFILES:
+            if version >= minimum:
+                profile = candidate
+    caps = {
+        'model': str(info.get('model') or ''),
+        'firmware': str(info.get('firmware') or ''),
+        'boot_firmware': str(info.get('boot_firmware') or ''),
+        'slots': info.get('slots') if isinstance(info.get('slots'), int) else 0,
+        'window_bytes': profile['window_bytes'],
+        'feed_assist_count': -1,
+    }
+    if status is not None:
+        caps['feed_assist_count'] = int('feed_assist_count' in status)
+    return caps
+
+
+# 换料预测关心的 G-code 行：带 E 的移动、挤出模式、E 坐标重置和换料命令。
+# 每种行只有一个命名组参与匹配，match.lastgroup 即行的类型
+_GCODE_EVENT = re.compile(
+    rb'^[ \t]*(?:'
+    rb'G[0-3](?![0-9.])[^\n;]*?[ \t]E(?P<e>[-+]?[0-9]*\.?[0-9]+)'
+    rb'|(?P<mode>M8[23])(?![0-9])'
+    rb'|G92(?![0-9.])[^\n;]*?[ \t]E(?P<reset>[-+]?[0-9]*\.?[0-9]+)'
+    rb'|T(?P<tool>[0-9]+)[ \t\r]*(?:;|$)'
+    rb'|ACE_CHANGE_TOOL[ \t][^\n;]*?TOOL=(?P<ace>-?[0-9]+)'
+    rb')', re.MULTILINE)
+
+# 索引每扫描这么多字节保存一个挤出状态检查点，计算任意位置的挤出量时最多重新解析一块
+GCODE_INDEX_CHUNK = 1 << 18
+
+
+def _parse_gcode(data, state, events=None, base=0):
+    """解析一段完整的 G-code 行，返回新的 (累计挤出量, 是否绝对挤出, E 坐标)
+
+    给出 events 时把换料追加为 (偏移, 工具, 换料前的累计挤出量)。
+    """
+    extruded, absolute, e_pos = state
+    for match in _GCODE_EVENT.finditer(data):
+        kind = match.lastgroup
+        if kind == 'e':
+            value = float(match.group('e'))
+            if absolute:
+                extruded += value - e_pos
+                e_pos = value
+            else:
+                extruded += value
+                e_pos += value
+        elif kind == 'mode':
+            absolute = match.group('mode') == b'M82'
+        elif kind == 'reset':
+            e_pos = float(match.group('reset'))
+        elif events is not None:
+            events.append((base + match.start(), int(match.group(kind)), extruded))
+    return extruded, absolute, e_pos
+
+
+class GcodeToolchangeIndex:
+    """G-code 文件中换料命令的位置索引
+
+    scan() 逐块扫描文件，可以分多次调用。索引记录每个 T<n> / ACE_CHANGE_TOOL
+    的字节偏移、目标工具和此前的累计挤出量（净挤出，回抽会抵消）。每块还保存
+    一个挤出状态检查点，跳转或续打到任意位置后，只需从最近的检查点重新解析
+    不到一块。key 包含文件大小和修改时间，文件被替换后应重建索引。
+    """
+
+    def __init__(self, path):
+        stat = os.stat(path)
+        self.path = path
+        self.key = (path, stat.st_size, stat.st_mtime)
+        self.size = stat.st_size
+        self.scanned = 0
+        self.offsets = []
+        self.toolchanges = []
+        self._checkpoint_offsets = [0]
+        self._checkpoints = [(0., True, 0.)]
+        self._cursor = (0, (0., True, 0.))
+
+    def complete(self):
+        return self.scanned >= self.size
+
+    def scan(self, max_bytes=GCODE_INDEX_CHUNK * 4):
+        """继续扫描最多约 max_bytes 字节，返回是否已扫描完整个文件"""
+        end = min(self.size, self.scanned + max_bytes)
+        with open(self.path, 'rb') as f:
+            while self.scanned < end:
+                f.seek(self.scanned)
+                data = f.read(GCODE_INDEX_CHUNK)
+                if not data:
+                    # 文件在扫描期间被截短
+                    self.size = self.scanned
+                    break
+                if self.scanned + len(data) < self.size:
+                    cut = data.rfind(b'\n') + 1
+                    if cut:
+                        data = data[:cut]
+                events = []
+                state = _parse_gcode(data, self._checkpoints[-1], events, self.scanned)
+                for offset, tool, extruded in events:
+                    self.offsets.append(offset)
+                    self.toolchanges.append((offset, tool, extruded))
+                self.scanned += len(data)
+                self._checkpoint_offsets.append(self.scanned)
+                self._checkpoints.append(state)
+        return self.complete()
+
+    def extruded_at(self, position):
+        """文件位置 position 之前的累计挤出量"""
+        position = min(position, self.scanned)
+        i = bisect.bisect_right(self._checkpoint_offsets, position) - 1
+        start, state = self._checkpoint_offsets[i], self._checkpoints[i]
+        # 打印中位置只会前进，从上次查询的位置继续解析
+        if start <= self._cursor[0] <= position:
+            start, state = self._cursor
+        if position > start:
+            with open(self.path, 'rb') as f:
+                f.seek(start)
+                data = f.read(position - start)
+            data = data[:data.rfind(b'\n') + 1]
+            state = _parse_gcode(data, state)
+            self._cursor = (start + len(data), state)
+        return state[0]
+
+    def next_toolchange(self, position):
+        """position 处或之后的第一个换料 (偏移, 工具, 换料前的累计挤出量)，尚未扫描到时返回 None"""
+        i = bisect.bisect_left(self.offsets, position)
+        if i < len(self.toolchanges):
+            return self.toolchanges[i]
+        return None
+
+
+class AceLink:
+    """一条 ACE 链路上与传输无关的请求簿记
+
+    编码与限速发送、请求调度与流水线、在途请求表、超时与重发、响应匹配、
+    状态合并、运动完成判断、keepalive、冻结恢复以及重连退避都在这里。
+    extras/ace.py 的 AceUnit（Klipper reactor）和下面的 AceClient（asyncio）
+    只提供时钟、串口读写、定时器和完成对象：
+
+      _now()                 当前单调时间
+      _write(data)           写串口，返回写出的字节数
+      _kick_writer()         尽快运行写入器，写入器调用 _run_writer()
+      _reconnect()           关闭并重新打开串口
+      _new_completion()      请求的完成对象，complete(response) 唤醒等待者
+
+    其余以下划线开头的空方法是通知，子类按需覆盖。
+    """
+
+    log_prefix = 'ACE'
+
+    def __init__(self, request_timeout=2., window_bytes=None, window_time=0.1, capabilities=None,
+                 keepalive_interval=2.5, freeze_timeout=1., reconnect_delay=0.1, reconnect_max_delay=5.,
+                 reconnect_timeout=10.):
+        self.request_timeout = request_timeout
+        self.keepalive_interval = keepalive_interval
+        self.freeze_timeout = freeze_timeout
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_timeout = reconnect_timeout
+        self.capabilities = capabilities
+        # 显式指定时始终使用 window_bytes，否则按固件能力选择
+        self._tx_window_bytes = window_bytes
+        self._encoder = AceFrameEncoder()
+        self._decoder = AceFrameDecoder()
+        self._pacer = AceWritePacer(window_bytes or self._capability('window_bytes'), window_time)
+        self._scheduler = AceRequestScheduler()
+        self._callback_map = {}
+        self._request_id = 0
+        self._tx_retry_time = None
+        self.lock = False
+        self.send_time = None
+        self._info = None
+        self._status_seq = 0
+        self._status_waiters = []
+        self._last_status_time = 0.
+        self._last_tx_complete = 0.
+        self._last_rx_time = 0.
+        self._reported_crc_errors = 0
+        self._reported_length_errors = 0
+        self.latency = AceLatencyStats()
+        self.request_timeouts = 0
+        self.request_retries = 0
+        self.request_failures = 0
+        self.keepalives = 0
+        self.freezes = 0
+        self.freeze_recoveries = 0
+        self.last_recovery_time = 0.
+        self._recovery_start = None
+        self._recovery_stage = 0
+        self._recovery_stage_time = 0.
+        self._connect_attempts = 0
+        self._disconnect_time = 0.
+        self.connect_count = 0
+        self.reconnect_count = 0
+        self.last_reconnect_time = 0.
+
+    # --- 子类提供的传输 ------------------------------------------------------
+
+    def _now(self):
+        raise NotImplementedError
+
+    def _write(self, data):
+        raise NotImplementedError
+
+    def _kick_writer(self):
+        raise NotImplementedError
+
+    def _reconnect(self):
+        raise NotImplementedError
+
+    def _new_completion(self):
+        raise NotImplementedError
+
+    # --- 通知 ----------------------------------------------------------------
+
+    def _report(self, msg):
+        """用户可见的消息"""
+
+    def _trace_tx(self, eventtime, task, data):
+        pass
+
+    def _trace_rx(self, eventtime, id, task, payload):
+        pass
+
+    def _trace_fault(self, reason, data=b''):
+        pass
+
+    def _frame_error(self, reason, data):
+        self._trace_fault(reason, data)
+
+    def _request_timed_out(self, task, retry):
+        pass
+
+    def _callback_error(self, e):
+        self._report(f'{self.log_prefix}: 响应回调错误: {str(e)}')
+
+    def _status_changed(self, old, new):
+        pass
+
+    def _link_changed(self):
+        """连接、冻结恢复等链路状态变化"""
+
+    # --- 固件能力 ------------------------------------------------------------
+
+    def _capability(self, key):
+        """当前固件的能力；还不知道固件时使用最保守的配置"""
+        if self.capabilities is not None and key in self.capabilities:
+            return self.capabilities[key]
+        return FIRMWARE_PROFILES[0][1].get(key)
+
+    def _has_feed_assist_count(self):
+        """状态中是否带有进料辅助计数；还不知道时（-1）按带有处理"""
+        return self._capability('feed_assist_count') != 0
+
+    def _apply_capabilities(self, caps):
+        if caps == self.capabilities:
+            return False
+        self.capabilities = caps
+        if self._tx_window_bytes is None:
+            self._pacer.window_bytes = caps['window_bytes']
+        return True
+
+    # --- 发送 ----------------------------------------------------------------
+
+    def _queue_request(self, request, callback=None, priority=None, pipelined=False):
+        task = self._scheduler.put(request, callback, priority, pipelined)
+        if task.completion is None:
+            task.completion = self._new_completion()
+        if not self.lock or self._can_pipeline():
+            self._kick_writer()
+        return task
+
+    def _poll_interval(self, eventtime):
+        """下一次后台 get_status 距上一次的间隔"""
+        return 1.
+
+    def _run_writer(self, eventtime):
+        """写入器的一次运行：写完上一帧、清理超时、发送允许发送的请求，返回下次运行时间
+
+        写串口的 SerialException 交给调用方处理（重连）。
+        """
+        if self._tx_retry_time is not None:
+            # 上一帧尚未完全写出：先写完它，再考虑下一帧
+            self._tx_retry_time = self._pacer.flush(self._write, eventtime)
+            if self._tx_retry_time is not None:
+                return self._tx_retry_time
+            self._last_tx_complete = eventtime
+        self._expire_requests(eventtime)
+        poll_interval = self._poll_interval(eventtime)
+        if self._scheduler.peek() is None and eventtime >= self._last_status_time + poll_interval:
+            # 后台轮询与排队中的 get_status 合并
+            self._scheduler.put({"method": "get_status"}, None, PRIORITY_BACKGROUND, True)
+        while self._tx_retry_time is None and self._can_send():
+            task = self._scheduler.pop()
+            try:
+                self._dispatch(task, eventtime)
+            except SerialException:
+                raise
+            except Exception as e:
+                self._report(f'{self.log_prefix}: 写入错误 {str(e)}')
+                self._callback_map.pop(task.id, None)
+                self._fail_request(task)
+                self.lock = bool(self._callback_map)
+        if self._tx_retry_time is not None:
+            return self._tx_retry_time
+        if self._scheduler.peek() is not None:
+            # 被在途请求挡住：响应到达时会立即重新运行
+            return self._next_deadline()
+        waketime = self._last_status_time + poll_interval
+        if self._callback_map:
+            waketime = min(waketime, self._next_deadline())
+        return waketime
+
+    def _can_send(self):
+        return self._scheduler.peek() is not None and (not self._callback_map or self._can_pipeline())
+
+    def _can_pipeline(self):
+        return can_pipeline(self._scheduler.peek(), self._callback_map)
+
+    def _next_deadline(self):
+        return min(task.deadline for task in self._callback_map.values())
+
+    def _dispatch(self, task, eventtime):
+        if task.method == 'get_status':
+            # 任何 get_status 响应都会刷新状态，并推迟下一次后台轮询
+            if AceLink._update_status not in task.callbacks:
+                task.callbacks.insert(0, AceLink._update_status)
+            self._last_status_time = eventtime
+        id = self._request_id
+        self._request_id += 1
+        task.id = id
+        task.attempts += 1
+        task.send_time = eventtime
+        task.deadline = eventtime + self.request_timeout
+        self._callback_map[id] = task
+        task.request['id'] = id
+        data = self._encoder.encode(task.request)
+        self._trace_tx(eventtime, task, data)
+        self._send_frame(data, eventtime)
+        self.send_time = eventtime
+        self.lock = True
+
+    def _send_frame(self, data, eventtime):
+        self._tx_retry_time = self._pacer.send(self._write, data, eventtime)
+        if self._tx_retry_time is None:
+            self._last_tx_complete = eventtime
+
+    # --- 超时与失败 ----------------------------------------------------------
+
+    def _expire_requests(self, eventtime):
+        """清理超过截止时间的请求：幂等请求重新排队，其余以失败完成"""
+        expired = [task for task in self._callback_map.values() if task.deadline <= eventtime]
+        if not expired:
+            return
+        for task in expired:
+            del self._callback_map[task.id]
+            self.request_timeouts += 1
+            retry = task.can_retry()
+            self._request_timed_out(task, retry)
+            if retry:
+                self.request_retries += 1
+                self._scheduler.requeue(task)
+            else:
+                self._fail_request(task)
+        self._trace_fault('timeout', ','.join(f'{task.method}#{task.id}' for task in expired).encode())
+        self.lock = bool(self._callback_map)
+        # 丢弃可能损坏的帧头，缓冲区中其后的完整帧仍然可用
+        self._handle_frames(self._decoder.resync())
+
+    def _fail_request(self, task):
+        self.request_failures += 1
+        task.complete(None)
+
+    def _requeue_idempotent(self, tasks):
+        """把可以重发的请求放回队首（不算一次失败的尝试），返回其余请求"""
+        rest = []
+        for task in sorted(tasks, key=lambda task: task.id, reverse=True):
+            del self._callback_map[task.id]
+            if task.idempotent():
+                task.attempts -= 1
+                self.request_retries += 1
+                self._scheduler.requeue(task)
+            else:
+                rest.append(task)
+        self.lock = bool(self._callback_map)
+        return rest
+
+    def _fail_pending_requests(self):
+        """连接断开时处理在途请求：幂等请求重新排队，重连后重发；其余可能已被执行，以失败结束
+
+        排队中尚未发送的请求全部保留，断开超过 reconnect_timeout 仍未恢复时才失败。
+        """
+        for task in self._requeue_idempotent(list(self._callback_map.values())):
+            self._fail_request(task)
+
+    def _fail_queued_requests(self):
+        tasks = self._scheduler.clear()
+        if tasks:
+            self._report(f'{self.log_prefix}: 连接未恢复，放弃 {len(tasks)} 个排队的请求')
+        for task in tasks:
+            self._fail_request(task)
+
+    def _fail_all_requests(self):
+        tasks = list(self._callback_map.values()) + self._scheduler.clear()
+        self._callback_map.clear()
+        self.lock = False
+        for task in tasks:
+            self._fail_request(task)
+
+    # --- 接收 ----------------------------------------------------------------
+
+    def _handle_frames(self, frames, raw_bytes=b''):
+        decoder = self._decoder
+        if decoder.crc_errors != self._reported_crc_errors:
+            self._reported_crc_errors = decoder.crc_errors
+            self._frame_error('crc', raw_bytes)
+        if decoder.length_errors != self._reported_length_errors:
+            self._reported_length_errors = decoder.length_errors
+            self._frame_error('length', raw_bytes)
+
+        completed = False
+        for payload in frames:
+            try:
+                response = decode_response(payload)
+                id = response['id']
+            except ValueError:
+                self._frame_error('json', payload)
+                continue
+            eventtime = self._now()
+            self._last_rx_time = eventtime
+            if self._recovery_start is not None:
+                self.last_recovery_time = eventtime - self._recovery_start
+                self.freeze_recoveries += 1
+                self._recovery_start = None
+                self._link_changed()
+                self._report(f'{self.log_prefix}: 冻结恢复完成，用时 {self.last_recovery_time:.3f}s')
+            task = self._callback_map.pop(id, None)
+            self._trace_rx(eventtime, id, task, payload)
+            if task is None:
+                continue
+            self.lock = bool(self._callback_map)
+            self.latency.record(task.method, eventtime - task.send_time)
+            for callback in task.callbacks:
+                try:
+                    callback(self=self, response=response)
+                except Exception as e:
+                    self._callback_error(e)
+            task.complete(response)
+            completed = True
+        if completed:
+            # 上一个请求已完成，立即发送下一个
+            self._kick_writer()
+
+    # --- 状态 ----------------------------------------------------------------
+
+    def _update_status(self, response):
+        result = response.get('result') if response is not None else None
+        if not isinstance(result, dict):
+            return
+        if result != self._info:
+            old, self._info = self._info, result
+            self._status_changed(old, result)
+        caps = self.capabilities
+        if caps is not None and caps['feed_assist_count'] != ('feed_assist_count' in result):
+            self._apply_capabilities(dict(caps, feed_assist_count=int('feed_assist_count' in result)))
+        self._status_seq += 1
+        self._wake_status_waiters()
+
+    def _wake_status_waiters(self):
+        waiters, self._status_waiters = self._status_waiters, []
+        for completion in waiters:
+            completion.complete(True)
+
+    def _motion_finished(self, expected_time):
+        """送料/退料被确认后调用，返回判断运动完成的条件：状态流显示 ACE 重新空闲，
+        若轮询没有捕捉到 busy 状态，至少经过预计的运动时间"""
+        start = self._now()
+        seq = self._status_seq
+        seen_busy = [False]
+
+        def finished():
+            if self._status_seq == seq or self._info is None:
+                return False
+            if self._info.get('status') != 'ready':
+                seen_busy[0] = True
+                return False
+            return seen_busy[0] or self._now() >= start + expected_time
+        return finished
+
+    def _motion_timeout(self, expected_time):
+        return expected_time * 2. + self.request_timeout
+
+    # --- 连接 ----------------------------------------------------------------
+
+    def _link_opened(self, eventtime):
+        """串口打开后重置链路状态"""
+        self._decoder.reset()
+        self._pacer.reset()
+        self._tx_retry_time = None
+        self._last_status_time = 0.
+        self._last_tx_complete = self._last_rx_time = eventtime
+        self._connect_attempts = 0
+        if self.connect_count:
+            self.reconnect_count += 1
+            self.last_reconnect_time = eventtime - self._disconnect_time
+        self.connect_count += 1
+        self._link_changed()
+
+    def _link_closed(self, eventtime):
+        """串口关闭后处理在途请求"""
+        self._disconnect_time = eventtime
+        self._link_changed()
+        self._fail_pending_requests()
+
+    def _connect_retry_delay(self, eventtime):
+        """连接失败后下一次尝试的延迟（指数退避）；断开太久时放弃排队的请求"""
+        if eventtime - self._disconnect_time > self.reconnect_timeout and len(self._scheduler):
+            self._fail_queued_requests()
+        delay = min(self.reconnect_delay * 2 ** self._connect_attempts, self.reconnect_max_delay)
+        self._connect_attempts += 1
+        return delay
+
+    # --- 看门狗 --------------------------------------------------------------
+
+    def _check_link(self, eventtime):
+        """看门狗的一次检查，返回下次检查时间
+
+        ACE 在 3 秒内没有收到完整帧就会断开。正常轮询已经足够频繁，只有链路
+        keepalive_interval 没有写出任何帧时才补发状态查询；它经过队列由写入器发送，
+        在途的非流水线请求仍独占链路，由 request_timeout 限制其时长。
+        """
+        keepalive_time = self._last_tx_complete + self.keepalive_interval
+        if (self._tx_retry_time is None and eventtime >= keepalive_time
+                and all(task.pipelined for task in self._callback_map.values())):
+            self.keepalives += 1
+            self._scheduler.put({"method": "get_status"}, None, PRIORITY_BACKGROUND, True)
+            self._kick_writer()
+        self._check_freeze(eventtime)
+        if keepalive_time <= eventtime:
+            keepalive_time = eventtime + self.keepalive_interval / 4.
+        return min(keepalive_time, eventtime + self.freeze_timeout / 2.)
+
+    def _check_freeze(self, eventtime):
+        """写入正常但 freeze_timeout 内没有任何响应时认为 ACE 冻结，逐级恢复"""
+        if self._recovery_start is not None:
+            if eventtime - self._recovery_stage_time < 2. * self.freeze_timeout:
+                return
+            self._recovery_stage_time = eventtime
+            if self._recovery_stage == 1:
+                # 填充没有让 ACE 恢复：重新打开串口
+                self._recovery_stage = 2
+                self._report(f'{self.log_prefix}: 填充后仍无响应，重新打开串口')
+                self._reconnect()
+            else:
+                self._report(f'{self.log_prefix}: 重新连接后仍无响应，ACE 可能需要重新上电')
+                self._send_filler(eventtime)
+            return
+        # 只看最近一次收到数据之后发出的请求，更早的请求可能只是被 ACE 忽略了
+        oldest = min((task.send_time for task in self._callback_map.values()
+                      if task.send_time >= self._last_rx_time), default=None)
+        if oldest is None or self._last_tx_complete < oldest or eventtime - oldest < self.freeze_timeout:
+            return
+        self.freezes += 1
+        self._recovery_start = self._recovery_stage_time = eventtime
+        self._link_changed()
+        self._report(f'{self.log_prefix}: {eventtime - oldest:.1f}s 内没有响应，开始冻结恢复')
+        self._trace_fault('freeze')
+        # 冻结期间发出的幂等请求已被吞掉，排在填充之后立即重发
+        lost = [task for task in self._callback_map.values()
+                if task.send_time >= self._last_rx_time and task.idempotent()]
+        self._requeue_idempotent(lost)
+        self._send_filler(eventtime)
+
+    def _send_filler(self, eventtime):
+        self._recovery_stage = 1
+        self._tx_retry_time = self._pacer.send(self._write, FREEZE_FILLER, eventtime)
+        # 填充之后立即探测
+        self._dispatch(AceRequest({"method": "get_status"}, None, PRIORITY_BACKGROUND, True), eventtime)
+        self._kick_writer()
+
+
+class AceError(Exception):
+    """ACE 返回错误、请求超时或连接断开"""
+
+
+class _FutureCompletion:
+    """让 AceRequest.complete() 唤醒 asyncio future"""
+
+    def __init__(self, future):
+        self.future = future
+
+    def complete(self, response):
+        if not self.future.done():
+            self.future.set_result(response)
+
+
+class AceClient(AceLink):
+    """ACE 的 asyncio 客户端
+
+    多个协程可以同时发出请求并各自等待响应。请求按与驱动相同的优先级排队；
+    查询默认以流水线方式发送，运动和控制命令一次只有一个在途。空闲时每隔
+    status_interval 秒轮询一次状态，subscribe() 产生状态变化流。请求簿记、
+    keepalive、冻结恢复和重连退避与驱动共用 AceLink：串口出错时重新打开同一端口，
+    可以重发的在途请求在重连后重发，其余以 AceError 结束。
+    """
+
+    def __init__(self, port=None, baud=115200, request_timeout=2., status_interval=1., fast_interval=0.2,
+                 window_bytes=None, window_time=0.1, **link_options):
+        super().__init__(request_timeout, window_bytes, window_time, **link_options)
+        self.port = port
+        self.baud = baud
+        self.status_interval = status_interval
+        self.fast_interval = fast_interval
+        self.info = None
+        self._serial = None
+        self._loop = None
+        self._timer = None
+        self._watchdog_timer = None
+        self._connect_timer = None
+        self._closed = True
+        self._subscribers = []
+        self._motion_waiters = 0
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+        port = self.port or find_by_id() or find_com_port()
+        if port is None:
+            raise AceError('未找到 ACE 串口')
+        self.port = port
+        self._open_serial()
+        self._closed = False
+        self.info = await self.call('get_info')
+        self._apply_capabilities(firmware_capabilities(self.info, self.status))
+        return self
+
+    async def close(self):
+        self._disconnect()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def connected(self):
+        return self._serial is not None
+
+    @property
+    def status(self):
+        return self._info
+
+    @property
+    def encoder(self):
+        return self._encoder
+
+    @property
+    def decoder(self):
+        return self._decoder
+
+    @property
+    def pacer(self):
+        return self._pacer
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    def _open_serial(self):
+        self._serial = serial.Serial(port=self.port, baudrate=self.baud, timeout=0, write_timeout=0)
+        self._loop.add_reader(self._serial.fileno(), self._reader)
+        now = self._loop.time()
+        self._link_opened(now)
+        self._kick()
+        self._watchdog_timer = self._loop.call_at(now + self.freeze_timeout / 2., self._watchdog)
+
+    def _close_serial(self):
+        for timer in (self._timer, self._watchdog_timer, self._connect_timer):
+            if timer is not None:
+                timer.cancel()
+        self._timer = self._watchdog_timer = self._connect_timer = None
+        if self._serial is not None:
+            self._loop.remove_reader(self._serial.fileno())
+            self._serial.close()
+            self._serial = None
+            self._link_closed(self._loop.time())
+
+    def _disconnect(self):
+        self._closed = True
+        self._close_serial()
+        self._fail_all_requests()
+        for queue in self._subscribers:
+            self._publish(queue, None)
+        self._wake_status_waiters()
+
+    # --- AceLink 的传输 ------------------------------------------------------
+
+    def _now(self):
+        return self._loop.time()
+
+    def _write(self, data):
+        return self._serial.write(data)
+
+    def _new_completion(self):
+        return _FutureCompletion(self._loop.create_future())
+
+    def _report(self, msg):
+        logging.info(msg)
+
+    def _kick_writer(self):
+        self._kick()
+
+    def _kick(self, when=None):
+        if self._serial is None:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        if when is None:
+            self._timer = self._loop.call_soon(self._writer)
+        else:
+            self._timer = self._loop.call_at(when, self._writer)
+
+    def _writer(self):
+        self._timer = None
+        try:
+            waketime = self._run_writer(self._loop.time())
+        except SerialException:
+            self._reconnect()
+            return
+        self._kick(waketime)
+
+    def _watchdog(self):
+        self._watchdog_timer = None
+        try:
+            waketime = self._check_link(self._loop.time())
+        except SerialException:
+            self._reconnect()
+            return
+        if self._serial is not None:
+            self._watchdog_timer = self._loop.call_at(waketime, self._watchdog)
+
+    def _reconnect(self):
+        self._report(f'{self.log_prefix}: 尝试重新连接')
+        self._close_serial()
+        self._connect_attempts = 0
+        self._connect_timer = self._loop.call_soon(self._connect_retry)
+
+    def _connect_retry(self):
+        self._connect_timer = None
+        try:
+            self._open_serial()
+            return
+        except SerialException:
+            self._serial = None
+        delay = self._connect_retry_delay(self._loop.time())
+        self._connect_timer = self._loop.call_later(delay, self._connect_retry)
+
+    def _poll_interval(self, eventtime):
+        if self._motion_waiters or (self.status is not None and self.status.get('status') != 'ready'):
+            return self.fast_interval
+        return self.status_interval
+
+    def _status_changed(self, old, new):
+        for queue in self._subscribers:
+            self._publish(queue, new)
+
+    # --- 接收 ----------------------------------------------------------------
+
+    def _reader(self):
+        try:
+            data = self._serial.read(4096)
+        except SerialException:
+            self._reconnect()
+            return
+        if data:
+            self._handle_frames(self._decoder.feed(data), data)
+
+    @staticmethod
+    def _publish(queue, status):
+        # 消费者跟不上时只保留最新状态
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(status)
+
+    # --- 公共接口 ------------------------------------------------------------
+
+    def send(self, method, params=None, priority=None, pipelined=None):
+        """排队一个请求，返回在响应到达时完成的 future；超时或断开时结果为 None
+
+        pipelined 默认对可重发的查询开启。连接中断期间请求留在队列中，重连后发送。
+        """
+        if self._closed:
+            raise AceError('ACE 未连接')
+        if pipelined is None:
+            pipelined = method in RETRY_LIMITS
+        request = {"method": method}
+        if params is not None:
+            request['params'] = params
+        return self._queue_request(request, None, priority, pipelined).completion.future
+
+    async def call(self, method, params=None, priority=None, pipelined=None):
+        """发送请求并返回 result；ACE 返回错误或超时时抛出 AceError"""
+        response = await self.send(method, params, priority, pipelined)
+        if response is None:
+            raise AceError(f'ACE 响应超时: {method}')
+        if response.get('code', 0) != 0:
+            raise AceError(f'ACE 错误: {response.get("msg")}')
+        return response.get('result')
+
+    async def subscribe(self):
+        """异步迭代状态变化，首先产生当前状态；连接断开时结束"""
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers.append(queue)
+        try:
+            if self.status is not None:
+                queue.put_nowait(self.status)
+            while True:
+                status = await queue.get()
+                if status is None:
+                    return
+                yield status
+        finally:
+            self._subscribers.remove(queue)
+
+    async def wait_status(self, predicate, timeout=None):
+        """每收到一次状态就检查 predicate，直到成立或超时"""
+        deadline = None if timeout is None else self._loop.time() + timeout
+        while not predicate():
+            if self._closed:
+                raise AceError('ACE 连接已断开')
+            remaining = None if deadline is None else deadline - self._loop.time()
+            if remaining is not None and remaining <= 0:
+                return predicate()
+            completion = self._new_completion()
+            self._status_waiters.append(completion)
+            try:
+                await asyncio.wait_for(completion.future, remaining)
+            except asyncio.TimeoutError:
+                return predicate()
+        return True
+
+    async def get_status(self):
+        return await self.call('get_status')
+
+    async def get_filament_info(self, index):
+        return await self.call('get_filament_info', {"index": index})
+
+    async def _motion(self, method, index, length, speed, wait):
+        self._motion_waiters += 1
+        try:
+            await self.call(method, {"index": index, "length": length, "speed": speed})
+            if not wait:
+                return
+            # 与驱动相同的完成条件
+            expected = length / speed
+            finished = self._motion_finished(expected)
+            if not await self.wait_status(finished, self._motion_timeout(expected)):
+                raise AceError(f'等待 {method} 完成超时')
+        finally:
+            self._motion_waiters -= 1
+
+    async def feed(self, index, length, speed=25, wait=True):
+        await self._motion('feed_filament', index, length, speed, wait)
+
+    async def retract(self, index, length, speed=25, wait=True):
+        await self._motion('unwind_filament', index, length, speed, wait)
+
+    async def start_drying(self, temp, duration, fan_speed=7000):
+        """duration 以分钟计"""
+        return await self.call('drying', {"temp": temp, "fan_speed": fan_speed, "duration": duration})
+
+    async def stop_drying(self):
+        return await self.call('drying_stop')
+
+    async def start_feed_assist(self, index):
+        return await self.call('start_feed_assist', {"index": index})
+
+    async def stop_feed_assist(self, index):
+        return await self.call('stop_feed_assist', {"index": index})
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 与 tools/ 下的工具一样直接导入 extras 中的协议模块
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'extras'))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,121 @@
+from extras.ace import BunnyAce
+
+
+class Completion:
+    def __init__(self):
+        self.result = None
+
+    def complete(self, result):
+        self.result = result
+
+
+class Gcode:
+    def __init__(self):
+        self.messages = []
+        self.scripts = []
+
+    def respond_info(self, msg):
+        self.messages.append(msg)
+
+    def run_script(self, script):
+        self.scripts.append(script)
+
+
+class Unit:
+    name = 'ace'
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def wait_ace_ready(self):
+        pass
+
+    def send_request(self, request):
+        self.requests.append(request)
+        return request
+
+    def wait_request(self, task):
+        return self.response
+
+    def _wait_motion_done(self, task, expected_time):
+        pass
+
+
+def make_ace(response={'code': 0}, slots=4):
+    """只带预送料所需属性的 BunnyAce，不经过 Klipper 配置"""
+    ace = BunnyAce.__new__(BunnyAce)
+    ace.gcode = Gcode()
+    ace.units = [Unit(response)]
+    ace.tools = [(ace.units[0], slot) for slot in range(slots)]
+    ace.variables = {'ace_current_index': 0}
+    ace.toolchange_load_length = 630
+    ace.prestage_park_length = 580
+    ace.feed_speed = 50
+    ace._staged = [0] * slots
+    ace._slot_ready = [True] * slots
+    ace._prestage_tool = -1
+    ace._prestage_version = 0
+    ace._prestage_completion = Completion()
+    ace._park_in_progress = False
+    ace.endless_spool_in_progress = False
+    return ace
+
+
+def test_load_length_subtracts_staged_filament():
+    ace = make_ace()
+    assert ace._load_length(1) == 630
+    ace._staged[1] = 580
+    assert ace._load_length(1) == 50
+    ace._staged[1] = 700
+    assert ace._load_length(1) == 0
+
+
+def test_prestage_blocked_reasons():
+    ace = make_ace()
+    assert ace._prestage_blocked(0) is not None
+    assert ace._prestage_blocked(1) is None
+    ace._slot_ready[2] = False
+    assert ace._prestage_blocked(2) is not None
+    ace._staged[3] = 580
+    assert ace._prestage_blocked(3) is not None
+    ace.prestage_park_length = 0
+    assert ace._prestage_blocked(1) is not None
+
+
+def test_prestage_feeds_only_the_missing_length():
+    ace = make_ace()
+    ace._staged[2] = 80
+    ace._prestage_tool = 2
+    ace._prestage(2)
+    assert ace.units[0].requests[0]['params'] == {'index': 2, 'length': 500, 'speed': 50}
+    assert ace._staged[2] == 580
+    assert ace._load_length(2) == 50
+    assert ace._prestage_tool == -1
+    assert ace._prestage_completion.result is True
+
+
+def test_prestage_error_keeps_staged_length():
+    ace = make_ace()
+    ace._staged[1] = 80
+
+    def fail(script):
+        raise Exception('SAVE_VARIABLE 失败')
+    ace.gcode.run_script = fail
+    ace._prestage_tool = 1
+    ace._prestage(1)
+    # 出错后保持原来的已送长度，换料按完整的剩余长度送料
+    assert ace._staged[1] == 80
+    assert ace._load_length(1) == 550
+    assert any('SAVE_VARIABLE 失败' in msg for msg in ace.gcode.messages)
+    assert ace._prestage_tool == -1
+    assert ace._prestage_completion.result is True
+
+
+def test_prestage_rejected_by_ace_keeps_staged_length():
+    ace = make_ace(response={'code': -1, 'msg': 'busy'})
+    ace._prestage_tool = 1
+    ace._prestage(1)
+    assert ace._staged[1] == 0
+    assert ace.gcode.scripts == []
+    assert any('busy' in msg for msg in ace.gcode.messages)
@@ -0,0 +1,252 @@
+import struct
+
+import ace_protocol
+from ace_protocol import (
+    FRAME_HEADER, MAX_PAYLOAD_LENGTH, PRIORITY_BACKGROUND, PRIORITY_CONTROL, PRIORITY_MOTION,
+    AceFrameDecoder, AceFrameEncoder, AceRequestScheduler, GcodeToolchangeIndex,
+    default_status, status_deltas)
+
+
+def frame(request):
+    return bytes(AceFrameEncoder().encode(request))
+
+
+# --- AceFrameDecoder ----------------------------------------------------------
+
+def test_decoder_single_frame():
+    decoder = AceFrameDecoder()
+    assert decoder.feed(frame({"method": "get_status", "id": 1})) == [b'{"method":"get_status","id":1}']
+    assert decoder.buffered() == 0
+    assert decoder.frames == 1
+
+
+def test_decoder_fragmented_input():
+    data = frame({"method": "get_info", "id": 7})
+    decoder = AceFrameDecoder()
+    frames = []
+    for i in range(len(data)):
+        frames += decoder.feed(data[i:i + 1])
+        if i < len(data) - 2:
+            # 帧尾之前不应返回任何负载
+            assert frames == []
+    assert frames == [b'{"method":"get_info","id":7}']
+    assert decoder.buffered() == 0
+    assert decoder.discarded_bytes == 0
+
+
+def test_decoder_multiple_frames_in_one_read():
+    data = b''.join(frame({"method": "get_status", "id": i}) for i in range(3))
+    decoder = AceFrameDecoder()
+    payloads = decoder.feed(data + frame({"method": "get_info", "id": 3})[:5])
+    assert payloads == [b'{"method":"get_status","id":%d}' % i for i in range(3)]
+    # 第四帧只到了一部分，留在缓冲区中
+    assert decoder.buffered() == 5
+    assert decoder.feed(frame({"method": "get_info", "id": 3})[5:]) == [b'{"method":"get_info","id":3}']
+
+
+def test_decoder_skips_noise_between_frames():
+    decoder = AceFrameDecoder()
+    data = b'\x00\x01' + frame({"method": "get_status", "id": 1}) + b'junk' + frame({"method": "get_status", "id": 2})
+    assert len(decoder.feed(data)) == 2
+    assert decoder.discarded_bytes == 6
+
+
+def test_decoder_bad_length_header():
+    decoder = AceFrameDecoder()
+    bad = FRAME_HEADER + struct.pack('<H', MAX_PAYLOAD_LENGTH + 1) + b'{}'
+    good = frame({"method": "get_status", "id": 5})
+    assert decoder.feed(bad + good) == [b'{"method":"get_status","id":5}']
+    assert decoder.length_errors == 1
+    assert decoder.buffered() == 0
+
+
+def test_decoder_bad_crc_resyncs_on_next_header():
+    decoder = AceFrameDecoder()
+    corrupt = bytearray(frame({"method": "get_status", "id": 1}))
+    corrupt[6] ^= 0xff
+    good = frame({"method": "get_status", "id": 2})
+    assert decoder.feed(bytes(corrupt) + good) == [b'{"method":"get_status","id":2}']
+    assert decoder.crc_errors == 1
+
+
+def test_decoder_resync_drops_stalled_header():
+    decoder = AceFrameDecoder()
+    # 头部声明了 100 字节但数据永远不会到达
+    stalled = FRAME_HEADER + struct.pack('<H', 100) + b'{"id":'
+    assert decoder.feed(stalled) == []
+    good = frame({"method": "get_status", "id": 3})
+    assert decoder.feed(good[:4]) == []
+    assert decoder.resync() == []
+    assert decoder.feed(good[4:]) == [b'{"method":"get_status","id":3}']
+
+
+
+# --- AceRequestScheduler -----------------------------------------------------
+
+def test_scheduler_orders_by_priority_then_fifo():
+    scheduler = AceRequestScheduler()
+    scheduler.put({"method": "get_status"}, None)
+    scheduler.put({"method": "get_filament_info", "params": {"index": 0}}, None, PRIORITY_BACKGROUND)
+    scheduler.put({"method": "drying", "params": {"temp": 50}}, None)
+    scheduler.put({"method": "feed_filament", "params": {"index": 1}}, None)
+    scheduler.put({"method": "stop_feed_filament", "params": {"index": 1}}, None)
+    assert scheduler.depths() == {'motion': 2, 'control': 1, 'background': 2}
+    order = [scheduler.pop().method for _ in range(len(scheduler))]
+    assert order == ['feed_filament', 'stop_feed_filament', 'drying', 'get_status', 'get_filament_info']
+    assert scheduler.pop() is None
+
+
+def test_scheduler_requeue_goes_first_in_its_priority():
+    scheduler = AceRequestScheduler()
+    first = scheduler.put({"method": "get_info"}, None, PRIORITY_CONTROL)
+    scheduler.put({"method": "drying_stop"}, None)
+    motion = scheduler.put({"method": "unwind_filament", "params": {"index": 0}}, None)
+    assert motion.priority == PRIORITY_MOTION
+    assert scheduler.pop() is motion
+    assert scheduler.pop() is first
+    scheduler.requeue(first)
+    assert scheduler.peek() is first
+    scheduler.requeue(motion)
+    assert scheduler.peek() is motion
+
+
+def test_scheduler_merges_queued_status_queries():
+    scheduler = AceRequestScheduler()
+    calls = []
+    first = scheduler.put({"method": "get_status"}, lambda *args: calls.append(1))
+    second = scheduler.put({"method": "get_status"}, lambda *args: calls.append(2), pipelined=True)
+    assert second is first
+    assert len(first.callbacks) == 2
+    assert first.pipelined
+    assert scheduler.merged == 1
+    assert len(scheduler) == 1
+
+
+def test_scheduler_does_not_merge_requests_with_params():
+    scheduler = AceRequestScheduler()
+    a = scheduler.put({"method": "get_filament_info", "params": {"index": 0}}, None)
+    b = scheduler.put({"method": "get_filament_info", "params": {"index": 0}}, None)
+    assert a is not b
+    status = scheduler.put({"method": "get_status"}, None)
+    assert scheduler.pop() is a
+    assert scheduler.pop() is b
+    assert scheduler.pop() is status
+    # 已取出的请求不再合并，新的 get_status 单独排队
+    assert scheduler.put({"method": "get_status"}, None) is not status
+
+
+def test_scheduler_clear_returns_every_queued_task():
+    scheduler = AceRequestScheduler()
+    tasks = [scheduler.put({"method": method}, None)
+             for method in ("get_status", "feed_filament", "get_info")]
+    assert sorted(scheduler.clear(), key=id) == sorted(tasks, key=id)
+    assert len(scheduler) == 0
+    assert scheduler.get_status()['max_depth'] == {'motion': 1, 'control': 0, 'background': 2}
+
+
+# --- status_deltas -----------------------------------------------------------
+
+def test_status_deltas_unchanged_status():
+    assert status_deltas(default_status(), default_status()) == []
+
+
+def test_status_deltas_reports_only_changed_fields():
+    old = default_status()
+    new = default_status()
+    new['slots'][2] = dict(new['slots'][2], status='ready')
+    new['temp'] = 30
+    new['dryer'] = dict(new['dryer'], status='drying', target_temp=50)
+    new['feed_assist_count'] = 12
+    assert status_deltas(old, new) == [
+        ('slot_status', (2, 'empty', 'ready')),
+        ('dryer', (old['dryer'], new['dryer'])),
+        ('feed_assist_count', (12,)),
+    ]
+
+
+def test_status_deltas_new_slot_has_no_previous_status():
+    old = default_status(2)
+    new = default_status(3)
+    assert status_deltas(old, new) == [('slot_status', (2, None, 'empty'))]
+
+
+def test_status_deltas_without_feed_assist_counter():
+    old = default_status(feed_assist_count=False)
+    assert 'feed_assist_count' not in old and 'cont_assist_time' not in old
+    new = dict(old, feed_assist_count=3)
+    assert status_deltas(old, new, feed_assist_count=False) == []
+    assert status_deltas(old, new) == [('feed_assist_count', (3,))]
+
+
+# --- GcodeToolchangeIndex ----------------------------------------------------
+
+GCODE = (
+    b'M83\n'
+    b'G1 X10 E5 ; prime\n'
+    b'G1 E-1\n'
+    b'T1\n'
+    b'G1 X20 E2.5\n'
+    b'M82\n'
+    b'G92 E0\n'
+    b'G1 X30 E4\n'
+    b'G1 X40 E6\n'
+    b'ACE_CHANGE_TOOL TOOL=3\n'
+    b'G0 X0\n'
+    b'T12 ; comment\n'
+    b'M104 T0 S200\n'
+)
+
+
+def write_gcode(tmp_path, data=GCODE):
+    path = tmp_path / 'print.gcode'
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_gcode_index_offsets_and_extrusion(tmp_path):
+    index = GcodeToolchangeIndex(write_gcode(tmp_path))
+    assert index.scan()
+    assert index.toolchanges == [
+        (GCODE.index(b'T1\n'), 1, 4.),
+        (GCODE.index(b'ACE_CHANGE_TOOL'), 3, 12.5),
+        (GCODE.index(b'T12'), 12, 12.5),
+    ]
+    # M104 T0 不是换料
+    assert [tool for _, tool, _ in index.toolchanges] == [1, 3, 12]
+
+
+def test_gcode_index_next_toolchange(tmp_path):
+    index = GcodeToolchangeIndex(write_gcode(tmp_path))
+    index.scan()
+    t1 = GCODE.index(b'T1\n')
+    assert index.next_toolchange(0)[1] == 1
+    assert index.next_toolchange(t1)[1] == 1
+    assert index.next_toolchange(t1 + 1)[1] == 3
+    assert index.next_toolchange(len(GCODE)) is None
+
+
+def test_gcode_index_extruded_at(tmp_path):
+    index = GcodeToolchangeIndex(write_gcode(tmp_path))
+    index.scan()
+    assert index.extruded_at(0) == 0.
+    assert index.extruded_at(GCODE.index(b'G1 E-1')) == 5.
+    # 位置落在行中间时只计入完整的行
+    assert index.extruded_at(GCODE.index(b'T1\n') + 1) == 4.
+    assert index.extruded_at(len(GCODE)) == 12.5
+    # 回到更早的位置时从检查点重新解析
+    assert index.extruded_at(GCODE.index(b'G1 X40')) == 10.5
+
+
+def test_gcode_index_scans_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(ace_protocol, 'GCODE_INDEX_CHUNK', 32)
+    lines = b'M83\n' + b''.join(b'G1 X%d E1\n' % i + (b'T%d\n' % (i % 4) if i % 10 == 9 else b'')
+                     for i in range(100))
+    index = GcodeToolchangeIndex(write_gcode(tmp_path, lines))
+    scans = 1
+    while not index.scan(64):
+        scans += 1
+    assert scans > 10
+    assert [(tool, extruded) for _, tool, extruded in index.toolchanges] == \
+        [(i % 4, i + 1.) for i in range(9, 100, 10)]
+    assert all(lines[offset:offset + 1] == b'T' for offset in index.offsets)
+    assert index.extruded_at(index.offsets[4]) == 50.
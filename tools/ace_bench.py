@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# ACE 协议层基准测试与自检
+#
+# 覆盖帧编码与 CRC、分片和多帧解码、get_status JSON 解析、请求调度，
+# 以及经 PTY 回环或模拟器的完整往返延迟。结果可写成 JSON 供后续比较。
+#
+# 用法（在打印机主机上，使用 klippy-env 的 Python）：
+#   ~/klippy-env/bin/python ~/ACEPROSV08/tools/ace_bench.py
+#   ~/klippy-env/bin/python ~/ACEPROSV08/tools/ace_bench.py --self-check
+#   ~/klippy-env/bin/python ~/ACEPROSV08/tools/ace_bench.py --json new.json --compare old.json
+import argparse, json, os, platform, struct, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extras'))
+import ace_protocol
+
+# 真实 get_status 响应负载，作为帧大小的参考
+SAMPLE_STATUS = {
+    "id": 1234, "code": 0, "msg": "success",
+    "result": {
+        "status": "ready", "dryer": {"status": "stop", "target_temp": 0, "duration": 0, "remain_time": 0},
+        "temp": 26, "enable_rfid": 1, "fan_speed": 7000, "feed_assist_count": 0, "cont_assist_time": 0.0,
+        "slots": [
+            {"index": i, "status": "ready", "sku": "", "type": "PLA", "color": [255, 255, 255], "rfid": 0}
+            for i in range(4)
+        ]
+    }
+}
+
+
+def legacy_crc(buffer):
+    """原始逐位实现，仅用于自检"""
+    _crc = 0xffff
+    for byte in buffer:
+        data = byte
+        data ^= _crc & 0xff
+        data ^= (data & 0x0f) << 4
+        _crc = ((data << 8) | (_crc >> 8)) ^ (data >> 4) ^ (data << 3)
+    return _crc
+
+
+def legacy_encode(request):
+    """原始的帧拼接实现，仅用于对比"""
+    payload = bytes(json.dumps(request), 'utf-8')
+    data = bytes([0xFF, 0xAA])
+    data += struct.pack('@H', len(payload))
+    data += payload
+    data += struct.pack('@H', legacy_crc(payload))
+    data += bytes([0xFE])
+    return data
+
+
+def self_check():
+    if ace_protocol.calc_crc(b'123456789') != 0x6f91:
+        return 'CRC 校验值错误'
+    for length in range(0, 1100):
+        data = os.urandom(length)
+        expected = legacy_crc(data)
+        if ace_protocol.calc_crc(data) != expected or ace_protocol.calc_crc_table(data) != expected:
+            return 'CRC 不一致，长度 %d' % (length,)
+    encoder = ace_protocol.AceFrameEncoder()
+    for request in ({"method": "get_status", "id": 7},
+                    {"method": "feed_filament", "params": {"index": 1, "length": 630, "speed": 80}, "id": 8}):
+        legacy = legacy_encode(request)
+        compact = bytes(encoder.encode(request))
+        if compact[4:-3] != json.dumps(request, separators=(',', ':')).encode('utf-8'):
+            return '编码器负载不一致: ' + request['method']
+        if json.loads(legacy[4:-3]) != json.loads(compact[4:-3]):
+            return '编码器与原始实现不一致: ' + request['method']
+    return None
+
+
+def bench(func, arg, min_time):
+    count = 0
+    start = time.perf_counter()
+    end = start + min_time
+    while True:
+        for _ in range(100):
+            func(arg)
+        count += 100
+        now = time.perf_counter()
+        if now >= end:
+            return count / (now - start)
+
+
+def frame(obj):
+    return bytes(ace_protocol.AceFrameEncoder().encode(obj))
+
+
+def status_stream(count):
+    """count 个连续的 get_status 响应帧"""
+    out = bytearray()
+    for i in range(count):
+        response = dict(SAMPLE_STATUS, id=i)
+        out += frame(response)
+    return bytes(out)
+
+
+def make_decode_fragmented(chunk):
+    stream = status_stream(16)
+    chunks = [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+    decoder = ace_protocol.AceFrameDecoder()
+
+    def run(_):
+        for data in chunks:
+            decoder.feed(data)
+    return run, 16
+
+
+def make_decode_multi():
+    stream = status_stream(16)
+    decoder = ace_protocol.AceFrameDecoder()
+    return (lambda _: decoder.feed(stream)), 16
+
+
+def make_decode_corrupt():
+    # 每 4 帧有一帧 CRC 错误，其中还夹带一个帧头，测量重新同步的开销
+    frames = []
+    for i in range(16):
+        data = bytearray(frame(dict(SAMPLE_STATUS, id=i)))
+        if i % 4 == 0:
+            data[40:42] = ace_protocol.FRAME_HEADER
+        frames.append(bytes(data))
+    stream = b''.join(frames)
+    decoder = ace_protocol.AceFrameDecoder()
+    return (lambda _: decoder.feed(stream)), 16
+
+
+def make_json_parse():
+    payload = json.dumps(SAMPLE_STATUS).encode('utf-8')
+    return (lambda _: json.loads(payload.decode('utf-8'))), 1
+
+
+def make_scheduler():
+    scheduler = ace_protocol.AceRequestScheduler()
+    requests = [
+        {"method": "feed_filament", "params": {"index": 1, "length": 630, "speed": 80}},
+        {"method": "get_status"},
+        {"method": "drying", "params": {"temp": 50, "fan_speed": 7000, "duration": 240}},
+        {"method": "get_status"},
+    ]
+
+    def run(_):
+        for request in requests:
+            scheduler.put(dict(request), None)
+        while scheduler.pop() is not None:
+            pass
+    return run, len(requests)
+
+
+def make_status_delta():
+    # 与驱动相同的比较：未变化的状态只需一次字典比较
+    old = json.loads(json.dumps(SAMPLE_STATUS['result']))
+    new = json.loads(json.dumps(SAMPLE_STATUS['result']))
+    return (lambda _: old != new), 1
+
+
+class LoopbackDevice:
+    """在 PTY 另一端用线程回复请求的最小设备"""
+
+    def __init__(self):
+        import pty, threading, tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        decoder = ace_protocol.AceFrameDecoder()
+        encoder = ace_protocol.AceFrameEncoder()
+        result = SAMPLE_STATUS['result']
+        while self.running:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            for payload in decoder.feed(data):
+                request = json.loads(payload)
+                os.write(self.master, encoder.encode(
+                    {"id": request['id'], "code": 0, "msg": "success", "result": result}))
+
+    def close(self):
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+
+def measure_round_trip(fd, count):
+    """在 fd 上逐个发送 get_status 并等待响应，返回每次往返的秒数"""
+    import select
+    encoder = ace_protocol.AceFrameEncoder()
+    decoder = ace_protocol.AceFrameDecoder()
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        os.write(fd, encoder.encode({"method": "get_status", "id": i}))
+        done = False
+        while not done:
+            if not select.select([fd], [], [], 2.)[0]:
+                raise RuntimeError('往返超时')
+            for payload in decoder.feed(os.read(fd, 4096)):
+                if json.loads(payload)['id'] == i:
+                    done = True
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def round_trip_loopback(count):
+    device = LoopbackDevice()
+    try:
+        return measure_round_trip(device.slave, count)
+    finally:
+        device.close()
+
+
+def round_trip_client(count, concurrent=False):
+    """经 AceClient（与 tools/ace_cli.py 相同的 asyncio 代码路径）测量往返延迟
+
+    concurrent 时同时发出全部请求，由客户端流水线发送，结果按总用时平均到每个请求。
+    """
+    import asyncio
+    device = LoopbackDevice()
+
+    async def timed(client, index):
+        start = time.perf_counter()
+        await client.call('get_filament_info', {"index": index % 4})
+        return time.perf_counter() - start
+
+    async def run():
+        # 回环设备没有 ACE 的接收窗口限制，放开发送限速以测量代码路径本身
+        client = ace_protocol.AceClient(os.ttyname(device.slave), status_interval=2., window_bytes=1 << 20)
+        await client.connect()
+        try:
+            if concurrent:
+                start = time.perf_counter()
+                await asyncio.gather(*(timed(client, i) for i in range(count)))
+                return [(time.perf_counter() - start) / count] * count
+            return [await timed(client, i) for i in range(count)]
+        finally:
+            await client.close()
+
+    try:
+        return asyncio.run(run())
+    finally:
+        device.close()
+
+
+def round_trip_emulator(count):
+    import subprocess, tempfile, tty
+    link = os.path.join(tempfile.mkdtemp(), 'ace_emu')
+    emulator = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ace_emulator.py'),
+         '--link', link, '--latency', '0'], stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            if os.path.exists(link):
+                break
+            time.sleep(0.1)
+        fd = os.open(link, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(fd)
+        try:
+            return measure_round_trip(fd, count)
+        finally:
+            os.close(fd)
+    finally:
+        emulator.terminate()
+        emulator.wait()
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] * 1e6
+    return {'ops_per_sec': len(samples) / sum(samples), 'us_per_op': sum(samples) / len(samples) * 1e6,
+            'p50_us': pick(.5), 'p99_us': pick(.99), 'samples': len(samples)}
+
+
+def throughput_benchmarks():
+    payload = json.dumps(SAMPLE_STATUS).encode('utf-8')
+    encoder = ace_protocol.AceFrameEncoder()
+    status_request = {"method": "get_status", "id": 1234}
+    feed_request = {"method": "feed_filament", "params": {"index": 1, "length": 630, "speed": 80}, "id": 1235}
+    # (名称, 函数, 参数, 每次调用处理的帧/请求数)
+    return [
+        ('crc.legacy', legacy_crc, payload, 1),
+        ('crc.table', ace_protocol.calc_crc_table, payload, 1),
+        ('crc.crc_hqx', ace_protocol.calc_crc, payload, 1),
+        ('encode.legacy.get_status', legacy_encode, status_request, 1),
+        ('encode.get_status', encoder.encode, status_request, 1),
+        ('encode.legacy.feed', legacy_encode, feed_request, 1),
+        ('encode.feed', encoder.encode, feed_request, 1),
+        ('decode.multi_frame', ) + make_decode_multi()[:1] + (None, 16),
+        ('decode.fragmented_7', ) + make_decode_fragmented(7)[:1] + (None, 16),
+        ('decode.fragmented_64', ) + make_decode_fragmented(64)[:1] + (None, 16),
+        ('decode.resync', ) + make_decode_corrupt()[:1] + (None, 16),
+        ('json.parse_status', ) + make_json_parse()[:1] + (None, 1),
+        ('status.delta_unchanged', ) + make_status_delta()[:1] + (None, 1),
+        ('scheduler.put_pop', ) + make_scheduler()[:1] + (None, 4),
+    ]
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    regressions = 0
+    print('\n与 %s 比较（每次操作耗时）:' % (baseline_path,))
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        change = (result['us_per_op'] - old['us_per_op']) / old['us_per_op'] * 100.
+        flag = ''
+        if change > threshold:
+            flag = '  <-- 回退'
+            regressions += 1
+        print('  %-28s %10.2f -> %10.2f us  %+6.1f%%%s' % (name, old['us_per_op'], result['us_per_op'], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACE 协议层基准测试')
+    parser.add_argument('--self-check', action='store_true', help='仅运行一致性自检')
+    parser.add_argument('--time', type=float, default=1.0, help='每项测试的最短运行时间（秒）')
+    parser.add_argument('--filter', default='', help='只运行名称包含该字符串的测试')
+    parser.add_argument('--round-trips', type=int, default=500, help='往返延迟测试的请求次数，0 跳过')
+    parser.add_argument('--emulator', action='store_true', help='同时测量与 ace_emulator.py 的往返延迟')
+    parser.add_argument('--json', dest='json_path', help='把结果写入 JSON 文件')
+    parser.add_argument('--compare', help='与之前的 JSON 结果比较')
+    parser.add_argument('--threshold', type=float, default=10., help='判定为回退的耗时增加百分比')
+    args = parser.parse_args()
+
+    error = self_check()
+    if error is not None:
+        print('自检失败: ' + error)
+        return 1
+    print('自检通过')
+    if args.self_check:
+        return 0
+
+    results = {}
+    for name, func, arg, per_call in throughput_benchmarks():
+        if args.filter not in name:
+            continue
+        rate = bench(func, arg, args.time) * per_call
+        results[name] = {'ops_per_sec': rate, 'us_per_op': 1e6 / rate}
+        print('%-28s %12.0f 次/秒  %10.2f us/次' % (name, rate, 1e6 / rate))
+
+    round_trips = [('rtt.loopback', round_trip_loopback),
+                   ('rtt.client', round_trip_client),
+                   ('rtt.client_pipelined', lambda count: round_trip_client(count, True))]
+    if args.emulator:
+        round_trips.append(('rtt.emulator', round_trip_emulator))
+    for name, func in round_trips:
+        if args.round_trips <= 0 or args.filter not in name:
+            continue
+        result = results[name] = summarize(func(args.round_trips))
+        print('%-28s %12.0f 次/秒  %10.2f us/次  p50 %.1f us  p99 %.1f us' % (
+            name, result['ops_per_sec'], result['us_per_op'], result['p50_us'], result['p99_us']))
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'time': time.time(), 'python': platform.python_version(),
+                       'machine': platform.machine(), 'node': platform.node(),
+                       'processor': platform.processor(), 'results': results}, f, indent=2)
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
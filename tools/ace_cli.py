@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# 不经过 Klipper 直接操作 ACE 的命令行工具
+#
+# 使用与驱动相同的协议层（extras/ace_protocol.py 中的 AceClient），用于
+# 离机测试和老化。不给出 --port 时按 /dev/serial/by-id 自动查找 ACE。
+# 不要在 Klipper 已连接同一台 ACE 时使用。
+#
+# 用法：
+#   ~/klippy-env/bin/python tools/ace_cli.py info
+#   ~/klippy-env/bin/python tools/ace_cli.py status
+#   ~/klippy-env/bin/python tools/ace_cli.py filament 0 1 2 3
+#   ~/klippy-env/bin/python tools/ace_cli.py feed 0 100 --speed 25
+#   ~/klippy-env/bin/python tools/ace_cli.py retract 0 100
+#   ~/klippy-env/bin/python tools/ace_cli.py dry 55 240
+#   ~/klippy-env/bin/python tools/ace_cli.py dry-stop
+#   ~/klippy-env/bin/python tools/ace_cli.py monitor --duration 600
+#   ~/klippy-env/bin/python tools/ace_cli.py --port /tmp/ace_emu burn-in --cycles 100 --slots 0 1
+import argparse, asyncio, json, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extras'))
+import ace_protocol
+
+
+def show(value):
+    print(json.dumps(value, indent=2, ensure_ascii=False))
+
+
+async def cmd_info(client, args):
+    show(dict(client.info, capabilities=client.capabilities))
+
+
+async def cmd_status(client, args):
+    show(await client.get_status())
+
+
+async def cmd_filament(client, args):
+    slots = args.index or range(len(client.status['slots']) if client.status else 4)
+    # 查询以流水线方式一次发出
+    results = await asyncio.gather(*(client.get_filament_info(index) for index in slots))
+    show(dict(zip(slots, results)))
+
+
+async def cmd_feed(client, args):
+    start = time.monotonic()
+    await client.feed(args.index, args.length, args.speed)
+    print(f'已送料 {args.length}mm，用时 {time.monotonic() - start:.2f}s')
+
+
+async def cmd_retract(client, args):
+    start = time.monotonic()
+    await client.retract(args.index, args.length, args.speed)
+    print(f'已退料 {args.length}mm，用时 {time.monotonic() - start:.2f}s')
+
+
+async def cmd_assist(client, args):
+    if args.stop:
+        await client.stop_feed_assist(args.index)
+        print(f'已停止料盘 {args.index} 的进料辅助')
+    else:
+        await client.start_feed_assist(args.index)
+        print(f'已启用料盘 {args.index} 的进料辅助')
+
+
+async def cmd_dry(client, args):
+    await client.start_drying(args.temp, args.duration, args.fan_speed)
+    print(f'开始干燥：{args.temp}°C，{args.duration} 分钟')
+
+
+async def cmd_dry_stop(client, args):
+    await client.stop_drying()
+    print('已停止干燥')
+
+
+def describe(event, args):
+    if event == 'slot_status':
+        index, previous, status = args
+        return f'料盘 {index}: {previous} -> {status}'
+    if event == 'dryer':
+        old, new = args
+        return f'干燥: {json.dumps(new, ensure_ascii=False)}'
+    return f'进料辅助计数: {args[0]}'
+
+
+async def cmd_monitor(client, args):
+    """打印状态变化，直到 --duration 秒后或按 Ctrl-C"""
+    deadline = None if not args.duration else time.monotonic() + args.duration
+    previous = None
+    stream = client.subscribe()
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            timeout = None if deadline is None else max(0., deadline - time.monotonic())
+            try:
+                status = await asyncio.wait_for(stream.__anext__(), timeout)
+            except (asyncio.TimeoutError, StopAsyncIteration):
+                break
+            stamp = time.strftime('%H:%M:%S')
+            if previous is None:
+                print(f'{stamp} {status.get("status")}，温度 {status.get("temp")}°C')
+            else:
+                if status.get('status') != previous.get('status'):
+                    print(f'{stamp} 状态: {previous.get("status")} -> {status.get("status")}')
+                counter = (client.capabilities or {}).get('feed_assist_count', -1) != 0
+                for event, event_args in ace_protocol.status_deltas(previous, status, counter):
+                    print(f'{stamp} {describe(event, event_args)}')
+            previous = status
+    finally:
+        await stream.aclose()
+
+
+async def cmd_burn_in(client, args):
+    """反复送料和退料，统计失败次数"""
+    failures = 0
+    start = time.monotonic()
+    for cycle in range(args.cycles):
+        for index in args.slots:
+            try:
+                await client.feed(index, args.length, args.speed)
+                await client.retract(index, args.length, args.speed)
+            except ace_protocol.AceError as e:
+                failures += 1
+                print(f'第 {cycle + 1} 轮料盘 {index} 失败: {e}')
+        print(f'第 {cycle + 1}/{args.cycles} 轮完成，失败 {failures}，'
+              f'已运行 {time.monotonic() - start:.0f}s')
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='不经过 Klipper 操作 ACE')
+    parser.add_argument('--port', help='串口路径，默认自动查找')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--timeout', type=float, default=2., help='请求超时（秒）')
+    parser.add_argument('--stats', action='store_true', help='结束时打印各方法的往返延迟')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('info', help='固件信息').set_defaults(func=cmd_info)
+    commands.add_parser('status', help='当前状态').set_defaults(func=cmd_status)
+    sub = commands.add_parser('filament', help='料盘 RFID 信息')
+    sub.add_argument('index', type=int, nargs='*')
+    sub.set_defaults(func=cmd_filament)
+    for name, func, help in (('feed', cmd_feed, '送料'), ('retract', cmd_retract, '退料')):
+        sub = commands.add_parser(name, help=help)
+        sub.add_argument('index', type=int)
+        sub.add_argument('length', type=float, help='长度（mm）')
+        sub.add_argument('--speed', type=float, default=25, help='速度（mm/s）')
+        sub.set_defaults(func=func)
+    sub = commands.add_parser('assist', help='进料辅助')
+    sub.add_argument('index', type=int)
+    sub.add_argument('--stop', action='store_true')
+    sub.set_defaults(func=cmd_assist)
+    sub = commands.add_parser('dry', help='开始干燥')
+    sub.add_argument('temp', type=int, help='温度（°C）')
+    sub.add_argument('duration', type=int, help='时长（分钟）')
+    sub.add_argument('--fan-speed', type=int, default=7000)
+    sub.set_defaults(func=cmd_dry)
+    commands.add_parser('dry-stop', help='停止干燥').set_defaults(func=cmd_dry_stop)
+    sub = commands.add_parser('monitor', help='打印状态变化')
+    sub.add_argument('--duration', type=float, default=0., help='监视时长（秒），0 表示直到 Ctrl-C')
+    sub.set_defaults(func=cmd_monitor)
+    sub = commands.add_parser('burn-in', help='反复送料退料')
+    sub.add_argument('--cycles', type=int, default=10)
+    sub.add_argument('--slots', type=int, nargs='+', default=[0, 1, 2, 3])
+    sub.add_argument('--length', type=float, default=50)
+    sub.add_argument('--speed', type=float, default=25)
+    sub.set_defaults(func=cmd_burn_in)
+    args = parser.parse_args()
+
+    async def run():
+        client = ace_protocol.AceClient(args.port, args.baud, args.timeout)
+        await client.connect()
+        try:
+            result = await args.func(client, args)
+        finally:
+            await client.close()
+        if args.stats:
+            show(client.latency.snapshot(time.monotonic()))
+        return result or 0
+
+    try:
+        return asyncio.run(run())
+    except (ace_protocol.AceError, ace_protocol.SerialException) as e:
+        print(str(e))
+        return 1
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# 基于伪终端的 ACE Pro 模拟器
+#
+# 打开一个 PTY 并在其上实现 PROTOCOL.md 中的分帧 JSON-RPC，模拟送料、
+# 退料、进料辅助、干燥和 RFID。把 [ace] 的 serial 指向 --link 给出的路径
+# 即可让驱动连接到模拟器：
+#
+#   python tools/ace_emulator.py --link /tmp/ace_emu
+#   [ace]
+#   serial: /tmp/ace_emu
+#
+# 可以注入与固件已知行为一致的故障：3 秒无完整帧断开、接收缓冲区溢出、
+# 以及错误帧头导致的冻结。
+import argparse, heapq, json, os, random, select, sys, time, tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extras'))
+import ace_protocol
+
+KEEPALIVE_TIMEOUT = 3.
+RX_WINDOW_BYTES = 1024
+RX_WINDOW_TIME = 0.1
+
+
+class FirmwareParser:
+    """模仿固件的简单接收状态机：找到帧头后按长度读取，不做重新同步"""
+
+    def __init__(self, freeze_on_long_frame=False, max_payload=ace_protocol.MAX_PAYLOAD_LENGTH):
+        self.freeze_on_long_frame = freeze_on_long_frame
+        self.max_payload = max_payload
+        self.buffer = bytearray()
+        self.frozen = False
+        self.bad_frames = 0
+
+    def feed(self, data):
+        """返回 (完整帧负载列表, 本次是否完成了至少一帧)"""
+        buf = self.buffer
+        buf += data
+        frames = []
+        completed = False
+        while not self.frozen:
+            start = buf.find(ace_protocol.FRAME_HEADER)
+            if start < 0:
+                del buf[:max(0, len(buf) - 1)]
+                break
+            del buf[:start]
+            if len(buf) < 4:
+                break
+            length = buf[2] | (buf[3] << 8)
+            if length > self.max_payload:
+                if self.freeze_on_long_frame:
+                    # 超长帧会让 ACE 进入无法恢复的状态
+                    self.frozen = True
+                    break
+                del buf[:1]
+                continue
+            end = 4 + length + 2
+            if len(buf) < end:
+                break
+            tail = buf.find(bytes([ace_protocol.FRAME_TAIL]), end)
+            if tail < 0:
+                break
+            payload = bytes(buf[4:4 + length])
+            crc = buf[end - 2] | (buf[end - 1] << 8)
+            del buf[:tail + 1]
+            completed = True
+            if ace_protocol.calc_crc(payload) != crc:
+                self.bad_frames += 1
+                continue
+            frames.append(payload)
+        return frames, completed
+
+
+class AceEmulator:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.encoder = ace_protocol.AceFrameEncoder()
+        self.timers = []
+        self.timer_seq = 0
+        self.master = None
+        self.slave = None
+        self.parser = FirmwareParser(args.fault_header_freeze)
+        self.last_frame_time = time.monotonic()
+        self.rx_history = []
+        self.frozen_until = None
+        self.stats = {'requests': 0, 'responses': 0, 'dropped_bytes': 0, 'disconnects': 0,
+                      'freezes': 0, 'bad_frames': 0}
+
+        self.action = None
+        self.action_end = 0.
+        self.action_slot = -1
+        self.feed_assist_index = -1
+        self.feed_assist_count = 0
+        self.feed_assist_start = None
+        self.enable_rfid = 1
+        self.dryer = {'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0}
+        self.dryer_end = 0.
+        self.temp = 25
+        self.fan_speed = 0
+        self.slots = []
+        for index in range(args.slots):
+            loaded = index not in args.empty
+            self.slots.append({
+                'index': index,
+                'status': 'ready' if loaded else 'empty',
+                'sku': 'EMU-%02d' % (index,) if loaded else '',
+                'brand': 'Emulator' if loaded else '',
+                'type': 'PLA' if loaded else '',
+                'color': [(index * 85) % 256, (index * 170) % 256, 255 - (index * 60) % 256] if loaded else [0, 0, 0],
+                'rfid': 2 if loaded else 0,
+            })
+
+    # --- PTY ---------------------------------------------------------------
+
+    def open_pty(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        name = os.ttyname(self.slave)
+        if self.args.link:
+            tmp = self.args.link + '.tmp'
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            os.symlink(name, tmp)
+            os.replace(tmp, self.args.link)
+        self.log(f'PTY {name}' + (f' -> {self.args.link}' if self.args.link else ''))
+        self.parser = FirmwareParser(self.args.fault_header_freeze)
+        self.last_frame_time = time.monotonic()
+
+    def disconnect(self, reason):
+        """模拟 USB 断开：关闭旧 PTY，稍后出现一个新的"""
+        self.stats['disconnects'] += 1
+        self.log(f'断开连接（{reason}）')
+        os.close(self.master)
+        os.close(self.slave)
+        self.master = self.slave = None
+        self.add_timer(self.args.reconnect_delay, self.open_pty)
+
+    # --- 定时器 --------------------------------------------------------------
+
+    def add_timer(self, delay, callback):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.timer_seq, callback))
+
+    def run_timers(self, now):
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self.timers)
+            callback()
+
+    # --- 接收 ----------------------------------------------------------------
+
+    def on_readable(self, now):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # 驱动关闭了串口
+            data = b''
+        if not data:
+            return
+        if self.args.fault_overflow:
+            data = self.apply_rx_window(now, data)
+        if self.frozen_until is not None:
+            return
+        frames, completed = self.parser.feed(data)
+        if completed:
+            self.last_frame_time = now
+        self.stats['bad_frames'] = self.parser.bad_frames
+        if self.parser.frozen:
+            self.freeze(now)
+            return
+        for payload in frames:
+            self.handle_payload(payload)
+
+    def apply_rx_window(self, now, data):
+        """共用的环形缓冲区：短时间内超过 1024 字节的数据被丢弃"""
+        self.rx_history = [(t, n) for t, n in self.rx_history if t > now - RX_WINDOW_TIME]
+        used = sum(n for _, n in self.rx_history)
+        allowed = max(0, RX_WINDOW_BYTES - used)
+        if len(data) > allowed:
+            self.stats['dropped_bytes'] += len(data) - allowed
+            self.log(f'接收缓冲区溢出，丢弃 {len(data) - allowed} 字节')
+            data = data[:allowed]
+        if data:
+            self.rx_history.append((now, len(data)))
+        return data
+
+    def freeze(self, now):
+        self.stats['freezes'] += 1
+        if self.args.freeze_time > 0:
+            self.frozen_until = now + self.args.freeze_time
+            self.log(f'错误帧头导致冻结 {self.args.freeze_time:.1f}s')
+        else:
+            self.frozen_until = float('inf')
+            self.log('错误帧头导致冻结（不可恢复）')
+
+    def check_keepalive(self, now):
+        if self.frozen_until is not None:
+            if now >= self.frozen_until:
+                self.frozen_until = None
+                self.disconnect('冻结后复位')
+            return
+        if self.args.fault_disconnect and now - self.last_frame_time > KEEPALIVE_TIMEOUT:
+            self.disconnect('3 秒内没有完整帧')
+
+    # --- RPC -----------------------------------------------------------------
+
+    def handle_payload(self, payload):
+        try:
+            request = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            return
+        self.stats['requests'] += 1
+        if self.args.verbose:
+            self.log('<< ' + payload.decode('utf-8'))
+        handler = getattr(self, 'rpc_' + str(request.get('method')), None)
+        params = request.get('params') or {}
+        if handler is None:
+            response = {'code': -1, 'msg': 'unknown method', 'result': {}}
+        else:
+            response = handler(params)
+        response['id'] = request.get('id')
+        if self.random.random() < self.args.drop_rate:
+            return
+        self.add_timer(self.args.latency / 1000., lambda: self.send(response))
+
+    def send(self, response):
+        if self.master is None:
+            return
+        data = bytearray(self.encoder.encode(response))
+        if self.random.random() < self.args.corrupt_rate:
+            data[self.random.randrange(4, len(data))] ^= 0xFF
+        try:
+            os.write(self.master, data)
+        except OSError:
+            return
+        self.stats['responses'] += 1
+        if self.args.verbose:
+            self.log('>> ' + json.dumps(response))
+
+    @staticmethod
+    def ok(result=None, msg='success'):
+        return {'code': 0, 'msg': msg, 'result': result or {}}
+
+    def slot_param(self, params):
+        index = params.get('index', -1)
+        if not isinstance(index, int) or not 0 <= index < len(self.slots):
+            return None
+        return index
+
+    def rpc_get_info(self, params):
+        return self.ok({'id': 0, 'slots': len(self.slots), 'model': 'Anycubic Color Engine Pro',
+                        'firmware': self.args.firmware, 'boot_firmware': 'V1.0.1'})
+
+    def rpc_get_status(self, params):
+        now = time.monotonic()
+        busy = self.action is not None and now < self.action_end
+        if self.feed_assist_index >= 0:
+            self.feed_assist_count = int((now - self.feed_assist_start) * 10)
+        return self.ok({
+            'status': 'busy' if busy else 'ready',
+            'action': self.action if busy else '',
+            'dryer': dict(self.dryer),
+            'temp': self.temp,
+            'enable_rfid': self.enable_rfid,
+            'fan_speed': self.fan_speed,
+            'feed_assist_count': self.feed_assist_count,
+            'cont_assist_time': 0.0,
+            'slots': [{k: slot[k] for k in ('index', 'status', 'sku', 'type', 'color', 'rfid')}
+                      for slot in self.slots],
+        })
+
+    def rpc_get_filament_info(self, params):
+        index = self.slot_param(params)
+        if index is None:
+            return {'code': -1, 'msg': 'invalid index', 'result': {}}
+        slot = self.slots[index]
+        return self.ok({'index': index, 'sku': slot['sku'], 'brand': slot['brand'], 'type': slot['type'],
+                        'color': slot['color'], 'rfid': slot['rfid'],
+                        'extruder_temp': {'min': 190, 'max': 230}, 'hotbed_temp': {'min': 50, 'max': 60},
+                        'diameter': 1.75, 'total': 330, 'current': 0})
+
+    def start_motion(self, action, params):
+        index = self.slot_param(params)
+        if index is None:
+            return {'code': -1, 'msg': 'invalid index', 'result': {}}
+        now = time.monotonic()
+        if self.action is not None and now < self.action_end:
+            return {'code': -1, 'msg': 'busy', 'result': {}}
+        if action == 'feeding' and self.slots[index]['status'] != 'ready':
+            return {'code': -1, 'msg': 'slot empty', 'result': {}}
+        length = max(0, params.get('length', 0))
+        speed = max(1, params.get('speed', 25))
+        # 电机加减速和换挡带来的固定开销
+        self.action = action
+        self.action_slot = index
+        self.action_end = now + length / float(speed) + self.args.motion_overhead
+        return self.ok()
+
+    def rpc_feed_filament(self, params):
+        return self.start_motion('feeding', params)
+
+    def rpc_unwind_filament(self, params):
+        return self.start_motion('unwinding', params)
+
+    def stop_motion(self, params):
+        if self.slot_param(params) is None:
+            return {'code': -1, 'msg': 'invalid index', 'result': {}}
+        self.action_end = time.monotonic()
+        return self.ok()
+
+    rpc_stop_feed_filament = stop_motion
+    rpc_stop_unwind_filament = stop_motion
+
+    def rpc_update_feeding_speed(self, params):
+        return self.ok() if self.slot_param(params) is not None else {'code': -1, 'msg': 'invalid index', 'result': {}}
+
+    rpc_update_unwinding_speed = rpc_update_feeding_speed
+
+    def rpc_start_feed_assist(self, params):
+        index = self.slot_param(params)
+        if index is None:
+            return {'code': -1, 'msg': 'invalid index', 'result': {}}
+        self.feed_assist_index = index
+        self.feed_assist_start = time.monotonic()
+        return self.ok()
+
+    def rpc_stop_feed_assist(self, params):
+        if self.slot_param(params) is None:
+            return {'code': -1, 'msg': 'invalid index', 'result': {}}
+        self.feed_assist_index = -1
+        self.feed_assist_count = 0
+        return self.ok(msg='')
+
+    def rpc_drying(self, params):
+        temp = params.get('temp', 0)
+        duration = params.get('duration', 240)
+        self.dryer = {'status': 'drying', 'target_temp': temp, 'duration': duration, 'remain_time': duration}
+        self.dryer_end = time.monotonic() + duration * 60.
+        self.fan_speed = params.get('fan_speed', 7000)
+        return self.ok(msg='drying')
+
+    def rpc_drying_stop(self, params):
+        self.dryer = {'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0}
+        self.fan_speed = 0
+        return self.ok()
+
+    def rpc_enable_rfid(self, params):
+        self.enable_rfid = 1
+        return self.ok()
+
+    def rpc_disable_rfid(self, params):
+        self.enable_rfid = 0
+        return self.ok()
+
+    # --- 主循环 --------------------------------------------------------------
+
+    def tick(self, now):
+        if self.dryer['status'] == 'drying':
+            remain = max(0, int((self.dryer_end - now) / 60.) + 1)
+            self.dryer['remain_time'] = remain
+            if now >= self.dryer_end:
+                self.rpc_drying_stop({})
+            elif self.temp < self.dryer['target_temp']:
+                self.temp += 1
+        elif self.temp > 25:
+            self.temp -= 1
+        self.add_timer(1., lambda: self.tick(time.monotonic()))
+
+    def log(self, msg):
+        print(f'{time.monotonic():.3f} {msg}', flush=True)
+
+    def run(self):
+        self.open_pty()
+        self.add_timer(1., lambda: self.tick(time.monotonic()))
+        try:
+            while True:
+                now = time.monotonic()
+                self.run_timers(now)
+                if self.master is not None:
+                    self.check_keepalive(now)
+                timeout = 0.1
+                if self.timers:
+                    timeout = max(0., min(timeout, self.timers[0][0] - time.monotonic()))
+                fds = [self.master] if self.master is not None else []
+                readable = select.select(fds, [], [], timeout)[0] if fds else time.sleep(timeout) or []
+                if readable:
+                    self.on_readable(time.monotonic())
+        except KeyboardInterrupt:
+            self.log('统计: ' + json.dumps(self.stats))
+        finally:
+            if self.args.link and os.path.islink(self.args.link):
+                os.unlink(self.args.link)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACE Pro PTY 模拟器')
+    parser.add_argument('--link', default='/tmp/ace_emu', help='指向 PTY 的符号链接路径')
+    parser.add_argument('--slots', type=int, default=4, help='料盘数量')
+    parser.add_argument('--empty', type=int, nargs='*', default=[], help='初始为空的料盘')
+    parser.add_argument('--firmware', default='V1.3.82', help='get_info 报告的固件版本')
+    parser.add_argument('--latency', type=float, default=5., help='响应延迟（毫秒）')
+    parser.add_argument('--motion-overhead', type=float, default=0.3, help='每次送料/退料的额外时间（秒）')
+    parser.add_argument('--seed', type=int, default=0, help='故障注入的随机种子')
+    parser.add_argument('--drop-rate', type=float, default=0., help='丢弃响应的概率')
+    parser.add_argument('--corrupt-rate', type=float, default=0., help='损坏响应字节的概率')
+    parser.add_argument('--fault-disconnect', action='store_true', help='3 秒内没有完整帧时断开连接')
+    parser.add_argument('--fault-overflow', action='store_true', help='短时间内超过 1024 字节时丢弃数据')
+    parser.add_argument('--fault-header-freeze', action='store_true', help='读到超长帧头时冻结')
+    parser.add_argument('--freeze-time', type=float, default=0., help='冻结持续时间，0 表示不可恢复')
+    parser.add_argument('--reconnect-delay', type=float, default=0.5, help='断开后重新出现的延迟（秒）')
+    parser.add_argument('--verbose', '-v', action='store_true', help='打印每个请求和响应')
+    args = parser.parse_args()
+    AceEmulator(args).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# ACE 串口与 RPC 层的故障注入测试
+#
+# FaultProxy 在 ACE（或 ace_emulator.py）和客户端之间转发字节，按种子化的概率
+# 注入故障：丢字节、破坏 CRC、在随机位置拆分帧、重复响应、在负载中插入
+# 0xFF 0xAA、把响应延迟到超时之后。run 子命令对每种故障配置启动模拟器，
+# 用 AceClient（与驱动相同的 AceLink 请求处理）施加负载，统计有效吞吐量、
+# 故障后的恢复时间和缓冲区占用；proxy 子命令只运行代理，把 [ace] 的 serial
+# 指向 --link 即可让 Klipper 中的驱动经受同样的故障。
+#
+# 用法：
+#   ~/klippy-env/bin/python tools/ace_faults.py run
+#   ~/klippy-env/bin/python tools/ace_faults.py run --profile header delay --duration 20 --json faults.json
+#   ~/klippy-env/bin/python tools/ace_faults.py proxy --device /dev/serial/by-id/usb-ANYCUBIC_ACE_1-if00 \
+#       --link /tmp/ace_faulty --profile mixed
+import argparse, asyncio, bisect, collections, json, os, random, signal, struct, subprocess, sys, tempfile
+import time, tracemalloc, tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extras'))
+import ace_protocol
+
+# 每种故障配置中各故障的概率（按帧计算）
+PROFILES = {
+    'clean': {},
+    'drop': {'drop': 0.05},
+    'crc': {'crc': 0.05},
+    'split': {'split': 0.5},
+    'duplicate': {'duplicate': 0.1},
+    'header': {'header': 0.03},
+    'delay': {'delay': 0.03},
+    'mixed': {'drop': 0.01, 'crc': 0.01, 'split': 0.2, 'duplicate': 0.02, 'header': 0.01, 'delay': 0.01},
+}
+
+
+def frame_bytes(payload):
+    crc = ace_protocol.calc_crc(payload)
+    return (ace_protocol.FRAME_HEADER + struct.pack('<H', len(payload)) + payload
+            + struct.pack('<HB', crc, ace_protocol.FRAME_TAIL))
+
+
+class FaultProxy:
+    """在设备和客户端 PTY 之间转发字节并注入故障
+
+    设备发出的响应先按帧解码再逐帧处理，请求方向只注入丢字节。同一方向的输出
+    按顺序排队，拆分的各段之间不会插入其他帧；延迟的帧到期后排在队尾。
+    """
+
+    def __init__(self, device, link=None, profile=None, seed=0, delay=2.5):
+        self.profile = profile or {}
+        self.random = random.Random(seed)
+        self.delay = delay
+        self.link = link
+        self.device = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(self.device)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        if link:
+            tmp = link + '.tmp'
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            os.symlink(self.port, tmp)
+            os.replace(tmp, link)
+        self.decoder = ace_protocol.AceFrameDecoder()
+        self.faults = collections.Counter()
+        self.fault_times = []
+        self.bytes = [0, 0]
+        self.loop = None
+        self._queue = collections.deque()
+        self._pump_handle = None
+
+    def start(self, loop):
+        self.loop = loop
+        loop.add_reader(self.device, self._from_device)
+        loop.add_reader(self.master, self._from_client)
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.device)
+            self.loop.remove_reader(self.master)
+        if self._pump_handle is not None:
+            self._pump_handle.cancel()
+        for fd in (self.device, self.master, self.slave):
+            os.close(fd)
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+
+    def _chance(self, fault):
+        probability = self.profile.get(fault, 0.)
+        if probability and self.random.random() < probability:
+            self.faults[fault] += 1
+            self.fault_times.append(self.loop.time())
+            return True
+        return False
+
+    def _drop_bytes(self, data):
+        data = bytearray(data)
+        start = self.random.randrange(len(data))
+        del data[start:start + self.random.randint(1, 8)]
+        return bytes(data)
+
+    def _from_client(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        if data and self._chance('drop'):
+            data = self._drop_bytes(data)
+        if data:
+            os.write(self.device, data)
+            self.bytes[0] += len(data)
+
+    def _from_device(self):
+        try:
+            data = os.read(self.device, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        for payload in self.decoder.feed(data):
+            self._deliver(frame_bytes(payload))
+
+    def _deliver(self, frame):
+        if self._chance('delay'):
+            # 延迟到请求超时之后，到期时排在队尾
+            self.loop.call_later(self.delay, self._enqueue, frame)
+            return
+        frame = bytearray(frame)
+        if self._chance('crc'):
+            frame[-3] ^= 0xff
+        if self._chance('header'):
+            pos = self.random.randint(4, len(frame) - 3)
+            frame[pos:pos] = ace_protocol.FRAME_HEADER
+        if self._chance('drop'):
+            frame = bytearray(self._drop_bytes(frame))
+        for _ in range(2 if self._chance('duplicate') else 1):
+            if len(frame) > 2 and self._chance('split'):
+                cuts = sorted(self.random.sample(range(1, len(frame)), min(3, len(frame) - 1)))
+                start = 0
+                for cut in cuts + [len(frame)]:
+                    self._enqueue(bytes(frame[start:cut]), self.random.uniform(0.001, 0.01))
+                    start = cut
+            else:
+                self._enqueue(bytes(frame))
+
+    def _enqueue(self, data, gap=0.):
+        now = self.loop.time()
+        after = self._queue[-1][0] if self._queue else now
+        self._queue.append((max(now, after + gap), data))
+        self._pump()
+
+    def _pump(self):
+        self._pump_handle = None
+        now = self.loop.time()
+        queue = self._queue
+        while queue and queue[0][0] <= now:
+            _, data = queue.popleft()
+            n = os.write(self.master, data)
+            self.bytes[1] += n
+            if n < len(data):
+                queue.appendleft((now, data[n:]))
+                break
+        if queue:
+            self._pump_handle = self.loop.call_at(max(queue[0][0], now + 0.001), self._pump)
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def recovery_times(fault_times, calls):
+    """每次故障之后，第一个在故障后发出的请求成功完成所需的时间"""
+    calls = sorted(calls)
+    issued = [issue for issue, done in calls]
+    # 从后往前的最早完成时间
+    earliest = [None] * len(calls)
+    best = None
+    for i in range(len(calls) - 1, -1, -1):
+        done = calls[i][1]
+        best = done if best is None or done < best else best
+        earliest[i] = best
+    times = []
+    for fault_time in fault_times:
+        i = bisect.bisect_left(issued, fault_time)
+        if i < len(calls):
+            times.append(earliest[i] - fault_time)
+    return times
+
+
+async def run_profile(name, profile, args):
+    loop = asyncio.get_running_loop()
+    workdir = tempfile.mkdtemp()
+    link = os.path.join(workdir, 'ace_emu')
+    emulator = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ace_emulator.py'),
+         '--link', link, '--latency', str(args.latency)], stdout=subprocess.DEVNULL)
+    proxy = client = None
+    try:
+        for _ in range(50):
+            if os.path.exists(link):
+                break
+            await asyncio.sleep(0.1)
+        proxy = FaultProxy(link, None, profile, args.seed, args.delay)
+        proxy.start(loop)
+        client = ace_protocol.AceClient(proxy.port, request_timeout=args.timeout)
+        await client.connect()
+        tracemalloc.start()
+        start = loop.time()
+        end = start + args.duration
+        calls = []
+        failures = collections.Counter()
+        peaks = {'read_buffer': 0, 'inflight': 0, 'queued': 0}
+        rng = random.Random(args.seed)
+
+        async def worker():
+            while loop.time() < end:
+                roll = rng.random()
+                if roll < 0.1:
+                    method, params = 'enable_rfid', None
+                elif roll < 0.3:
+                    method, params = 'get_status', None
+                else:
+                    method, params = 'get_filament_info', {"index": rng.randrange(4)}
+                issue = loop.time()
+                try:
+                    await client.call(method, params)
+                except ace_protocol.AceError:
+                    failures[method] += 1
+                    continue
+                calls.append((issue, loop.time()))
+
+        async def sampler():
+            while loop.time() < end:
+                peaks['read_buffer'] = max(peaks['read_buffer'], client.decoder.buffered())
+                peaks['inflight'] = max(peaks['inflight'], len(client._callback_map))
+                peaks['queued'] = max(peaks['queued'], len(client.scheduler))
+                await asyncio.sleep(0.005)
+
+        await asyncio.gather(sampler(), *(worker() for _ in range(args.concurrency)))
+        elapsed = loop.time() - start
+        _, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        latencies = [done - issue for issue, done in calls]
+        recovery = recovery_times([t for t in proxy.fault_times if t < end], calls)
+        return {
+            'profile': profile,
+            'calls_per_sec': len(calls) / elapsed,
+            'rx_bytes_per_sec': proxy.bytes[1] / elapsed,
+            'ok': len(calls),
+            'failed': dict(failures),
+            'timeouts': client.request_timeouts,
+            'retries': client.request_retries,
+            'latency_p50_ms': percentile(latencies, .5) * 1e3 if latencies else None,
+            'latency_p99_ms': percentile(latencies, .99) * 1e3 if latencies else None,
+            'recovery_p50_ms': percentile(recovery, .5) * 1e3 if recovery else None,
+            'recovery_max_ms': max(recovery) * 1e3 if recovery else None,
+            'faults': dict(proxy.faults),
+            'decoder': {'crc_errors': client.decoder.crc_errors, 'length_errors': client.decoder.length_errors,
+                        'discarded_bytes': client.decoder.discarded_bytes},
+            'peak_read_buffer': peaks['read_buffer'],
+            'peak_inflight': peaks['inflight'],
+            'peak_queued': peaks['queued'],
+            'peak_memory_kib': memory_peak / 1024.,
+        }
+    finally:
+        if client is not None:
+            await client.close()
+        if proxy is not None:
+            proxy.close()
+        emulator.send_signal(signal.SIGINT)
+        emulator.wait()
+
+
+def show(name, result):
+    fmt = lambda value: '-' if value is None else '%.1f' % (value,)
+    print('%-10s %8.1f 次/秒  失败 %-4d 超时 %-4d p50 %6s ms  p99 %7s ms  恢复 p50 %7s / 最大 %7s ms  '
+          '缓冲 %5d B  在途 %2d  排队 %3d  内存 %6.1f KiB  故障 %s' % (
+              name, result['calls_per_sec'], sum(result['failed'].values()), result['timeouts'],
+              fmt(result['latency_p50_ms']), fmt(result['latency_p99_ms']),
+              fmt(result['recovery_p50_ms']), fmt(result['recovery_max_ms']),
+              result['peak_read_buffer'], result['peak_inflight'], result['peak_queued'],
+              result['peak_memory_kib'], json.dumps(result['faults'])), flush=True)
+
+
+def cmd_run(args):
+    results = {}
+    for name in args.profile or PROFILES:
+        results[name] = asyncio.run(run_profile(name, PROFILES[name], args))
+        show(name, results[name])
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'time': time.time(), 'seed': args.seed, 'duration': args.duration,
+                       'concurrency': args.concurrency, 'results': results}, f, indent=2)
+    return 0
+
+
+def cmd_proxy(args):
+    profile = dict(PROFILES[args.profile])
+
+    async def run():
+        proxy = FaultProxy(args.device, args.link, profile, args.seed, args.delay)
+        proxy.start(asyncio.get_running_loop())
+        print(f'{args.link} -> {proxy.port}，故障配置 {args.profile}: {json.dumps(profile)}', flush=True)
+        try:
+            while True:
+                await asyncio.sleep(10.)
+                print(f'已注入 {json.dumps(dict(proxy.faults))}，转发 {proxy.bytes[0]}/{proxy.bytes[1]} 字节',
+                      flush=True)
+        finally:
+            proxy.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACE 串口与 RPC 层故障注入')
+    commands = parser.add_subparsers(dest='command', required=True)
+    sub = commands.add_parser('run', help='对每种故障配置运行负载并统计')
+    sub.add_argument('--profile', nargs='*', choices=sorted(PROFILES), help='只运行这些配置')
+    sub.add_argument('--duration', type=float, default=10., help='每种配置的运行时间（秒）')
+    sub.add_argument('--concurrency', type=int, default=4, help='同时发出请求的协程数')
+    sub.add_argument('--timeout', type=float, default=2., help='请求超时（秒）')
+    sub.add_argument('--latency', type=float, default=5., help='模拟器响应延迟（毫秒）')
+    sub.add_argument('--json', dest='json_path', help='把结果写入 JSON 文件')
+    sub.set_defaults(func=cmd_run)
+    sub = commands.add_parser('proxy', help='只运行故障代理，供 Klipper 中的驱动连接')
+    sub.add_argument('--device', required=True, help='ACE 或模拟器的串口路径')
+    sub.add_argument('--link', default='/tmp/ace_faulty', help='指向代理 PTY 的符号链接')
+    sub.add_argument('--profile', default='mixed', choices=sorted(PROFILES))
+    sub.set_defaults(func=cmd_proxy)
+    for sub in commands.choices.values():
+        sub.add_argument('--seed', type=int, default=0, help='故障注入的随机种子')
+        sub.add_argument('--delay', type=float, default=2.5, help='delay 故障的延迟（秒）')
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# 离线重放 ACE 串口会话捕获文件
+#
+# 捕获文件由 [ace] 的 capture_file 选项或 ACE_CAPTURE 命令生成。重放时
+# 发送和接收的字节分别经过与驱动相同的帧解码器，响应经过驱动的 AceLink
+# 请求簿记（按 id 匹配、超时、重新同步、延迟统计），用于复现现场的帧头/长度
+# 错误，以及在没有打印机的情况下测量解码吞吐量。
+#
+# 用法：
+#   ~/klippy-env/bin/python tools/ace_replay.py ace_capture.bin
+#   ~/klippy-env/bin/python tools/ace_replay.py ace_capture.bin --realtime --verbose
+import argparse, collections, json, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extras'))
+import ace_protocol
+
+
+class ReplaySession(ace_protocol.AceLink):
+    """按驱动的方式重放一个捕获：发送的帧按捕获中的 id 登记为在途请求，
+    接收的字节经过 AceLink 与驱动共用的解码、响应匹配、超时和状态合并"""
+
+    def __init__(self, timeout=2., verbose=False):
+        # 捕获中的字节已经按驱动的节奏写出，重放时不再限速
+        super().__init__(request_timeout=timeout, window_bytes=1 << 30)
+        self.verbose = verbose
+        self.tx_decoder = ace_protocol.AceFrameDecoder()
+        self.timeouts = collections.Counter()
+        self.unmatched = 0
+        self.invalid_json = 0
+        self.bytes = [0, 0]
+        self._eventtime = 0.
+
+    def feed(self, eventtime, direction, data):
+        self._eventtime = eventtime
+        self.bytes[direction] += len(data)
+        self._expire_requests(eventtime)
+        # 驱动的重发在捕获中是一帧新的请求，不在这里重发
+        self._scheduler.clear()
+        if direction == ace_protocol.CAPTURE_TX:
+            for payload in self.tx_decoder.feed(data):
+                try:
+                    request = json.loads(payload.decode('utf-8'))
+                    id = request['id']
+                except (ValueError, KeyError, TypeError):
+                    self.invalid_json += 1
+                    continue
+                self._log(eventtime, '>>', payload)
+                self._request_id = id
+                method = request.get('method')
+                priority = ace_protocol.METHOD_PRIORITY.get(method, ace_protocol.PRIORITY_CONTROL)
+                task = ace_protocol.AceRequest(request, None, priority, method in ace_protocol.RETRY_LIMITS)
+                self._dispatch(task, eventtime)
+        else:
+            self._handle_frames(self._decoder.feed(data), data)
+
+    # --- AceLink 的传输：只有捕获中的时间，没有串口 ------------------------------
+
+    def _now(self):
+        return self._eventtime
+
+    def _write(self, data):
+        return len(data)
+
+    def _kick_writer(self):
+        pass
+
+    def _reconnect(self):
+        pass
+
+    def _new_completion(self):
+        return None
+
+    def _poll_interval(self, eventtime):
+        return float('inf')
+
+    def _trace_rx(self, eventtime, id, task, payload):
+        self._log(eventtime, '<<', payload)
+        if task is None:
+            self.unmatched += 1
+
+    def _frame_error(self, reason, data):
+        if reason == 'json':
+            self.invalid_json += 1
+
+    def _request_timed_out(self, task, retry):
+        self.timeouts[task.method] += 1
+        self._log(self._eventtime, '!!', f'{task.method} id={task.id} 超时'.encode('utf-8'))
+
+    def _log(self, eventtime, marker, payload):
+        if self.verbose:
+            print(f'{eventtime:.6f} {marker} {payload.decode("utf-8", "replace")}')
+
+    def report(self):
+        print(f'发送 {self.bytes[ace_protocol.CAPTURE_TX]} 字节，接收 {self.bytes[ace_protocol.CAPTURE_RX]} 字节')
+        for name, decoder in (('发送', self.tx_decoder), ('接收', self._decoder)):
+            print(f'{name}: 帧 {decoder.frames}，CRC 错误 {decoder.crc_errors}，'
+                  f'长度错误 {decoder.length_errors}，丢弃 {decoder.discarded_bytes} 字节，'
+                  f'残留 {decoder.buffered()} 字节')
+        print(f'无效 JSON {self.invalid_json}，无对应请求的响应 {self.unmatched}，'
+              f'结束时未响应 {len(self._callback_map)}')
+        histograms = self.latency.histograms
+        for method in sorted(set(histograms) | set(self.timeouts)):
+            histogram = histograms.get(method)
+            if histogram is not None:
+                print(f'  {method:<20} {histogram.count:6d} 次  p50 {histogram.percentile(.5):7.2f}ms  '
+                      f'p99 {histogram.percentile(.99):7.2f}ms  超时 {self.timeouts.get(method, 0)}')
+            else:
+                print(f'  {method:<20}      0 次  超时 {self.timeouts.get(method, 0)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='重放 ACE 串口会话捕获')
+    parser.add_argument('capture', nargs='+', help='捕获文件（轮转的多个文件按时间顺序给出）')
+    parser.add_argument('--realtime', action='store_true', help='按记录的时间间隔重放')
+    parser.add_argument('--timeout', type=float, default=2., help='判定请求超时的秒数')
+    parser.add_argument('--verbose', '-v', action='store_true', help='打印每一帧')
+    args = parser.parse_args()
+
+    session = ReplaySession(args.timeout, args.verbose)
+    start = time.perf_counter()
+    first = None
+    for path in args.capture:
+        for eventtime, direction, data in ace_protocol.read_capture(path):
+            if args.realtime:
+                if first is None:
+                    first = (eventtime, time.perf_counter())
+                delay = (eventtime - first[0]) - (time.perf_counter() - first[1])
+                if delay > 0:
+                    time.sleep(delay)
+            session.feed(eventtime, direction, data)
+    elapsed = time.perf_counter() - start
+
+    session.report()
+    frames = session.tx_decoder.frames + session._decoder.frames
+    total = sum(session.bytes)
+    if not args.realtime and elapsed > 0:
+        print(f'重放用时 {elapsed:.3f}s：{frames / elapsed:.0f} 帧/秒，{total / elapsed / 1e6:.2f} MB/秒')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())